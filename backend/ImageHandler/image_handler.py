@@ -1,10 +1,22 @@
 import uuid
 import logging
 from google.cloud import storage, firestore
+from google.cloud.firestore_v1.field_path import FieldPath
 from flask import Flask, request, jsonify
 import json
 import os
+import time
+import queue
+import hashlib
+import functools
+import itertools
+import threading
+from collections import OrderedDict
 import requests
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.http import parse_options_header
+from werkzeug.sansio.multipart import MultipartDecoder, NeedData, Field, File, Data, Epilogue
+from google.api_core.exceptions import Conflict, FailedPrecondition, NotFound
 
 current_dir = os.path.dirname(os.path.abspath(__file__))
 print(current_dir)
@@ -25,6 +37,61 @@ BATCH_TABLE_NAME=os.getenv('BATCH_TABLE_NAME','batch_uploads')
 IMAGE_METADATA_TABLE_NAME=os.getenv('IMAGE_METADATA_TABLE_NAME','image_metadata')
 # Configuration
 BUCKET_NAME = os.getenv("GCP_BUCKET_NAME", "cu-image-flow")
+# GCS uploads in flight at once, shared by all upload requests
+UPLOAD_CONCURRENCY = int(os.getenv("UPLOAD_CONCURRENCY", 16))
+# Most writes Firestore accepts in one batch
+FIRESTORE_BATCH_LIMIT = 500
+upload_executor = ThreadPoolExecutor(max_workers=UPLOAD_CONCURRENCY)
+# /upload-images/stream: bytes read from the request at a time, pieces of an
+# image queued for its upload, and the chunk size of the resumable upload
+# (a multiple of 256 KiB). Memory per image in flight is about
+# STREAMING_READ_SIZE * STREAMING_QUEUE_SIZE + STREAMING_CHUNK_SIZE.
+STREAMING_READ_SIZE = int(os.getenv("STREAMING_READ_SIZE", 64 * 1024))
+STREAMING_QUEUE_SIZE = int(os.getenv("STREAMING_QUEUE_SIZE", 4))
+STREAMING_CHUNK_SIZE = int(os.getenv("STREAMING_CHUNK_SIZE", 1024 * 1024))
+MAX_METADATA_BYTES = int(os.getenv("MAX_METADATA_BYTES", 1024 * 1024))
+# Images of one streaming request uploading at once: the one being received
+# and earlier ones finishing their upload. Streamed images wait on the client,
+# so they get threads of their own request rather than upload_executor's.
+STREAMING_UPLOADS_PER_REQUEST = int(os.getenv("STREAMING_UPLOADS_PER_REQUEST", 2))
+# Queued after the pieces of an image the request ended in the middle of
+STREAM_ABORTED = object()
+# Lifetime of the signed URLs /get-processed-images returns, and how much of it
+# must be left for a cached URL to be handed out again
+SIGNED_URL_MINUTES = int(os.getenv("SIGNED_URL_MINUTES", 60))
+SIGNED_URL_MIN_REMAINING_MINUTES = int(os.getenv("SIGNED_URL_MIN_REMAINING_MINUTES", 15))
+SIGNED_URL_CACHE_SIZE = int(os.getenv("SIGNED_URL_CACHE_SIZE", 5000))
+# Completed batches whose object listings are kept
+LISTING_CACHE_SIZE = int(os.getenv("LISTING_CACHE_SIZE", 256))
+# Largest page a paginated listing returns, and the page size NDJSON
+# responses are listed and sent in
+MAX_PAGE_SIZE = int(os.getenv("MAX_PAGE_SIZE", 1000))
+STREAM_PAGE_SIZE = int(os.getenv("STREAM_PAGE_SIZE", 100))
+# Orders Firestore queries by document id, so pages need no composite index
+DOCUMENT_ID = FieldPath.document_id()
+# How /batches hands out upload URLs: "signed" V4 signed PUT URLs, or
+# "resumable" upload sessions (also works against a local GCS emulator,
+# which cannot sign URLs)
+UPLOAD_URL_TYPE = os.getenv("UPLOAD_URL_TYPE", "signed")
+UPLOAD_URL_MINUTES = int(os.getenv("UPLOAD_URL_MINUTES", 30))
+# job_status of a batch created through /batches until it is committed
+AWAITING_UPLOAD = "Awaiting Upload"
+# Uploaded batches waiting to be posted to the interaction service, and how
+# they are posted: the request timeout, how often the outbox is checked
+# besides when an upload adds to it, how long a pod holds an entry it is
+# posting, and the delay before a retry, doubling per failed attempt up to
+# DISPATCH_MAX_RETRY_SECONDS, for at most DISPATCH_MAX_ATTEMPTS attempts
+OUTBOX_TABLE_NAME = os.getenv('OUTBOX_TABLE_NAME', 'dispatch_outbox')
+DISPATCH_TIMEOUT_SECONDS = float(os.getenv("DISPATCH_TIMEOUT_SECONDS", 30))
+DISPATCH_POLL_SECONDS = float(os.getenv("DISPATCH_POLL_SECONDS", 30))
+DISPATCH_LEASE_SECONDS = float(os.getenv("DISPATCH_LEASE_SECONDS", 120))
+DISPATCH_RETRY_SECONDS = float(os.getenv("DISPATCH_RETRY_SECONDS", 5))
+DISPATCH_MAX_RETRY_SECONDS = float(os.getenv("DISPATCH_MAX_RETRY_SECONDS", 300))
+DISPATCH_MAX_ATTEMPTS = int(os.getenv("DISPATCH_MAX_ATTEMPTS", 10))
+# Outbox entries read per query
+DISPATCH_BATCH_SIZE = int(os.getenv("DISPATCH_BATCH_SIZE", 50))
+# job_status of a batch the interaction service never accepted
+DISPATCH_FAILED = "Dispatch Failed"
 logging.basicConfig(level=logging.INFO)
 
 # Helper function to upload image to Google Cloud Storage
@@ -40,6 +107,45 @@ def upload_to_gcs(image_file, batch_uuid, image_name):
         logging.error(f"Failed to upload image to GCS: {e}")
         raise
 
+# Uploads an image as its pieces arrive on chunks, a queue ending in None.
+# The upload is abandoned if STREAM_ABORTED arrives instead.
+def stream_to_gcs(chunks, batch_uuid, image_name, content_type=None):
+    blob = storage_client.bucket(BUCKET_NAME).blob(f"{batch_uuid}/input/{image_name}")
+    data = b""
+    try:
+        with blob.open("wb", chunk_size=STREAMING_CHUNK_SIZE, ignore_flush=True, content_type=content_type) as writer:
+            data = chunks.get()
+            while data is not None:
+                if data is STREAM_ABORTED:
+                    raise RuntimeError("The request ended before the image was complete")
+                writer.write(data)
+                data = chunks.get()
+    except Exception as e:
+        # Take the rest of the image so the request reading it is not blocked
+        while data is not None and data is not STREAM_ABORTED:
+            data = chunks.get()
+        logging.error(f"Failed to upload image to GCS: {e}")
+        raise
+    logging.info(f"Image uploaded to GCS: {blob.public_url}")
+    return blob.public_url
+
+# Moves an image streamed under a provisional name to the name its metadata gave it
+def rename_streamed_image(upload_result, batch_uuid, streamed_name, image_name):
+    upload_result()
+    bucket = storage_client.bucket(BUCKET_NAME)
+    blob = bucket.rename_blob(bucket.blob(f"{batch_uuid}/input/{streamed_name}"), f"{batch_uuid}/input/{image_name}")
+    return blob.public_url
+
+# Deletes what a rejected streaming upload already put in the bucket
+def delete_streamed_images(batch_uuid, uploads):
+    bucket = storage_client.bucket(BUCKET_NAME)
+    for file_name, image_name, upload_result in uploads:
+        try:
+            upload_result()
+            bucket.blob(f"{batch_uuid}/input/{image_name}").delete()
+        except Exception as e:
+            logging.error(f"Failed to delete {image_name} of rejected batch {batch_uuid}: {e}")
+
 # Function to save data to Firestore with support for custom document IDs
 def save_to_firestore(table_name, data, doc_id=None):
     try:
@@ -50,50 +156,455 @@ def save_to_firestore(table_name, data, doc_id=None):
         logging.error(f"Failed to save data to Firestore: {e}")
         raise
 
+# Writes documents with as few commits as possible. Returns the error of each
+# document's commit, None where it was written.
+def save_batch_to_firestore(table_name, documents):
+    errors = {}
+    collection = firestore_client.collection(table_name)
+    doc_ids = list(documents)
+    for start in range(0, len(doc_ids), FIRESTORE_BATCH_LIMIT):
+        chunk = doc_ids[start:start + FIRESTORE_BATCH_LIMIT]
+        batch = firestore_client.batch()
+        for doc_id in chunk:
+            batch.set(collection.document(doc_id), documents[doc_id])
+        try:
+            batch.commit()
+            logging.info(f"Data saved to Firestore: {table_name} - {len(chunk)} documents")
+            errors.update((doc_id, None) for doc_id in chunk)
+        except Exception as e:
+            logging.error(f"Failed to save data to Firestore: {e}")
+            errors.update((doc_id, e) for doc_id in chunk)
+    return errors
+
+# Upload URL for one image of a two-phase upload, with the method and headers
+# the client must send the bytes with
+def create_upload_url(batch_uuid, image_name, content_type, origin=None):
+    blob = storage_client.bucket(BUCKET_NAME).blob(f"{batch_uuid}/input/{image_name}")
+    if UPLOAD_URL_TYPE == "resumable":
+        upload_url = blob.create_resumable_upload_session(content_type=content_type, origin=origin)
+    else:
+        upload_url = blob.generate_signed_url(version="v4", expiration=timedelta(minutes=UPLOAD_URL_MINUTES),
+                                              method="PUT", content_type=content_type)
+    return {"upload_url": upload_url, "method": "PUT", "headers": {"Content-Type": content_type}}
+
+# Posts the batch manifest to the interaction service, which publishes its images
+def dispatch_batch(manifest):
+    response = requests.post(f"{INTERACTION_POD_URL}/process_batch", json=manifest,
+                             timeout=DISPATCH_TIMEOUT_SECONDS)
+    response.raise_for_status()
+    return response.json()
+
+# Outbox document of a batch, due at once
+def outbox_entry(manifest):
+    return {"manifest": manifest, "attempts": 0, "next_attempt_at": time.time()}
+
+class DispatchOutbox:
+    # Posts uploaded batches to the interaction service in the background, so
+    # uploads are answered without waiting for it. A batch is a document of
+    # OUTBOX_TABLE_NAME, named by its batch_id, until it is posted, so it
+    # survives a crash of the pod that took the upload. Any pod may post any
+    # entry: it claims one by moving next_attempt_at a lease ahead against the
+    # version it read, so only one pod gets it, and an entry whose pod died
+    # is due again once the lease runs out.
+
+    def __init__(self):
+        self.wakeup = threading.Event()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def wake(self):
+        # Drains the outbox now, starting the worker if it is not running
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+        self.wakeup.set()
+
+    def run(self):
+        while True:
+            self.wakeup.clear()
+            try:
+                # A full read may have left more entries due
+                if self.drain() >= DISPATCH_BATCH_SIZE:
+                    continue
+            except Exception as e:
+                logging.error(f"Failed to drain the dispatch outbox: {e}")
+            self.wakeup.wait(DISPATCH_POLL_SECONDS)
+
+    def drain(self):
+        # Posts the entries that are due, returning how many were read
+        now = time.time()
+        entries = list(firestore_client.collection(OUTBOX_TABLE_NAME)
+                       .where("next_attempt_at", "<=", now).limit(DISPATCH_BATCH_SIZE).stream())
+        for entry in entries:
+            try:
+                entry.reference.update({"next_attempt_at": now + DISPATCH_LEASE_SECONDS},
+                                       option=firestore_client.write_option(last_update_time=entry.update_time))
+            except (FailedPrecondition, Conflict, NotFound):
+                # Taken or finished by another pod
+                continue
+            self.post(entry)
+        return len(entries)
+
+    def post(self, entry):
+        data = entry.to_dict()
+        try:
+            dispatch_batch(data["manifest"])
+        except Exception as e:
+            attempts = data.get("attempts", 0) + 1
+            # A rejected manifest is rejected again, so only other failures are retried
+            rejected = isinstance(e, requests.HTTPError) and e.response is not None and \
+                e.response.status_code < 500
+            if rejected or attempts >= DISPATCH_MAX_ATTEMPTS:
+                logging.error(f"Giving up dispatching batch {entry.id} after {attempts} attempts: {e}")
+                firestore_client.collection(BATCH_TABLE_NAME).document(entry.id).update({"job_status": DISPATCH_FAILED})
+                entry.reference.delete()
+            else:
+                delay = min(DISPATCH_RETRY_SECONDS * 2 ** (attempts - 1), DISPATCH_MAX_RETRY_SECONDS)
+                logging.warning(f"Dispatching batch {entry.id} failed, retrying in {delay}s: {e}")
+                entry.reference.update({"attempts": attempts, "next_attempt_at": time.time() + delay,
+                                        "last_error": str(e)})
+            return
+        entry.reference.delete()
+        logging.info(f"Dispatched batch {entry.id}")
+
+dispatch_outbox = DispatchOutbox()
+
+# Saves the metadata of every image that uploaded and dispatches them. uploads
+# holds (file name, image metadata, image name, upload result) per image, where
+# the upload result returns the image URL or raises if the upload failed.
+def save_and_dispatch_batch(batch_uuid, email, uploads):
+    image_urls = {}
+    errors = {}
+    metadata_documents = {}
+    for file_name, image_metadata, image_name, upload_result in uploads:
+        doc_id = f"{batch_uuid}_{image_name}"
+        try:
+            image_urls[doc_id] = upload_result()
+        except Exception as e:
+            errors[doc_id] = e
+            continue
+        metadata_documents[doc_id] = {
+            "batch_id": batch_uuid,
+            "filter_json": image_metadata.get('filters', []),
+            "image_name": image_name,
+            "is_processed": False,
+            # Optional fast/balanced/small output encoding, see the image processor
+            "encoder_profile": image_metadata.get('encoder_profile')
+        }
+    errors.update(save_batch_to_firestore(IMAGE_METADATA_TABLE_NAME, metadata_documents))
+
+    response_data = []
+    # Everything process_batch needs to dispatch the batch, so it does not
+    # have to read back the documents written here
+    manifest = {"batch_id": batch_uuid, "email": email, "images": []}
+    for file_name, image_metadata, image_name, upload_result in uploads:
+        doc_id = f"{batch_uuid}_{image_name}"
+        if errors[doc_id] is None:
+            manifest["images"].append({
+                "doc_id": doc_id,
+                "image_name": image_name,
+                "filters": metadata_documents[doc_id]["filter_json"],
+                "encoder_profile": metadata_documents[doc_id]["encoder_profile"]
+            })
+            response_data.append({
+                "image_name": image_name,
+                "batch_id": batch_uuid,
+                "status": "success",
+                "image_url": image_urls[doc_id]
+            })
+        else:
+            logging.error(f"Error processing {file_name}: {errors[doc_id]}")
+            response_data.append({
+                "image_name": image_name,
+                "batch_id": batch_uuid,
+                "status": "error"
+            })
+
+    # Answered once the batch is in the outbox; it is dispatched from there
+    try:
+        save_to_firestore(OUTBOX_TABLE_NAME, outbox_entry(manifest), doc_id=batch_uuid)
+    except Exception as e:
+        return jsonify({"error": f"Failed to queue batch {batch_uuid}: {e}"}), 500
+    dispatch_outbox.wake()
+    return jsonify({"batch_id": batch_uuid, "images": response_data}), 202
+
+class SignedUrlCache:
+    # Thread-safe cache of signed URLs by object name. A URL is reused until
+    # less than min_remaining seconds of it are left. Every URL lives the same
+    # time, so entries are kept in expiry order and evicted from the front.
+
+    def __init__(self, lifetime, min_remaining, max_size):
+        self.lifetime = lifetime
+        self.min_remaining = min_remaining
+        self.max_size = max_size
+        self.urls = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, blob):
+        now = time.time()
+        with self.lock:
+            entry = self.urls.get(blob.name)
+            if entry and entry[1] - now > self.min_remaining:
+                return entry[0]
+        url = blob.generate_signed_url(expiration=timedelta(seconds=self.lifetime))
+        with self.lock:
+            self.urls.pop(blob.name, None)
+            self.urls[blob.name] = (url, now + self.lifetime)
+            while self.urls and (len(self.urls) > self.max_size or
+                                 next(iter(self.urls.values()))[1] - now <= self.min_remaining):
+                self.urls.popitem(last=False)
+        return url
+
+    def clear(self):
+        with self.lock:
+            self.urls.clear()
+
+
+class ListingCache:
+    # Thread-safe LRU of the object names of completed batches, which no longer
+    # change, so their pages need no listing
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.listings = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, batch_id):
+        with self.lock:
+            names = self.listings.get(batch_id)
+            if names is not None:
+                self.listings.move_to_end(batch_id)
+            return names
+
+    def put(self, batch_id, names):
+        with self.lock:
+            self.listings[batch_id] = names
+            self.listings.move_to_end(batch_id)
+            while len(self.listings) > self.max_size:
+                self.listings.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.listings.clear()
+
+
+signed_url_cache = SignedUrlCache(SIGNED_URL_MINUTES * 60, SIGNED_URL_MIN_REMAINING_MINUTES * 60,
+                                  SIGNED_URL_CACHE_SIZE)
+listing_cache = ListingCache(LISTING_CACHE_SIZE)
+
+def batch_completed(batch_id):
+    batch = firestore_client.collection(BATCH_TABLE_NAME).document(batch_id).get()
+    return batch.exists and (batch.to_dict() or {}).get("job_status") == "Completed"
+
+# Names of every object of a batch, from one listing or, once the batch is
+# completed, from the listing cache
+def list_batch_objects(bucket, batch_id, completed=None):
+    names = listing_cache.get(batch_id)
+    if names is not None:
+        return names
+    if completed is None:
+        completed = batch_completed(batch_id)
+    names = [blob.name for blob in bucket.list_blobs(prefix=f"{batch_id}/") if not blob.name.endswith("/")]
+    if completed:
+        listing_cache.put(batch_id, names)
+    return names
+
+# The object names of a completed batch, listed once and then cached, or None
+# while the batch is in progress
+def completed_batch_objects(bucket, batch_id):
+    names = listing_cache.get(batch_id)
+    if names is None and batch_completed(batch_id):
+        names = list_batch_objects(bucket, batch_id, completed=True)
+    return names
+
+# Image pairs, by file name, of a listing of the whole batch: those after
+# cursor, at most page_size of them, and the cursor of the next page (None on
+# the last). Only the pairs returned are signed.
+def image_pairs_from_listing(bucket, batch_id, names, with_derivatives, cursor=None, page_size=None):
+    input_blobs = {}
+    output_blobs = {}
+    # Derivatives written by the image processor are stored at
+    # {batch_id}/derivatives/{name}/{input|output}/{file_name}
+    derivative_blobs = {}
+    for name in names:
+        parts = name[len(batch_id) + 1:].split("/")
+        if len(parts) == 2 and parts[0] == "input":
+            input_blobs[parts[1]] = name
+        elif len(parts) == 2 and parts[0] == "output":
+            output_blobs[parts[1]] = name
+        elif len(parts) == 4 and parts[0] == "derivatives" and parts[3]:
+            _, derivative, kind, file_name = parts
+            url_key = "before_url" if kind == "input" else "after_url"
+            derivative_blobs.setdefault(file_name, {}).setdefault(derivative, {})[url_key] = name
+
+    def signed_url(name):
+        return signed_url_cache.get(bucket.blob(name))
+
+    # Pair images by file name
+    file_names = [file_name for file_name in input_blobs
+                  if file_name in output_blobs and (not cursor or file_name > cursor)]
+    next_cursor = None
+    if page_size and len(file_names) > page_size:
+        file_names = file_names[:page_size]
+        next_cursor = file_names[-1]
+    image_pairs = [{
+        "file_name": file_name,
+        "before_url": signed_url(input_blobs[file_name]),
+        "after_url": signed_url(output_blobs[file_name])
+    } for file_name in file_names]
+
+    if with_derivatives:
+        for image_pair in image_pairs:
+            image_pair["derivatives"] = {
+                derivative: {url_key: signed_url(name) for url_key, name in names.items()}
+                for derivative, names in derivative_blobs.get(image_pair["file_name"], {}).items()
+                if "before_url" in names and "after_url" in names
+            }
+    return image_pairs, next_cursor
+
+# Cached URLs keep the body, and so its ETag, the same between polls until
+# they are re-signed
+def conditional_response(response):
+    response.set_etag(hashlib.sha256(response.get_data()).hexdigest())
+    response.headers["Cache-Control"] = "no-cache"
+    return response.make_conditional(request)
+
+# Page size from a request's limit parameter, or None when it has none
+def parse_page_size(limit):
+    if limit is None:
+        return None
+    page_size = int(limit)
+    if page_size < 1 or page_size > MAX_PAGE_SIZE:
+        raise ValueError(f"limit must be between 1 and {MAX_PAGE_SIZE}")
+    return page_size
+
+# Object names of the derivatives of the given images, listed by derivative
+# and kind starting at the first of them: {file_name: {derivative: {url_key: name}}}
+def list_page_derivatives(bucket, batch_id, file_names):
+    derivatives_folder = f"{batch_id}/derivatives/"
+    folders = bucket.list_blobs(prefix=derivatives_folder, delimiter="/")
+    # Prefixes are filled in as the listing is read
+    for _ in folders:
+        pass
+    wanted = set(file_names)
+    derivative_blobs = {}
+    for folder in sorted(folders.prefixes):
+        derivative = folder[len(derivatives_folder):-1]
+        for kind, url_key in [("input", "before_url"), ("output", "after_url")]:
+            prefix = f"{folder}{kind}/"
+            for blob in bucket.list_blobs(prefix=prefix, start_offset=prefix + file_names[0],
+                                          max_results=len(file_names)):
+                file_name = blob.name[len(prefix):]
+                if file_name in wanted:
+                    derivative_blobs.setdefault(file_name, {}).setdefault(derivative, {})[url_key] = blob.name
+    return derivative_blobs
+
+# One page of image pairs after the file name cursor, and the cursor of the
+# next page (None on the last). Pages follow the output listing, as an image
+# only has a pair once it is processed, and the input of every output is at
+# the same file name.
+def list_image_pair_page(bucket, batch_id, page_size, cursor, with_derivatives):
+    output_folder = f"{batch_id}/output/"
+    # The listing starts at the cursor's own output, and one more than a page
+    # tells whether another page follows
+    blobs = bucket.list_blobs(prefix=output_folder, start_offset=output_folder + cursor if cursor else None,
+                              max_results=page_size + (2 if cursor else 1))
+    file_names = [blob.name[len(output_folder):] for blob in blobs]
+    file_names = [file_name for file_name in file_names
+                  if file_name and "/" not in file_name and (not cursor or file_name > cursor)]
+    next_cursor = file_names[page_size - 1] if len(file_names) > page_size else None
+    file_names = file_names[:page_size]
+
+    def signed_url(name):
+        return signed_url_cache.get(bucket.blob(name))
+
+    image_pairs = [{
+        "file_name": file_name,
+        "before_url": signed_url(f"{batch_id}/input/{file_name}"),
+        "after_url": signed_url(f"{output_folder}{file_name}")
+    } for file_name in file_names]
+    if with_derivatives and file_names:
+        derivative_blobs = list_page_derivatives(bucket, batch_id, file_names)
+        for image_pair in image_pairs:
+            image_pair["derivatives"] = {
+                derivative: {url_key: signed_url(name) for url_key, name in names.items()}
+                for derivative, names in derivative_blobs.get(image_pair["file_name"], {}).items()
+                if "before_url" in names and "after_url" in names
+            }
+    return image_pairs, next_cursor
+
+# NDJSON body of one JSON object per line, from the first page already listed
+# and the pages after it
+def ndjson_pages(first_items, next_cursor, list_page):
+    for item in first_items:
+        yield json.dumps(item) + "\n"
+    while next_cursor:
+        items, next_cursor = list_page(next_cursor)
+        for item in items:
+            yield json.dumps(item) + "\n"
+
+# Every document of the query after cursor, in document order, read a page
+# at a time
+def stream_query_pages(query, page_size, cursor):
+    while True:
+        page_query = query.order_by(DOCUMENT_ID).limit(page_size)
+        if cursor:
+            page_query = page_query.start_after({DOCUMENT_ID: cursor})
+        docs = list(page_query.stream())
+        yield from docs
+        if len(docs) < page_size:
+            return
+        cursor = docs[-1].id
+
 @app.route('/get-processed-images', methods=['GET'])
 def get_output_urls():
     batch_id = request.args.get('batch_id')
     if not batch_id:
         return jsonify({"error": "batch_id is required"}), 400
-
+    with_derivatives = request.args.get('derivatives', 'false').lower() == 'true'
+    try:
+        page_size = parse_page_size(request.args.get('limit'))
+    except ValueError as e:
+        return jsonify({"error": f"Invalid limit: {e}"}), 400
+
+    # limit pages through the pairs with cursor, the file name of the last
+    # pair of the previous page; format=ndjson sends every pair after cursor
+    # on a line of its own. Without either the whole batch comes in one
+    # document. Completed batches come from the cached listing either way.
+    cursor = request.args.get('cursor')
+    ndjson = request.args.get('format') == 'ndjson'
     try:
-        input_folder = f"{batch_id}/input/"
-        output_folder = f"{batch_id}/output/"
-
         bucket = storage_client.bucket(BUCKET_NAME)
-        input_urls = {}
-        output_urls = {}
-
-        # List blobs in input folder
-        for blob in bucket.list_blobs(prefix=input_folder):
-            if blob.name.endswith("/"):
-                continue
-            file_name = os.path.basename(blob.name)
-            input_urls[file_name] = blob.generate_signed_url(expiration=timedelta(hours=1))
-
-        # List blobs in output folder
-        for blob in bucket.list_blobs(prefix=output_folder):
-            if blob.name.endswith("/"):
-                continue
-            file_name = os.path.basename(blob.name)
-            output_urls[file_name] = blob.generate_signed_url(expiration=timedelta(hours=1))
-
-        # Pair images by file name
-        image_pairs = [{
-            "file_name": file_name,
-            "before_url": input_url,
-            "after_url": output_urls[file_name]
-        } for file_name, input_url in input_urls.items() if file_name in output_urls]
-
-        if not image_pairs:
-            return jsonify({"error": "No matching image pairs found for the given batch_id"}), 404
-
-        return jsonify({"batch_id": batch_id, "image_pairs": image_pairs}), 200
-
+        names = completed_batch_objects(bucket, batch_id) if page_size or ndjson else None
+        if names is None and (page_size or ndjson):
+            # In progress: list a page at a time
+            image_pairs, next_cursor = list_image_pair_page(bucket, batch_id, page_size or STREAM_PAGE_SIZE,
+                                                            cursor, with_derivatives)
+        else:
+            if names is None:
+                names = list_batch_objects(bucket, batch_id)
+            image_pairs, next_cursor = image_pairs_from_listing(bucket, batch_id, names, with_derivatives, cursor,
+                                                                None if ndjson else page_size)
     except Exception as e:
         logging.error(f"Failed to retrieve output URLs for batch_id {batch_id}: {e}")
         return jsonify({"error": f"Failed to retrieve output URLs: {e}"}), 500
 
+    if not image_pairs and not cursor:
+        return jsonify({"error": "No matching image pairs found for the given batch_id"}), 404
+    if ndjson and names is not None:
+        # Everything is listed already, so the body can be compared between polls
+        return conditional_response(app.response_class(
+            "".join(json.dumps(image_pair) + "\n" for image_pair in image_pairs), mimetype="application/x-ndjson"))
+    if ndjson:
+        list_page = functools.partial(list_image_pair_page, bucket, batch_id, page_size or STREAM_PAGE_SIZE,
+                                      with_derivatives=with_derivatives)
+        return app.response_class(ndjson_pages(image_pairs, next_cursor, list_page),
+                                  mimetype="application/x-ndjson")
+    if page_size:
+        return jsonify({"batch_id": batch_id, "image_pairs": image_pairs, "next_cursor": next_cursor}), 200
+    return conditional_response(jsonify({"batch_id": batch_id, "image_pairs": image_pairs}))
+
 @app.route('/get-images-by-status', methods=['GET'])
 def get_images_by_status():
     batch_id = request.args.get('batch_id')
@@ -103,16 +614,43 @@ def get_images_by_status():
         return jsonify({"error": "batch_id and IsProcessed parameters are required"}), 400
 
     is_processed = is_processed.lower() == 'true'
+    try:
+        page_size = parse_page_size(request.args.get('limit'))
+    except ValueError as e:
+        return jsonify({"error": f"Invalid limit: {e}"}), 400
+    cursor = request.args.get('cursor')
 
     try:
         image_metadata_ref = firestore_client.collection(IMAGE_METADATA_TABLE_NAME)
         query = image_metadata_ref.where("batch_id", "==", batch_id).where("is_processed", "==", is_processed)
-        images = [doc.to_dict() for doc in query.stream()]
 
-        if not images:
+        # limit pages through the images in document order with cursor, the
+        # id of the last document of the previous page; format=ndjson sends
+        # every image after cursor on a line of its own, reading limit images
+        # at a time, like /get-processed-images
+        if request.args.get('format') == 'ndjson':
+            docs = stream_query_pages(query, page_size or STREAM_PAGE_SIZE, cursor)
+            first = next(docs, None)
+            if first is None:
+                return jsonify({"error": "No images found matching the criteria"}), 404
+            images = (doc.to_dict() for doc in itertools.chain([first], docs))
+            return app.response_class((json.dumps(image) + "\n" for image in images),
+                                      mimetype="application/x-ndjson")
+        if page_size or cursor:
+            query = query.order_by(DOCUMENT_ID).limit(page_size or MAX_PAGE_SIZE)
+            if cursor:
+                query = query.start_after({DOCUMENT_ID: cursor})
+
+        docs = list(query.stream())
+        images = [doc.to_dict() for doc in docs]
+
+        if not images and not cursor:
             return jsonify({"error": "No images found matching the criteria"}), 404
 
-        return jsonify({"batch_id": batch_id, "IsProcessed": is_processed, "images": images}), 200
+        response_data = {"batch_id": batch_id, "IsProcessed": is_processed, "images": images}
+        if page_size or cursor:
+            response_data["next_cursor"] = docs[-1].id if len(docs) == (page_size or MAX_PAGE_SIZE) else None
+        return jsonify(response_data), 200
 
     except Exception as e:
         logging.error(f"Failed to retrieve images with batch_id {batch_id} and IsProcessed {is_processed}: {e}")
@@ -132,6 +670,12 @@ def upload_images():
     if len(files) != len(images_metadata):
         logging.error("Number of files does not match number of metadata entries")
         return jsonify({"error": "Mismatched files and metadata entries"}), 400
+    # An image's document and input object are named after it, so a repeated
+    # name would be processed twice and the batch never counted down to done
+    image_names = [image_metadata.get('image_name', image_file.filename)
+                   for image_file, image_metadata in zip(files, images_metadata)]
+    if len(set(image_names)) != len(image_names):
+        return jsonify({"error": "Image names must be unique within a batch"}), 400
 
     batch_uuid = str(uuid.uuid4())
     logging.info(f"Generated Batch batch_id: {batch_uuid} for the image upload")
@@ -144,42 +688,225 @@ def upload_images():
     }
     save_to_firestore(BATCH_TABLE_NAME, firestore_data_batch_uploads, doc_id=batch_uuid)
 
-    response_data = []
-    for image_file, image_metadata in zip(files, images_metadata):
-        try:
-            image_name = image_metadata.get('image_name', image_file.filename)
-            filters = image_metadata.get('filters', [])
+    # Uploads run in parallel, then the metadata of the uploaded images is
+    # written in as few Firestore commits as possible
+    uploads = []
+    for image_file, image_metadata, image_name in zip(files, images_metadata, image_names):
+        future = upload_executor.submit(upload_to_gcs, image_file, batch_uuid, image_name)
+        uploads.append((image_file.filename, image_metadata, image_name, future.result))
+
+    return save_and_dispatch_batch(batch_uuid, email, uploads)
+
+# Same form and response as /upload-images, but read as it arrives: each image
+# is piped into a chunked upload while the rest of the request is still being
+# received, so memory does not grow with the size of the batch. Images are
+# named by their metadata when the metadata part comes before the files.
+# Otherwise they are streamed under a provisional name unique to their
+# position, as file names may repeat, and renamed once the metadata arrives.
+@app.route('/upload-images/stream', methods=['POST'])
+def upload_images_stream():
+    content_type, options = parse_options_header(request.headers.get("Content-Type", ""))
+    if content_type != "multipart/form-data" or not options.get("boundary"):
+        return jsonify({"error": "Expected a multipart/form-data request"}), 400
 
-            image_url = upload_to_gcs(image_file, batch_uuid, image_name)
-            doc_id = f"{batch_uuid}_{image_name}"
+    batch_uuid = str(uuid.uuid4())
+    logging.info(f"Generated Batch batch_id: {batch_uuid} for the streaming image upload")
+
+    decoder = MultipartDecoder(options["boundary"].encode(), max_form_memory_size=MAX_METADATA_BYTES)
+    metadata = None
+    metadata_data = None
+    chunks = None
+    # (file name, image name, upload result) per image
+    uploads = []
+    executor = ThreadPoolExecutor(max_workers=STREAMING_UPLOADS_PER_REQUEST)
+    try:
+        complete = False
+        while not complete:
+            data = request.stream.read(STREAMING_READ_SIZE)
+            decoder.receive_data(data or None)
+            event = decoder.next_event()
+            while not isinstance(event, NeedData):
+                if isinstance(event, Field):
+                    metadata_data = bytearray() if event.name == "metadata" else None
+                elif isinstance(event, File):
+                    chunks = None
+                    if event.name == "files":
+                        index = len(uploads)
+                        images_metadata = (metadata or {}).get("imagesMetadata", [])
+                        image_name = f".part-{index}"
+                        # A repeated name keeps its provisional one, the batch is rejected below
+                        if index < len(images_metadata) and images_metadata[index].get(
+                                "image_name", event.filename) not in [upload[1] for upload in uploads]:
+                            image_name = images_metadata[index].get("image_name", event.filename)
+                        chunks = queue.Queue(maxsize=STREAMING_QUEUE_SIZE)
+                        future = executor.submit(stream_to_gcs, chunks, batch_uuid, image_name,
+                                                 event.headers.get("Content-Type"))
+                        uploads.append((event.filename, image_name, future.result))
+                elif isinstance(event, Data):
+                    if chunks is not None:
+                        if event.data:
+                            chunks.put(event.data)
+                        if not event.more_data:
+                            chunks.put(None)
+                            chunks = None
+                    elif metadata_data is not None:
+                        metadata_data += event.data
+                        if len(metadata_data) > MAX_METADATA_BYTES:
+                            raise ValueError("metadata is too large")
+                        if not event.more_data:
+                            metadata = json.loads(metadata_data)
+                            metadata_data = None
+                elif isinstance(event, Epilogue):
+                    complete = True
+                    break
+                event = decoder.next_event()
+            if not data and not complete:
+                raise ValueError("The request ended before the multipart body was complete")
+    except Exception as e:
+        if chunks is not None:
+            chunks.put(STREAM_ABORTED)
+        logging.error(f"Failed to read streaming upload for batch {batch_uuid}: {e}")
+        delete_streamed_images(batch_uuid, uploads)
+        return jsonify({"error": f"Failed to read upload: {e}"}), 400
+    finally:
+        # Uploads already started run to the end
+        executor.shutdown(wait=False)
+
+    if not uploads or metadata is None:
+        logging.error("Files and metadata are required")
+        delete_streamed_images(batch_uuid, uploads)
+        return jsonify({"error": "Files and metadata are required"}), 400
+    email = metadata.get("email")
+    images_metadata = metadata.get("imagesMetadata", [])
+    if len(uploads) != len(images_metadata):
+        logging.error("Number of files does not match number of metadata entries")
+        delete_streamed_images(batch_uuid, uploads)
+        return jsonify({"error": "Mismatched files and metadata entries"}), 400
+    image_names = [image_metadata.get("image_name", file_name)
+                   for (file_name, _, _), image_metadata in zip(uploads, images_metadata)]
+    if len(set(image_names)) != len(image_names):
+        delete_streamed_images(batch_uuid, uploads)
+        return jsonify({"error": "Image names must be unique within a batch"}), 400
 
-            firestore_data_image_metadata = {
-                "batch_id": batch_uuid,
-                "filter_json": filters,
-                "image_name": image_name,
-                "is_processed": False
-            }
-            save_to_firestore(IMAGE_METADATA_TABLE_NAME, firestore_data_image_metadata, doc_id=doc_id)
+    firestore_data_batch_uploads = {
+        "email": email,
+        "email_sent": False,
+        "image_count": len(uploads),
+        "job_status": "Pending"
+    }
+    save_to_firestore(BATCH_TABLE_NAME, firestore_data_batch_uploads, doc_id=batch_uuid)
 
-            response_data.append({
-                "image_name": image_name,
-                "batch_id": batch_uuid,
-                "status": "success",
-                "image_url": image_url
-            })
+    named_uploads = []
+    for (file_name, streamed_name, upload_result), image_metadata, image_name in zip(uploads, images_metadata,
+                                                                                    image_names):
+        if image_name != streamed_name:
+            upload_result = functools.partial(rename_streamed_image, upload_result, batch_uuid, streamed_name,
+                                              image_name)
+        named_uploads.append((file_name, image_metadata, image_name, upload_result))
+    return save_and_dispatch_batch(batch_uuid, email, named_uploads)
+
+# Two-phase upload: image bytes go straight to Cloud Storage instead of through
+# this pod. POST /batches takes the metadata /upload-images takes, as JSON, and
+# returns an upload URL per image; POST /batches/<batch_id>/commit once they
+# are uploaded starts processing.
+@app.route('/batches', methods=['POST'])
+def create_batch():
+    metadata = request.get_json(silent=True) or {}
+    images_metadata = metadata.get("imagesMetadata")
+    if not images_metadata or not isinstance(images_metadata, list) or \
+            not all(isinstance(image, dict) and image.get("image_name") for image in images_metadata):
+        return jsonify({"error": "imagesMetadata with an image_name per image is required"}), 400
+    image_names = [image["image_name"] for image in images_metadata]
+    if len(set(image_names)) != len(image_names):
+        return jsonify({"error": "Image names must be unique within a batch"}), 400
 
-        except Exception as e:
-            logging.error(f"Error processing {image_file.filename}: {e}")
-            response_data.append({
-                "image_name": image_name,
-                "batch_id": batch_uuid,
-                "status": "error"
-            })
+    batch_uuid = str(uuid.uuid4())
+    logging.info(f"Generated Batch batch_id: {batch_uuid} for a direct upload of {len(image_names)} images")
 
-    response = requests.get(f"{INTERACTION_POD_URL}/process_batch?batch_id={batch_uuid}")
-    print(f"response: {response}")
-    return response.json()
-    # return jsonify(response_data), 200
+    # The batch document holds the images until the commit writes their metadata
+    firestore_data_batch_uploads = {
+        "email": metadata.get("email"),
+        "email_sent": False,
+        "image_count": len(images_metadata),
+        "job_status": AWAITING_UPLOAD,
+        "images": [{
+            "image_name": image["image_name"],
+            "filters": image.get("filters", []),
+            "encoder_profile": image.get("encoder_profile")
+        } for image in images_metadata]
+    }
+    try:
+        save_to_firestore(BATCH_TABLE_NAME, firestore_data_batch_uploads, doc_id=batch_uuid)
+        origin = request.headers.get("Origin")
+        uploads = [dict(image_name=image["image_name"],
+                        **create_upload_url(batch_uuid, image["image_name"],
+                                            image.get("content_type", "application/octet-stream"), origin))
+                   for image in images_metadata]
+    except Exception as e:
+        logging.error(f"Failed to create batch {batch_uuid}: {e}")
+        return jsonify({"error": f"Failed to create batch: {e}"}), 500
+
+    return jsonify({"batch_id": batch_uuid, "uploads": uploads}), 201
+
+@app.route('/batches/<batch_id>/commit', methods=['POST'])
+def commit_batch(batch_id):
+    batch_ref = firestore_client.collection(BATCH_TABLE_NAME).document(batch_id)
+    try:
+        batch = batch_ref.get()
+        if not batch.exists:
+            return jsonify({"error": "No such batch"}), 404
+        batch_data = batch.to_dict()
+        if batch_data.get("job_status") != AWAITING_UPLOAD:
+            return jsonify({"error": "Batch is already committed"}), 409
+
+        # One listing checks every image, however large the batch
+        input_folder = f"{batch_id}/input/"
+        uploaded = {blob.name[len(input_folder):] for blob in
+                    storage_client.bucket(BUCKET_NAME).list_blobs(prefix=input_folder)}
+        missing = [image["image_name"] for image in batch_data["images"] if image["image_name"] not in uploaded]
+        if missing:
+            return jsonify({"error": "Images have not been uploaded", "missing": missing}), 409
+
+        metadata_documents = {
+            f"{batch_id}_{image['image_name']}": {
+                "batch_id": batch_id,
+                "filter_json": image["filters"],
+                "image_name": image["image_name"],
+                "is_processed": False,
+                "encoder_profile": image["encoder_profile"]
+            } for image in batch_data["images"]
+        }
+        # Written before the batch is claimed so a failed commit can be retried;
+        # concurrent commits write the same documents
+        errors = save_batch_to_firestore(IMAGE_METADATA_TABLE_NAME, metadata_documents)
+        failed = [doc_id for doc_id, error in errors.items() if error]
+        if failed:
+            raise RuntimeError(f"Could not save the metadata of {len(failed)} images")
+
+        manifest = {"batch_id": batch_id, "email": batch_data.get("email"), "images": [{
+            "doc_id": doc_id,
+            "image_name": document["image_name"],
+            "filters": document["filter_json"],
+            "encoder_profile": document["encoder_profile"]
+        } for doc_id, document in metadata_documents.items()]}
+        # The batch is claimed and queued for dispatch in one write. Only the
+        # first of concurrent commits gets past the precondition.
+        write_batch = firestore_client.batch()
+        write_batch.update(batch_ref, {"job_status": "Pending"},
+                           option=firestore_client.write_option(last_update_time=batch.update_time))
+        write_batch.set(firestore_client.collection(OUTBOX_TABLE_NAME).document(batch_id), outbox_entry(manifest))
+        try:
+            write_batch.commit()
+        except (FailedPrecondition, Conflict):
+            return jsonify({"error": "Batch is already committed"}), 409
+    except Exception as e:
+        logging.error(f"Failed to commit batch {batch_id}: {e}")
+        return jsonify({"error": f"Failed to commit batch: {e}"}), 500
+
+    dispatch_outbox.wake()
+    return jsonify({"batch_id": batch_id, "image_count": len(manifest["images"])}), 202
 
 if __name__ == '__main__':
+    # Picks up entries left by pods that stopped before posting them
+    dispatch_outbox.wake()
     app.run(host='0.0.0.0', port=image_port)
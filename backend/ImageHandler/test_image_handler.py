@@ -3,8 +3,26 @@ from unittest.mock import Mock, patch, MagicMock
 from flask import json
 import io
 import uuid
+import threading
 from werkzeug.datastructures import FileStorage, MultiDict
-from image_handler import app, save_to_firestore, upload_to_gcs
+from werkzeug.test import encode_multipart
+from google.api_core.exceptions import FailedPrecondition
+import image_handler
+from image_handler import app, save_to_firestore, upload_to_gcs, SignedUrlCache, ListingCache
+
+
+@pytest.fixture(autouse=True)
+def clear_caches():
+    image_handler.signed_url_cache.clear()
+    image_handler.listing_cache.clear()
+    yield
+
+
+@pytest.fixture(autouse=True)
+def outbox_wakeups():
+    # The outbox is drained by calling drain, not by a worker thread
+    with patch.object(image_handler.dispatch_outbox, 'wake') as wake:
+        yield wake
 
 
 @pytest.fixture
@@ -53,14 +71,14 @@ def mock_firestore():
 
 @pytest.fixture
 def mock_requests():
-    with patch('image_handler.requests.get') as mock_requests:
+    with patch('image_handler.requests.post') as mock_requests:
         mock_response = Mock()
         mock_response.json.return_value = {"status": "processing"}
         mock_requests.return_value = mock_response
         yield mock_requests
 
 
-def test_upload_images_success(client, mock_storage, mock_firestore, mock_requests):
+def test_upload_images_success(client, mock_storage, mock_firestore, mock_requests, outbox_wakeups):
     # Create test file
     test_file = (io.BytesIO(b"test image content"), "test1.jpg")
 
@@ -87,14 +105,77 @@ def test_upload_images_success(client, mock_storage, mock_firestore, mock_reques
         content_type='multipart/form-data'
     )
 
-    # Assert response
-    assert response.status_code == 200
+    # Assert response: accepted before the batch is dispatched
+    assert response.status_code == 202
+    assert json.loads(response.data)['batch_id']
     assert mock_storage.bucket.called
     assert mock_firestore.collection.called
-    assert mock_requests.called
+    mock_requests.assert_not_called()
+    outbox_wakeups.assert_called_once()
+    # The batch is dispatched from a manifest of the uploaded images
+    manifest = outbox_manifest(mock_firestore)
+    assert manifest['email'] == 'test@example.com'
+    assert manifest['images'] == [{
+        'doc_id': f"{manifest['batch_id']}_test1.jpg",
+        'image_name': 'test1.jpg',
+        'filters': ['blur', 'sharpen'],
+        'encoder_profile': None
+    }]
+
+
+def outbox_manifest(mock_firestore):
+    # The manifest put in the dispatch outbox, written alone or with the commit
+    sets = mock_firestore.collection.return_value.document.return_value.set.call_args_list + \
+        mock_firestore.batch.return_value.set.call_args_list
+    entries = [call.args[-1] for call in sets if 'manifest' in call.args[-1]]
+    assert len(entries) == 1
+    return entries[0]['manifest']
+
+
+def upload_form(image_names):
+    metadata = {
+        "email": "test@example.com",
+        "imagesMetadata": [{"image_name": image_name, "filters": []} for image_name in image_names]
+    }
+    return MultiDict([('metadata', json.dumps(metadata))] +
+                     [('files', (io.BytesIO(b"test image content"), image_name)) for image_name in image_names])
+
+
+def test_upload_images_uploads_in_parallel(client, mock_storage, mock_firestore, mock_requests):
+    # Each upload waits for the other, so this only finishes if they overlap
+    barrier = threading.Barrier(2, timeout=5)
+    mock_blob = mock_storage.bucket.return_value.blob.return_value
+    mock_blob.upload_from_file.side_effect = lambda image_file: barrier.wait()
+
+    response = client.post('/upload-images', data=upload_form(['test1.jpg', 'test2.jpg']),
+                           content_type='multipart/form-data')
 
+    assert response.status_code == 202
+    assert not barrier.broken
+    assert len(outbox_manifest(mock_firestore)['images']) == 2
 
-def test_get_processed_images_success(client, mock_storage):
+
+def test_upload_images_reports_failed_uploads(client, mock_storage, mock_firestore, mock_requests):
+    def upload(image_file):
+        if image_file.filename == 'test2.jpg':
+            raise Exception("Upload failed")
+
+    mock_blob = mock_storage.bucket.return_value.blob.return_value
+    mock_blob.upload_from_file.side_effect = upload
+
+    response = client.post('/upload-images', data=upload_form(['test1.jpg', 'test2.jpg', 'test3.jpg']),
+                           content_type='multipart/form-data')
+
+    assert response.status_code == 202
+    # The metadata of the uploaded images goes to Firestore in one commit
+    write_batch = mock_firestore.batch.return_value
+    assert write_batch.set.call_count == 2
+    write_batch.commit.assert_called_once()
+    manifest = outbox_manifest(mock_firestore)
+    assert [image['image_name'] for image in manifest['images']] == ['test1.jpg', 'test3.jpg']
+
+
+def test_get_processed_images_success(client, mock_storage, mock_firestore):
     # Mock list_blobs to return specific results
     mock_bucket = mock_storage.bucket.return_value
 
@@ -105,10 +186,9 @@ def test_get_processed_images_success(client, mock_storage):
         def generate_signed_url(self, expiration):
             return f"https://signed-url.com/{self.name}"
 
-    mock_bucket.list_blobs.side_effect = [
-        [MockBlob("test-batch/input/test1.jpg")],
-        [MockBlob("test-batch/output/test1.jpg")]
-    ]
+    mock_bucket.list_blobs.return_value = [MockBlob("test-batch/input/test1.jpg"),
+                                           MockBlob("test-batch/output/test1.jpg")]
+    mock_bucket.blob.side_effect = MockBlob
 
     response = client.get('/get-processed-images?batch_id=test-batch')
 
@@ -177,4 +257,557 @@ def test_upload_to_gcs_error(mock_storage):
     with pytest.raises(Exception) as exc_info:
         upload_to_gcs(test_file, "test-batch", "test.jpg")
 
-    assert "Upload failed" in str(exc_info.value)
\ No newline at end of file
+    assert "Upload failed" in str(exc_info.value)
+
+def test_get_processed_images_with_derivatives(client, mock_storage, mock_firestore):
+    mock_bucket = mock_storage.bucket.return_value
+
+    class MockBlob:
+        def __init__(self, name):
+            self.name = name
+
+        def generate_signed_url(self, expiration):
+            return f"https://signed-url.com/{self.name}"
+
+    mock_bucket.list_blobs.return_value = [
+        MockBlob("test-batch/input/test1.jpg"),
+        MockBlob("test-batch/output/test1.jpg"),
+        MockBlob("test-batch/derivatives/thumbnail/input/test1.jpg"),
+        MockBlob("test-batch/derivatives/thumbnail/output/test1.jpg"),
+        MockBlob("test-batch/derivatives/preview/input/test1.jpg")
+    ]
+    mock_bucket.blob.side_effect = MockBlob
+
+    response = client.get('/get-processed-images?batch_id=test-batch&derivatives=true')
+
+    assert response.status_code == 200
+    data = json.loads(response.data)
+    assert data['image_pairs'][0]['derivatives'] == {
+        "thumbnail": {
+            "before_url": "https://signed-url.com/test-batch/derivatives/thumbnail/input/test1.jpg",
+            "after_url": "https://signed-url.com/test-batch/derivatives/thumbnail/output/test1.jpg"
+        }
+    }
+
+
+
+class SignedBlob:
+    # A blob whose signed URLs are numbered, so re-signing shows
+    signatures = 0
+
+    def __init__(self, name):
+        self.name = name
+
+    def generate_signed_url(self, expiration):
+        SignedBlob.signatures += 1
+        return f"https://signed-url.com/{self.name}?signature={SignedBlob.signatures}"
+
+
+def test_signed_url_cache_reuses_until_near_expiry():
+    cache = SignedUrlCache(lifetime=3600, min_remaining=900, max_size=10)
+    blob = SignedBlob("test-batch/input/test1.jpg")
+
+    with patch('image_handler.time.time', return_value=1000):
+        url = cache.get(blob)
+    with patch('image_handler.time.time', return_value=1000 + 2600):
+        assert cache.get(blob) == url
+    # Less than min_remaining left: signed again
+    with patch('image_handler.time.time', return_value=1000 + 2800):
+        assert cache.get(blob) != url
+
+
+def test_signed_url_cache_evicts_oldest_and_expired():
+    cache = SignedUrlCache(lifetime=3600, min_remaining=900, max_size=2)
+    with patch('image_handler.time.time', return_value=1000):
+        for name in ["a", "b", "c"]:
+            cache.get(SignedBlob(name))
+    assert list(cache.urls) == ["b", "c"]
+    # Adding a URL after b and c are near expiry drops both
+    with patch('image_handler.time.time', return_value=1000 + 2800):
+        cache.get(SignedBlob("d"))
+    assert list(cache.urls) == ["d"]
+
+
+def test_listing_cache_evicts_least_recently_used():
+    cache = ListingCache(max_size=2)
+    cache.put("batch-1", ["batch-1/input/a.jpg"])
+    cache.put("batch-2", ["batch-2/input/a.jpg"])
+    cache.get("batch-1")
+    cache.put("batch-3", ["batch-3/input/a.jpg"])
+    assert cache.get("batch-2") is None
+    assert cache.get("batch-1") == ["batch-1/input/a.jpg"]
+
+
+def set_up_listing(mock_storage, mock_firestore, job_status):
+    mock_bucket = mock_storage.bucket.return_value
+    mock_bucket.list_blobs.return_value = [SignedBlob("test-batch/input/test1.jpg"),
+                                           SignedBlob("test-batch/output/test1.jpg")]
+    mock_bucket.blob.side_effect = SignedBlob
+    batch = Mock(exists=True)
+    batch.to_dict.return_value = {"job_status": job_status}
+    mock_firestore.collection.return_value.document.return_value.get.return_value = batch
+    return mock_bucket
+
+
+def test_get_processed_images_reuses_completed_listing(client, mock_storage, mock_firestore):
+    mock_bucket = set_up_listing(mock_storage, mock_firestore, "Completed")
+
+    first = client.get('/get-processed-images?batch_id=test-batch')
+    second = client.get('/get-processed-images?batch_id=test-batch')
+
+    assert first.status_code == second.status_code == 200
+    # One listing of the whole batch, then none: it is completed
+    mock_bucket.list_blobs.assert_called_once_with(prefix="test-batch/")
+    assert mock_firestore.collection.return_value.document.return_value.get.call_count == 1
+    # The cached URLs keep the response the same
+    assert first.data == second.data
+
+
+def test_get_processed_images_lists_batches_in_progress(client, mock_storage, mock_firestore):
+    mock_bucket = set_up_listing(mock_storage, mock_firestore, "In Progress")
+
+    client.get('/get-processed-images?batch_id=test-batch')
+    client.get('/get-processed-images?batch_id=test-batch')
+
+    assert mock_bucket.list_blobs.call_count == 2
+
+
+def test_get_processed_images_not_modified(client, mock_storage, mock_firestore):
+    set_up_listing(mock_storage, mock_firestore, "Completed")
+
+    first = client.get('/get-processed-images?batch_id=test-batch')
+    etag = first.headers['ETag']
+    second = client.get('/get-processed-images?batch_id=test-batch', headers={'If-None-Match': etag})
+
+    assert second.status_code == 304
+    assert second.data == b""
+
+
+class BlobPages:
+    # A GCS listing of pages of page_size objects, whose page tokens are the
+    # index the page starts at
+    def __init__(self, names, page_size=None, page_token=None, prefixes=()):
+        start = int(page_token or 0)
+        end = start + page_size if page_size else len(names)
+        self.blobs = [SignedBlob(name) for name in names[start:end]]
+        self.pages = iter([self.blobs])
+        self.next_page_token = str(end) if end < len(names) else None
+        self.prefixes = set(prefixes)
+
+    def __iter__(self):
+        return iter(self.blobs)
+
+
+def set_up_pages(mock_storage, file_names, derivatives=()):
+    def list_blobs(prefix, max_results=None, page_token=None, start_offset=None, delimiter=None):
+        if delimiter:
+            return BlobPages([], prefixes=[f"{prefix}{derivative}/" for derivative in derivatives])
+        names = [f"{prefix}{file_name}" for file_name in file_names]
+        names = [name for name in names if not start_offset or name >= start_offset]
+        return BlobPages(names, max_results, page_token)
+
+    mock_bucket = mock_storage.bucket.return_value
+    mock_bucket.list_blobs.side_effect = list_blobs
+    mock_bucket.blob.side_effect = SignedBlob
+    return mock_bucket
+
+
+def test_get_processed_images_pages_with_cursor(client, mock_storage, mock_firestore):
+    set_up_pages(mock_storage, ["a.jpg", "b.jpg", "c.jpg"], derivatives=["thumbnail"])
+
+    response = client.get('/get-processed-images?batch_id=test-batch&limit=2&derivatives=true')
+    assert response.status_code == 200
+    data = json.loads(response.data)
+    assert [pair['file_name'] for pair in data['image_pairs']] == ["a.jpg", "b.jpg"]
+    assert data['image_pairs'][0]['before_url'].startswith("https://signed-url.com/test-batch/input/a.jpg")
+    assert data['image_pairs'][1]['derivatives']['thumbnail']['after_url'].startswith(
+        "https://signed-url.com/test-batch/derivatives/thumbnail/output/b.jpg")
+
+    assert data['next_cursor'] == "b.jpg"
+
+    response = client.get(f"/get-processed-images?batch_id=test-batch&limit=2&cursor={data['next_cursor']}")
+    data = json.loads(response.data)
+    assert [pair['file_name'] for pair in data['image_pairs']] == ["c.jpg"]
+    assert data['next_cursor'] is None
+    # Pages of a batch in progress are listed on their own, never the whole batch
+    list_calls = mock_storage.bucket.return_value.list_blobs.call_args_list
+    assert "test-batch/" not in [call.kwargs['prefix'] for call in list_calls]
+
+
+def test_get_processed_images_rejects_bad_limit(client, mock_storage, mock_firestore):
+    response = client.get('/get-processed-images?batch_id=test-batch&limit=0')
+    assert response.status_code == 400
+
+
+def test_get_processed_images_streams_ndjson(client, mock_storage, mock_firestore):
+    mock_bucket = set_up_pages(mock_storage, ["a.jpg", "b.jpg", "c.jpg"])
+
+    with patch('image_handler.STREAM_PAGE_SIZE', 2):
+        response = client.get('/get-processed-images?batch_id=test-batch&format=ndjson')
+        assert response.status_code == 200
+        assert response.mimetype == "application/x-ndjson"
+        lines = response.get_data(as_text=True).splitlines()
+
+    assert [json.loads(line)['file_name'] for line in lines] == ["a.jpg", "b.jpg", "c.jpg"]
+    assert [call.kwargs['start_offset'] for call in mock_bucket.list_blobs.call_args_list] == \
+        [None, "test-batch/output/b.jpg"]
+
+
+def test_get_processed_images_serves_completed_batches_from_listing_cache(client, mock_storage, mock_firestore):
+    mock_bucket = set_up_listing(mock_storage, mock_firestore, "Completed")
+    url = '/get-processed-images?batch_id=test-batch&format=ndjson&derivatives=true'
+
+    first = client.get(url)
+    second = client.get(url, headers={'If-None-Match': first.headers['ETag']})
+    page = client.get('/get-processed-images?batch_id=test-batch&limit=1')
+
+    assert first.status_code == 200
+    assert [json.loads(line)['file_name'] for line in first.get_data(as_text=True).splitlines()] == ["test1.jpg"]
+    assert second.status_code == 304
+    assert json.loads(page.data)['next_cursor'] is None
+    # One listing of the whole batch, then none: it is completed
+    mock_bucket.list_blobs.assert_called_once_with(prefix="test-batch/")
+
+
+def test_get_processed_images_ndjson_not_found(client, mock_storage, mock_firestore):
+    set_up_pages(mock_storage, [])
+    response = client.get('/get-processed-images?batch_id=test-batch&format=ndjson')
+    assert response.status_code == 404
+
+
+def image_docs(ids):
+    return [Mock(id=doc_id, to_dict=Mock(return_value={"image_name": doc_id})) for doc_id in ids]
+
+
+def test_get_images_by_status_pages_with_cursor(client, mock_firestore):
+    query = mock_firestore.collection.return_value.where.return_value
+    query.order_by.return_value = query
+    query.limit.return_value = query
+    query.start_after.return_value = query
+    query.stream.return_value = image_docs(["img-1", "img-2"])
+
+    response = client.get('/get-images-by-status?batch_id=test-batch&IsProcessed=true&limit=2')
+    data = json.loads(response.data)
+    assert data['next_cursor'] == "img-2"
+    query.order_by.assert_called_once_with("__name__")
+    query.limit.assert_called_once_with(2)
+    query.start_after.assert_not_called()
+
+    query.stream.return_value = image_docs(["img-3"])
+    response = client.get('/get-images-by-status?batch_id=test-batch&IsProcessed=true&limit=2&cursor=img-2')
+    data = json.loads(response.data)
+    assert [image['image_name'] for image in data['images']] == ["img-3"]
+    assert data['next_cursor'] is None
+    query.start_after.assert_called_once_with({"__name__": "img-2"})
+
+
+def test_get_images_by_status_streams_ndjson(client, mock_firestore):
+    query = mock_firestore.collection.return_value.where.return_value
+    query.order_by.return_value = query
+    query.limit.return_value = query
+    query.start_after.return_value = query
+    query.stream.side_effect = [image_docs(["img-1", "img-2"]), image_docs(["img-3"])]
+
+    response = client.get('/get-images-by-status?batch_id=test-batch&IsProcessed=true&format=ndjson&limit=2')
+
+    assert response.mimetype == "application/x-ndjson"
+    lines = response.get_data(as_text=True).splitlines()
+    # Every page, like /get-processed-images
+    assert [json.loads(line)['image_name'] for line in lines] == ["img-1", "img-2", "img-3"]
+    query.start_after.assert_called_once_with({"__name__": "img-2"})
+
+
+def test_create_batch_returns_upload_urls(client, mock_storage, mock_firestore):
+    mock_blob = mock_storage.bucket.return_value.blob.return_value
+    mock_blob.generate_signed_url.side_effect = lambda **kwargs: f"https://signed-url.com/{kwargs['method']}"
+
+    response = client.post('/batches', json={
+        "email": "test@example.com",
+        "imagesMetadata": [
+            {"image_name": "test1.jpg", "filters": ["blur"], "content_type": "image/jpeg"},
+            {"image_name": "test2.png", "filters": []}
+        ]
+    })
+
+    assert response.status_code == 201
+    data = json.loads(response.data)
+    assert data['uploads'][0] == {"image_name": "test1.jpg", "upload_url": "https://signed-url.com/PUT",
+                                  "method": "PUT", "headers": {"Content-Type": "image/jpeg"}}
+    assert mock_storage.bucket.return_value.blob.call_args_list[0].args == (f"{data['batch_id']}/input/test1.jpg",)
+    # No image bytes pass through the handler
+    mock_blob.upload_from_file.assert_not_called()
+    batch = mock_firestore.collection.return_value.document.return_value.set.call_args.args[0]
+    assert batch['job_status'] == 'Awaiting Upload'
+    assert batch['images'][0] == {"image_name": "test1.jpg", "filters": ["blur"], "encoder_profile": None}
+
+
+def test_create_batch_resumable_uploads(client, mock_storage, mock_firestore):
+    mock_blob = mock_storage.bucket.return_value.blob.return_value
+    mock_blob.create_resumable_upload_session.return_value = 'https://session-url.com'
+
+    with patch('image_handler.UPLOAD_URL_TYPE', 'resumable'):
+        response = client.post('/batches', json={"imagesMetadata": [{"image_name": "test1.jpg"}]},
+                               headers={"Origin": "https://app.example.com"})
+
+    assert response.status_code == 201
+    assert json.loads(response.data)['uploads'][0]['upload_url'] == 'https://session-url.com'
+    mock_blob.create_resumable_upload_session.assert_called_once_with(content_type='application/octet-stream',
+                                                                      origin='https://app.example.com')
+
+
+def set_up_awaiting_batch(mock_storage, mock_firestore, uploaded):
+    batch = Mock(exists=True, update_time='update-time')
+    batch.to_dict.return_value = {
+        "email": "test@example.com",
+        "job_status": "Awaiting Upload",
+        "images": [{"image_name": "test1.jpg", "filters": ["blur"], "encoder_profile": "small"},
+                   {"image_name": "test2.jpg", "filters": [], "encoder_profile": None}]
+    }
+    mock_firestore.collection.return_value.document.return_value.get.return_value = batch
+    # name is taken by the Mock constructor, so it is set afterwards
+    blobs = []
+    for image_name in uploaded:
+        blob = Mock()
+        blob.name = f"test-batch/input/{image_name}"
+        blobs.append(blob)
+    mock_storage.bucket.return_value.list_blobs.return_value = blobs
+
+
+def test_commit_batch_dispatches_uploaded_images(client, mock_storage, mock_firestore, mock_requests):
+    set_up_awaiting_batch(mock_storage, mock_firestore, ['test1.jpg', 'test2.jpg'])
+
+    response = client.post('/batches/test-batch/commit')
+
+    assert response.status_code == 202
+    write_batch = mock_firestore.batch.return_value
+    # Two metadata documents, then the outbox entry with the claim
+    assert write_batch.set.call_count == 3
+    # The batch is claimed against the version that was read
+    mock_firestore.write_option.assert_called_once_with(last_update_time='update-time')
+    write_batch.update.assert_called_once_with(mock_firestore.collection.return_value.document.return_value,
+                                               {"job_status": "Pending"},
+                                               option=mock_firestore.write_option.return_value)
+    mock_requests.assert_not_called()
+    manifest = outbox_manifest(mock_firestore)
+    assert manifest['images'][0] == {"doc_id": "test-batch_test1.jpg", "image_name": "test1.jpg",
+                                     "filters": ["blur"], "encoder_profile": "small"}
+    assert len(manifest['images']) == 2
+
+
+def test_commit_batch_reports_missing_uploads(client, mock_storage, mock_firestore, mock_requests):
+    set_up_awaiting_batch(mock_storage, mock_firestore, ['test1.jpg'])
+
+    response = client.post('/batches/test-batch/commit')
+
+    assert response.status_code == 409
+    assert json.loads(response.data)['missing'] == ['test2.jpg']
+    mock_firestore.batch.assert_not_called()
+    mock_requests.assert_not_called()
+
+
+def test_commit_batch_only_once(client, mock_storage, mock_firestore, mock_requests, outbox_wakeups):
+    set_up_awaiting_batch(mock_storage, mock_firestore, ['test1.jpg', 'test2.jpg'])
+    write_batch = mock_firestore.batch.return_value
+    # The metadata commit succeeds, the claim with the outbox entry does not
+    write_batch.commit.side_effect = [None, FailedPrecondition('stale')]
+
+    response = client.post('/batches/test-batch/commit')
+
+    assert response.status_code == 409
+    outbox_wakeups.assert_not_called()
+
+
+def outbox_entry(manifest, attempts=0):
+    entry = Mock(id=manifest['batch_id'], update_time='update-time')
+    entry.to_dict.return_value = {"manifest": manifest, "attempts": attempts, "next_attempt_at": 0}
+    return entry
+
+
+def set_up_outbox(mock_firestore, entries):
+    query = mock_firestore.collection.return_value.where.return_value
+    query.limit.return_value.stream.return_value = entries
+
+
+def test_dispatch_outbox_posts_due_batches(mock_firestore, mock_requests):
+    entry = outbox_entry({"batch_id": "test-batch", "images": []})
+    set_up_outbox(mock_firestore, [entry])
+
+    assert image_handler.dispatch_outbox.drain() == 1
+
+    # Claimed against the version read, posted with a timeout, then removed
+    mock_firestore.write_option.assert_called_once_with(last_update_time='update-time')
+    mock_requests.assert_called_once_with("http://interaction-pod:8080/process_batch",
+                                          json={"batch_id": "test-batch", "images": []},
+                                          timeout=image_handler.DISPATCH_TIMEOUT_SECONDS)
+    entry.reference.delete.assert_called_once()
+
+
+def test_dispatch_outbox_skips_batches_claimed_elsewhere(mock_firestore, mock_requests):
+    entry = outbox_entry({"batch_id": "test-batch", "images": []})
+    entry.reference.update.side_effect = FailedPrecondition('stale')
+    set_up_outbox(mock_firestore, [entry])
+
+    image_handler.dispatch_outbox.drain()
+
+    mock_requests.assert_not_called()
+    entry.reference.delete.assert_not_called()
+
+
+def test_dispatch_outbox_retries_with_backoff(mock_firestore, mock_requests):
+    mock_requests.side_effect = image_handler.requests.ConnectionError("refused")
+    entry = outbox_entry({"batch_id": "test-batch", "images": []}, attempts=2)
+    set_up_outbox(mock_firestore, [entry])
+
+    with patch('image_handler.time.time', return_value=1000):
+        image_handler.dispatch_outbox.drain()
+
+    retry = entry.reference.update.call_args.args[0]
+    assert retry['attempts'] == 3
+    assert retry['next_attempt_at'] == 1000 + image_handler.DISPATCH_RETRY_SECONDS * 4
+    entry.reference.delete.assert_not_called()
+
+
+def test_dispatch_outbox_gives_up_on_rejected_batches(mock_firestore, mock_requests):
+    mock_requests.return_value.raise_for_status.side_effect = image_handler.requests.HTTPError(
+        response=Mock(status_code=400))
+    entry = outbox_entry({"batch_id": "test-batch", "images": []})
+    set_up_outbox(mock_firestore, [entry])
+
+    image_handler.dispatch_outbox.drain()
+
+    mock_firestore.collection.return_value.document.return_value.update.assert_called_once_with(
+        {"job_status": image_handler.DISPATCH_FAILED})
+    entry.reference.delete.assert_called_once()
+
+
+@pytest.fixture
+def streamed_blobs(mock_storage):
+    # A blob per object name, recording what was written to it
+    blobs = {}
+
+    def blob(name):
+        if name not in blobs:
+            streamed_blob = Mock(public_url=f'https://storage.googleapis.com/{name}', written=[])
+            writer = MagicMock()
+            writer.__enter__.return_value.write.side_effect = streamed_blob.written.append
+            writer.__exit__.return_value = False
+            streamed_blob.open.return_value = writer
+            blobs[name] = streamed_blob
+        return blobs[name]
+
+    mock_storage.bucket.return_value.blob.side_effect = blob
+    yield blobs
+
+
+def multipart_body(fields):
+    # The test client puts form fields before files, so bodies that need
+    # another order are encoded here
+    boundary, body = encode_multipart(MultiDict([
+        (name, FileStorage(io.BytesIO(value[0]), filename=value[1]) if isinstance(value, tuple) else value)
+        for name, value in fields
+    ]))
+    return body, f'multipart/form-data; boundary={boundary}'
+
+
+def test_upload_images_stream_pipes_files_to_storage(client, mock_firestore, mock_requests, streamed_blobs):
+    image_data = bytes(range(256)) * 40
+    metadata = {"email": "test@example.com", "imagesMetadata": [
+        {"image_name": "first.jpg", "filters": ["blur"]},
+        {"image_name": "second.jpg", "filters": []}
+    ]}
+    data = MultiDict([
+        ('metadata', json.dumps(metadata)),
+        ('files', (io.BytesIO(image_data), "test1.jpg")),
+        ('files', (io.BytesIO(b"second image"), "test2.jpg"))
+    ])
+
+    with patch('image_handler.STREAMING_READ_SIZE', 1024):
+        response = client.post('/upload-images/stream', data=data, content_type='multipart/form-data')
+
+    assert response.status_code == 202
+    manifest = outbox_manifest(mock_firestore)
+    batch_id = manifest['batch_id']
+    first = streamed_blobs[f"{batch_id}/input/first.jpg"]
+    # Written a piece at a time, never the whole file at once
+    assert b"".join(first.written) == image_data
+    assert max(len(piece) for piece in first.written) <= 1024
+    assert b"".join(streamed_blobs[f"{batch_id}/input/second.jpg"].written) == b"second image"
+    assert [image['image_name'] for image in manifest['images']] == ['first.jpg', 'second.jpg']
+    assert manifest['images'][0]['filters'] == ['blur']
+
+
+def test_upload_images_stream_renames_when_metadata_comes_last(client, mock_storage, mock_firestore, mock_requests,
+                                                               streamed_blobs):
+    metadata = {"email": "test@example.com", "imagesMetadata": [{"image_name": "first.jpg", "filters": []},
+                                                                 {"image_name": "second.jpg", "filters": []}]}
+    # Client file names may repeat
+    body, content_type = multipart_body([
+        ('files', (b"first image", "photo.jpg")),
+        ('files', (b"second image", "photo.jpg")),
+        ('metadata', json.dumps(metadata))
+    ])
+
+    bucket = mock_storage.bucket.return_value
+    bucket.rename_blob.side_effect = lambda blob, new_name: bucket.blob(new_name)
+
+    with patch('image_handler.upload_executor') as mock_executor:
+        response = client.post('/upload-images/stream', data=body, content_type=content_type)
+
+    assert response.status_code == 202
+    # Streamed images do not hold threads of the shared upload pool
+    mock_executor.submit.assert_not_called()
+    batch_id = outbox_manifest(mock_firestore)['batch_id']
+    assert b"".join(streamed_blobs[f"{batch_id}/input/.part-0"].written) == b"first image"
+    assert b"".join(streamed_blobs[f"{batch_id}/input/.part-1"].written) == b"second image"
+    assert [call.args for call in bucket.rename_blob.call_args_list] == [
+        (streamed_blobs[f"{batch_id}/input/.part-0"], f"{batch_id}/input/first.jpg"),
+        (streamed_blobs[f"{batch_id}/input/.part-1"], f"{batch_id}/input/second.jpg")
+    ]
+    assert [image['image_name'] for image in outbox_manifest(mock_firestore)['images']] == \
+        ['first.jpg', 'second.jpg']
+
+
+def test_upload_images_stream_abandons_incomplete_request(client, mock_storage, mock_firestore, mock_requests,
+                                                          streamed_blobs):
+    body, content_type = multipart_body([
+        ('metadata', json.dumps({"imagesMetadata": [{"image_name": "test1.jpg"}]})),
+        ('files', (b"test image content" * 100, "test1.jpg"))
+    ])
+
+    response = client.post('/upload-images/stream', data=body[:len(body) // 2], content_type=content_type)
+
+    assert response.status_code == 400
+    writer = next(iter(streamed_blobs.values())).open.return_value
+    # The partial image is not committed to the bucket
+    assert writer.__exit__.call_args.args[0] is RuntimeError
+    mock_firestore.batch.assert_not_called()
+    mock_requests.assert_not_called()
+
+
+def test_upload_images_rejects_repeated_names(client, mock_storage, mock_firestore, mock_requests):
+    response = client.post('/upload-images', data=upload_form(['test1.jpg', 'test1.jpg']),
+                           content_type='multipart/form-data')
+
+    assert response.status_code == 400
+    mock_storage.bucket.return_value.blob.return_value.upload_from_file.assert_not_called()
+    mock_firestore.collection.return_value.document.return_value.set.assert_not_called()
+
+
+def test_upload_images_stream_rejects_repeated_names(client, mock_storage, mock_firestore, mock_requests,
+                                                     streamed_blobs):
+    metadata = {"email": "test@example.com", "imagesMetadata": [{"image_name": "same.jpg", "filters": []},
+                                                                 {"image_name": "same.jpg", "filters": []}]}
+    body, content_type = multipart_body([
+        ('metadata', json.dumps(metadata)),
+        ('files', (b"first image", "one.jpg")),
+        ('files', (b"second image", "two.jpg"))
+    ])
+
+    response = client.post('/upload-images/stream', data=body, content_type=content_type)
+
+    assert response.status_code == 400
+    # The second copy is not streamed over the first, and both are removed
+    assert sorted(name.rsplit('/', 1)[1] for name in streamed_blobs) == ['.part-1', 'same.jpg']
+    for streamed_blob in streamed_blobs.values():
+        streamed_blob.delete.assert_called_once()
+    mock_firestore.collection.return_value.document.return_value.set.assert_not_called()
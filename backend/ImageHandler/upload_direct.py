@@ -0,0 +1,49 @@
+import os
+import sys
+import json
+import mimetypes
+import argparse
+import requests
+
+
+def create_batch(handler_url, email, image_paths, filters):
+    images_metadata = [{
+        "image_name": os.path.basename(image_path),
+        "filters": filters,
+        "content_type": mimetypes.guess_type(image_path)[0] or "application/octet-stream"
+    } for image_path in image_paths]
+    response = requests.post(f"{handler_url}/batches", json={"email": email, "imagesMetadata": images_metadata})
+    response.raise_for_status()
+    return response.json()
+
+
+def upload_images(batch, image_paths):
+    # Straight to Cloud Storage, not through the handler
+    for upload, image_path in zip(batch["uploads"], image_paths):
+        with open(image_path, "rb") as image_file:
+            response = requests.request(upload["method"], upload["upload_url"], data=image_file,
+                                        headers=upload["headers"])
+        response.raise_for_status()
+        print(f"Uploaded {upload['image_name']}", file=sys.stderr)
+
+
+def commit_batch(handler_url, batch_id):
+    response = requests.post(f"{handler_url}/batches/{batch_id}/commit")
+    return response.status_code, response.json()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Upload a batch through the two-phase /batches API')
+    parser.add_argument('images', nargs='+')
+    parser.add_argument('--handler', default='http://localhost:5000', help='Image handler URL')
+    parser.add_argument('--email', default='test@example.com')
+    parser.add_argument('--filters', default='[{"filter_type": "grayscale", "filter_value": "1"}]',
+                        help='Filters for every image, as JSON')
+    args = parser.parse_args()
+
+    batch = create_batch(args.handler, args.email, args.images, json.loads(args.filters))
+    print(f"Created batch {batch['batch_id']}", file=sys.stderr)
+    upload_images(batch, args.images)
+    status_code, result = commit_batch(args.handler, batch["batch_id"])
+    print(json.dumps({"batch_id": batch["batch_id"], "status_code": status_code, "result": result}, indent=2))
+    sys.exit(0 if status_code < 400 else 1)
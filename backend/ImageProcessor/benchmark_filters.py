@@ -0,0 +1,135 @@
+import io
+import os
+import time
+import logging
+import argparse
+from PIL import Image, ImageChops
+import image_processor
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+TESTING_IMAGES_DIR = os.path.join(current_dir, '..', '..', 'testing-images')
+DEFAULT_IMAGES = [os.path.join(TESTING_IMAGES_DIR, 'cheetah.jpg'), os.path.join(TESTING_IMAGES_DIR, 'sun.jpg')]
+THUMBNAIL_SIZES = ['1024', '256']
+# PNG encoding of a full-size photo takes tens of seconds at high effort, so
+# PNG and WebP are measured on a downscaled copy
+ENCODE_PNG_BOX = '1600'
+
+# Chains of point filters users commonly send
+CHAINS = {
+    'brightness-contrast-brightness': [
+        {'filter_type': 'brightness', 'filter_value': '1.2'},
+        {'filter_type': 'contrast', 'filter_value': '1.5'},
+        {'filter_type': 'brightness', 'filter_value': '0.9'},
+    ],
+    'grayscale-brightness-contrast': [
+        {'filter_type': 'grayscale', 'filter_value': '1'},
+        {'filter_type': 'brightness', 'filter_value': '1.3'},
+        {'filter_type': 'contrast', 'filter_value': '1.2'},
+    ],
+    'brightness-grayscale-contrast': [
+        {'filter_type': 'brightness', 'filter_value': '0.8'},
+        {'filter_type': 'grayscale', 'filter_value': '1'},
+        {'filter_type': 'contrast', 'filter_value': '1.4'},
+    ],
+}
+
+
+def max_difference(image_a, image_b):
+    extrema = ImageChops.difference(image_a, image_b).getextrema()
+    if isinstance(extrema[0], tuple):
+        return max(band_max for _, band_max in extrema)
+    return extrema[1]
+
+
+def time_filters(image, filters, fuse_point_filters, repeat):
+    timings = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = image_processor.run_filters(image, filters, fuse_point_filters=fuse_point_filters)
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+
+def run_fusion_benchmark(image_path, repeat):
+    image = Image.open(image_path)
+    image.load()
+    print(f"Image: {image_path} ({image.width}x{image.height} {image.mode}), best of {repeat} runs")
+    print(f"{'chain':<32}{'unfused (s)':>12}{'fused (s)':>12}{'speedup':>10}{'max diff':>10}")
+    for name, filters in CHAINS.items():
+        unfused_time, unfused_image = time_filters(image, filters, False, repeat)
+        fused_time, fused_image = time_filters(image, filters, True, repeat)
+        difference = max_difference(unfused_image, fused_image)
+        print(f"{name:<32}{unfused_time:>12.3f}{fused_time:>12.3f}{unfused_time / fused_time:>9.1f}x{difference:>10}")
+
+
+def time_thumbnail(image_path, box, draft, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        image = Image.open(image_path)
+        filters = [{'filter_type': 'thumbnail', 'filter_value': box}]
+        if draft:
+            image = image_processor.run_filters(image, filters)
+        else:
+            image.load()
+            image = image_processor.apply_filter(image, filters[0])
+        timings.append(time.perf_counter() - start)
+    return min(timings), image.size
+
+
+def run_draft_benchmark(image_path, repeat):
+    with Image.open(image_path) as image:
+        print(f"Image: {image_path} ({image.width}x{image.height} {image.format}), best of {repeat} runs")
+    print(f"{'thumbnail':<12}{'output':>12}{'full decode (s)':>18}{'draft decode (s)':>18}{'speedup':>10}")
+    for box in THUMBNAIL_SIZES:
+        full_time, size = time_thumbnail(image_path, box, False, repeat)
+        draft_time, _ = time_thumbnail(image_path, box, True, repeat)
+        output = f"{size[0]}x{size[1]}"
+        print(f"{box:<12}{output:>12}{full_time:>18.3f}{draft_time:>18.3f}{full_time / draft_time:>9.1f}x")
+
+
+def time_encode(image, output_format, options, repeat):
+    timings = []
+    size = 0
+    for _ in range(repeat):
+        output_io = io.BytesIO()
+        start = time.perf_counter()
+        image_processor.save_image(image, output_io, output_format, options)
+        timings.append(time.perf_counter() - start)
+        size = output_io.tell()
+    return min(timings), size
+
+
+def run_encode_benchmark(image_path, repeat):
+    image = Image.open(image_path)
+    image.load()
+    downscaled = image_processor.apply_filter(image, {'filter_type': 'thumbnail', 'filter_value': ENCODE_PNG_BOX})
+    print(f"Image: {image_path}, best of {repeat} runs")
+    print(f"{'format':<8}{'profile':<10}{'size':>12}{'encode (s)':>12}{'bytes':>12}{'MB/s in':>10}")
+    for output_format, source in [('JPEG', image), ('PNG', downscaled), ('WEBP', downscaled)]:
+        for profile, settings in image_processor.ENCODER_PROFILES.items():
+            encode_time, size = time_encode(source, output_format, settings[output_format], repeat)
+            megabytes = source.width * source.height * len(source.getbands()) / 1e6
+            dimensions = f"{source.width}x{source.height}"
+            print(f"{output_format:<8}{profile:<10}{dimensions:>12}{encode_time:>12.3f}{size:>12}"
+                  f"{megabytes / encode_time:>10.1f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark image processor filter paths')
+    parser.add_argument('--benchmark', choices=['fusion', 'draft', 'encode', 'all'], default='all',
+                        help='fusion: fused vs unfused point filters, draft: full vs JPEG draft decode for '
+                             'thumbnails, encode: encode time and bytes per encoder profile')
+    parser.add_argument('--image', action='append', help='Image to benchmark, may be repeated')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+    for image_path in args.image or DEFAULT_IMAGES:
+        if args.benchmark in ['fusion', 'all']:
+            run_fusion_benchmark(image_path, args.repeat)
+        if args.benchmark in ['draft', 'all']:
+            run_draft_benchmark(image_path, args.repeat)
+        if args.benchmark in ['encode', 'all']:
+            run_encode_benchmark(image_path, args.repeat)
+        print()
@@ -0,0 +1,95 @@
+import time
+import logging
+import argparse
+import threading
+from types import SimpleNamespace
+from collections import Counter, deque
+import image_processor
+
+
+class FakeSubscriber:
+    # Stand-in for SubscriberClient's pull, acknowledge and
+    # modify_ack_deadline: a backlog of messages, every request taking
+    # round_trip seconds. Nacked messages go back to the backlog. Lease
+    # expiry is not modelled.
+
+    def __init__(self, message_count, round_trip):
+        self.round_trip = round_trip
+        self.backlog = deque(SimpleNamespace(ack_id=f'ack-{index}', message=SimpleNamespace(
+            data=b'{}', message_id=str(index))) for index in range(message_count))
+        self.leased = {}
+        self.message_count = message_count
+        self.acked = 0
+        self.requests = Counter()
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+
+    def pull(self, request, timeout=None):
+        time.sleep(self.round_trip)
+        with self.lock:
+            self.requests['pull'] += 1
+            received = [self.backlog.popleft() for _ in range(min(request['max_messages'], len(self.backlog)))]
+            self.leased.update((received_message.ack_id, received_message) for received_message in received)
+        return SimpleNamespace(received_messages=received)
+
+    def acknowledge(self, request):
+        time.sleep(self.round_trip)
+        with self.lock:
+            self.requests['acknowledge'] += 1
+            for ack_id in request['ack_ids']:
+                if self.leased.pop(ack_id, None) is not None:
+                    self.acked += 1
+            if self.acked == self.message_count:
+                self.done.set()
+
+    def modify_ack_deadline(self, request):
+        time.sleep(self.round_trip)
+        with self.lock:
+            self.requests['modify_ack_deadline'] += 1
+            if request['ack_deadline_seconds'] == 0:
+                self.backlog.extend(self.leased.pop(ack_id) for ack_id in request['ack_ids']
+                                    if ack_id in self.leased)
+
+
+def handle(work_time):
+    # Download, process and upload as one wait, then the ack the status
+    # reporter would send once the update is accepted
+    def handle_message(message):
+        time.sleep(work_time)
+        message.ack()
+    return handle_message
+
+
+def run(batch_size, message_count, round_trip, work_time):
+    fake = FakeSubscriber(message_count, round_trip)
+    leaser = image_processor.PullLeaser(fake, 'projects/benchmark/subscriptions/benchmark',
+                                        image_processor.PULL_ACK_DEADLINE, image_processor.PULL_FLUSH_INTERVAL)
+    stop = threading.Event()
+    start = time.perf_counter()
+    worker = threading.Thread(target=image_processor.run_pull_worker,
+                              args=(leaser, handle(work_time), batch_size, stop))
+    worker.start()
+    fake.done.wait()
+    elapsed = time.perf_counter() - start
+    stop.set()
+    worker.join()
+    leaser.stop()
+    print(f"{batch_size:>10}{message_count:>10}{elapsed:>10.2f}{message_count / elapsed:>12.1f}"
+          f"{fake.requests['pull']:>8}{fake.requests['acknowledge']:>8}{fake.requests['modify_ack_deadline']:>10}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark pull mode throughput against batch size on a local '
+                                                 'stand-in for Pub/Sub')
+    parser.add_argument('--messages', type=int, default=500)
+    parser.add_argument('--batch-sizes', type=int, nargs='*', default=[1, 2, 5, 10, 25, 50])
+    parser.add_argument('--round-trip', type=float, default=0.02, help='Seconds per Pub/Sub request')
+    parser.add_argument('--work-time', type=float, default=0.05,
+                        help='Seconds of download, processing and upload per message')
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    print(f"Fake Pub/Sub, {args.round_trip * 1000:.0f} ms per request, {args.work_time * 1000:.0f} ms per message")
+    print(f"{'batch':>10}{'messages':>10}{'seconds':>10}{'msgs/sec':>12}{'pulls':>8}{'acks':>8}{'extends':>10}")
+    for batch_size in args.batch_sizes:
+        run(batch_size, args.messages, args.round_trip, args.work_time)
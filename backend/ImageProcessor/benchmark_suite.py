@@ -0,0 +1,200 @@
+import io
+import os
+import sys
+import json
+import math
+import time
+import logging
+import argparse
+import platform
+import statistics
+from datetime import datetime, timezone
+import PIL
+from PIL import Image
+import image_processor
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+TESTING_IMAGES_DIR = os.path.join(current_dir, '..', '..', 'testing-images')
+TESTING_IMAGES = ['cheetah.jpg', 'sun.jpg']
+SYNTHETIC_SIZES_MP = [1, 12, 50]
+# Synthetic inputs per mode, encoded the way users upload them
+SYNTHETIC_MODES = {'RGB': 'JPEG', 'L': 'JPEG', 'RGBA': 'PNG'}
+
+# Every filter type apply_filters understands, then chains users send
+FILTER_CASES = {
+    'rotate': [{'filter_type': 'rotate', 'filter_value': '45'}],
+    'grayscale': [{'filter_type': 'grayscale', 'filter_value': '1'}],
+    'blur': [{'filter_type': 'blur', 'filter_value': '2.0'}],
+    'brightness': [{'filter_type': 'brightness', 'filter_value': '1.2'}],
+    'contrast': [{'filter_type': 'contrast', 'filter_value': '1.5'}],
+    'resize': [{'filter_type': 'resize', 'filter_value': '0.5'}],
+    'thumbnail': [{'filter_type': 'thumbnail', 'filter_value': '256'}],
+    'chain-enhance': [
+        {'filter_type': 'brightness', 'filter_value': '1.2'},
+        {'filter_type': 'contrast', 'filter_value': '1.5'},
+        {'filter_type': 'brightness', 'filter_value': '0.9'}
+    ],
+    'chain-frontend': [
+        {'filter_type': 'resize', 'filter_value': {'width': 1024, 'height': None}},
+        {'filter_type': 'rotate', 'filter_value': 90},
+        {'filter_type': 'brightness', 'filter_value': 1.3},
+        {'filter_type': 'grayscale', 'filter_value': {}}
+    ],
+    'chain-soften': [
+        {'filter_type': 'grayscale', 'filter_value': '1'},
+        {'filter_type': 'contrast', 'filter_value': '1.3'},
+        {'filter_type': 'blur', 'filter_value': '4'}
+    ]
+}
+
+
+def synthetic_image(megapixels, mode):
+    # Noise over a gradient: compresses like a photo rather than like a flat
+    # colour, and is the same on every run
+    width = int(math.sqrt(megapixels * 1e6 * 3 / 2))
+    height = int(megapixels * 1e6 / width)
+    gradient = Image.linear_gradient('L').resize((width, height))
+    noise = Image.effect_noise((width, height), 40)
+    luminance = Image.blend(gradient, noise, 0.3)
+    if mode == 'L':
+        return luminance
+    bands = [luminance, luminance.transpose(Image.FLIP_LEFT_RIGHT), luminance.transpose(Image.FLIP_TOP_BOTTOM)]
+    if mode == 'RGBA':
+        bands.append(gradient.transpose(Image.ROTATE_180))
+    return Image.merge(mode, bands)
+
+
+def load_inputs(sizes, include_testing_images):
+    # (name, encoded bytes) for every input image
+    inputs = []
+    if include_testing_images:
+        for file_name in TESTING_IMAGES:
+            with open(os.path.join(TESTING_IMAGES_DIR, file_name), 'rb') as image_file:
+                inputs.append((file_name, image_file.read()))
+    for megapixels in sizes:
+        for mode, image_format in SYNTHETIC_MODES.items():
+            output_io = io.BytesIO()
+            synthetic_image(megapixels, mode).save(output_io, format=image_format)
+            inputs.append((f'synthetic-{megapixels}mp-{mode}.{image_format.lower()}', output_io.getvalue()))
+    return inputs
+
+
+def run_case(image_data, filters, encoder_profile):
+    # Decode, filter and encode timings for one run of the processor pipeline,
+    # as measured by process_image itself
+    timings = {}
+    start = time.perf_counter()
+    outputs = image_processor.process_image(image_data, filters, [], encoder_profile, timings)
+    return {
+        'decode_s': timings['decode'],
+        'filter_s': timings['filters'],
+        'encode_s': timings['encode'],
+        'total_s': time.perf_counter() - start,
+        'output_bytes': len(outputs['output'][0])
+    }
+
+
+def run_suite(inputs, case_names, repeat, encoder_profile):
+    results = []
+    for input_name, image_data in inputs:
+        with Image.open(io.BytesIO(image_data)) as image:
+            input_megapixels = image.width * image.height / 1e6
+            input_mode = image.mode
+        for case_name in case_names:
+            runs = [run_case(image_data, FILTER_CASES[case_name], encoder_profile) for _ in range(repeat)]
+            total = statistics.median(run['total_s'] for run in runs)
+            result = {
+                'input': input_name,
+                'mode': input_mode,
+                'input_megapixels': round(input_megapixels, 2),
+                'case': case_name,
+                'filters': FILTER_CASES[case_name],
+                'decode_s': statistics.median(run['decode_s'] for run in runs),
+                'filter_s': statistics.median(run['filter_s'] for run in runs),
+                'encode_s': statistics.median(run['encode_s'] for run in runs),
+                'total_s': total,
+                'images_per_sec': 1 / total,
+                'megapixels_per_sec': input_megapixels / total,
+                'output_bytes': runs[0]['output_bytes']
+            }
+            results.append(result)
+            print(f"{input_name:<32}{case_name:<16}{total:>9.3f}s{result['images_per_sec']:>9.2f} img/s"
+                  f"{result['megapixels_per_sec']:>9.1f} MP/s", file=sys.stderr)
+    return results
+
+
+def suite_metadata(repeat, encoder_profile):
+    return {
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'pillow': PIL.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'repeat': repeat,
+        'statistic': 'median',
+        'settings': {
+            'FUSE_POINT_FILTERS': image_processor.FUSE_POINT_FILTERS,
+            'TILED_PIXEL_THRESHOLD': image_processor.TILED_PIXEL_THRESHOLD,
+            'TILE_STRIP_ROWS': image_processor.TILE_STRIP_ROWS,
+            'HOIST_RESIZE': image_processor.HOIST_RESIZE,
+            'ENCODER_PROFILE': encoder_profile
+        }
+    }
+
+
+def compare_results(baseline, results, threshold):
+    # Cases whose total time grew by more than threshold (a fraction) since the baseline
+    baseline_totals = {(result['input'], result['case']): result['total_s'] for result in baseline['results']}
+    regressions = []
+    for result in results:
+        baseline_total = baseline_totals.get((result['input'], result['case']))
+        if baseline_total and result['total_s'] > baseline_total * (1 + threshold):
+            regressions.append({
+                'input': result['input'],
+                'case': result['case'],
+                'baseline_total_s': baseline_total,
+                'total_s': result['total_s'],
+                'change': result['total_s'] / baseline_total - 1
+            })
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark every image processor filter and common chains, '
+                                                 'reporting JSON timings for decode, filters and encode')
+    parser.add_argument('--sizes', type=float, nargs='*', default=SYNTHETIC_SIZES_MP,
+                        help='Megapixels of the synthetic inputs')
+    parser.add_argument('--no-testing-images', action='store_true', help='Skip the bundled testing images')
+    parser.add_argument('--case', action='append', choices=sorted(FILTER_CASES),
+                        help='Filter case to run, may be repeated (default: all)')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--encoder-profile', default=image_processor.ENCODER_PROFILE,
+                        choices=sorted(image_processor.ENCODER_PROFILES))
+    parser.add_argument('--output', help='Write the JSON report here instead of stdout')
+    parser.add_argument('--compare', help='Baseline JSON report to check for regressions')
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help='Fractional slowdown against the baseline that counts as a regression')
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    sizes = [int(size) if float(size).is_integer() else size for size in args.sizes]
+    inputs = load_inputs(sizes, not args.no_testing_images)
+    results = run_suite(inputs, args.case or list(FILTER_CASES), args.repeat, args.encoder_profile)
+    report = {'metadata': suite_metadata(args.repeat, args.encoder_profile), 'results': results}
+
+    exit_code = 0
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            report['regressions'] = compare_results(json.load(baseline_file), results, args.threshold)
+        for regression in report['regressions']:
+            print(f"Regression: {regression['input']} {regression['case']} "
+                  f"{regression['baseline_total_s']:.3f}s -> {regression['total_s']:.3f}s "
+                  f"({regression['change']:+.0%})", file=sys.stderr)
+        exit_code = 1 if report['regressions'] else 0
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    sys.exit(exit_code)
@@ -5,9 +5,25 @@ import io
 import os
 import logging
 import json
+import math
 import time
+import threading
+import hashlib
+import functools
+import resource
+import multiprocessing
+import queue
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from google.cloud.pubsub_v1.subscriber.scheduler import Scheduler, ThreadScheduler
+from google.api_core.exceptions import NotFound
 from dotenv import load_dotenv
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 load_dotenv()
 current_dir = os.path.dirname(os.path.abspath(__file__))
 print(current_dir)
@@ -20,6 +36,89 @@ BUCKET_NAME = os.getenv('GCP_BUCKET_NAME', 'cu-image-flow')
 IMAGE_PUBSUB_TOPIC = os.getenv('IMAGE_PUBSUB_TOPIC', 'projects/dcsc-project-440602/topics/image-processing-queue')
 SUBSCRIPTION_NAME = os.getenv('PUBSUB_SUBSCRIPTION', 'image-processing-queue-sub')
 INTERACTION_POD_URL = os.getenv('INTERACTION_POD_URL', 'http://interaction-pod:8080')
+# 'thread' runs decode/filter/encode on the subscriber callback threads,
+# 'process' hands it to a process pool so a pod can use all of its cores
+EXECUTION_MODE = os.getenv('EXECUTION_MODE', 'thread')
+PROCESS_POOL_SIZE = int(os.getenv('PROCESS_POOL_SIZE', os.cpu_count() or 1))
+# In process mode the subscriber leases at most this many messages per pool
+# worker, so leased messages are not left waiting for a free worker
+LEASED_MESSAGES_PER_WORKER = int(os.getenv('LEASED_MESSAGES_PER_WORKER', 1))
+# Result cache for repeated (input bytes, filters) jobs: 'off', 'local' keeps
+# recent outputs in an in-memory LRU, 'gcs' keeps them as objects under
+# RESULT_CACHE_PREFIX and serves hits with a server-side copy. Expire the GCS
+# tier with a bucket lifecycle rule on that prefix.
+RESULT_CACHE_MODE = os.getenv('RESULT_CACHE_MODE', 'local')
+RESULT_CACHE_MAX_ENTRIES = int(os.getenv('RESULT_CACHE_MAX_ENTRIES', 256))
+RESULT_CACHE_MAX_BYTES = int(os.getenv('RESULT_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+RESULT_CACHE_PREFIX = os.getenv('RESULT_CACHE_PREFIX', 'result-cache')
+# Stream the input from a GCS reader into the decoder and the encoder output
+# into a chunked resumable upload, so no full copy of either file is held in
+# memory. Only used in thread mode, process workers need the bytes.
+STREAMING_IO = os.getenv('STREAMING_IO', 'false').lower() == 'true'
+# Resumable uploads need a multiple of 256 KiB
+STREAMING_CHUNK_SIZE = int(os.getenv('STREAMING_CHUNK_SIZE', 2 * 1024 * 1024))
+# Downscaled copies of the input and output made from the same decode, as
+# 'name:box' pairs. Stored at {batch_id}/derivatives/{name}/input/{image_name}
+# and {batch_id}/derivatives/{name}/output/{image_name}.
+DERIVATIVES = os.getenv('DERIVATIVES', 'thumbnail:256,preview:1024')
+DERIVATIVE_JPEG_QUALITY = int(os.getenv('DERIVATIVE_JPEG_QUALITY', 85))
+# Encoder profile for outputs, overridable per job with 'encoder_profile' in
+# the message. The output keeps the source format; with ENCODER_WEBP the
+# 'small' profile writes WebP instead.
+ENCODER_PROFILE = os.getenv('ENCODER_PROFILE', 'balanced')
+ENCODER_WEBP = os.getenv('ENCODER_WEBP', 'false').lower() == 'true'
+# Prometheus metrics are served at :METRICS_PORT/metrics, 0 turns them off.
+# Stage quantiles are computed over the last METRICS_WINDOW messages.
+METRICS_PORT = int(os.getenv('METRICS_PORT', 8082))
+METRICS_WINDOW = int(os.getenv('METRICS_WINDOW', 1024))
+# Image status updates are sent to the interaction service in bulk, once
+# STATUS_BATCH_SIZE have been collected or the oldest has waited
+# STATUS_BATCH_DELAY seconds
+STATUS_BATCH_SIZE = int(os.getenv('STATUS_BATCH_SIZE', 50))
+STATUS_BATCH_DELAY = float(os.getenv('STATUS_BATCH_DELAY', 0.5))
+STATUS_TIMEOUT = float(os.getenv('STATUS_TIMEOUT', 10))
+# Size-based priority lanes, the same 'name:max_images' list as the
+# interaction service's SCHEDULING_LANES, highest priority first. Lane
+# messages are read from {PUBSUB_SUBSCRIPTION}-{lane} and run on LANE_WORKERS
+# threads (in process mode, one per leased pool slot), taken from the highest
+# priority lane with messages waiting. A lane that has had messages waiting
+# but no worker for LANE_MAX_WAIT seconds is served first, so large batches
+# keep moving however many small ones arrive.
+# Within a lane, batches take turns. Empty reads PUBSUB_SUBSCRIPTION alone.
+SCHEDULING_LANES = os.getenv('SCHEDULING_LANES', '')
+# 'streaming' leases messages through a streaming pull and runs each
+# callback as its message arrives. 'pull' pulls up to PULL_BATCH_SIZE
+# messages per request and runs their callbacks together, so their
+# downloads, processing and uploads overlap, and sends acks, nacks and lease
+# extensions in bulk every PULL_FLUSH_INTERVAL seconds. Pulled messages are
+# leased for PULL_ACK_DEADLINE seconds as soon as they are pulled, whatever
+# the subscription's ack deadline, and kept leased until they are acked,
+# however long their batch takes.
+WORKER_MODE = os.getenv('WORKER_MODE', 'streaming')
+PULL_BATCH_SIZE = int(os.getenv('PULL_BATCH_SIZE', 10))
+PULL_ACK_DEADLINE = int(os.getenv('PULL_ACK_DEADLINE', 60))
+PULL_FLUSH_INTERVAL = float(os.getenv('PULL_FLUSH_INTERVAL', 0.1))
+PULL_TIMEOUT = float(os.getenv('PULL_TIMEOUT', 30))
+# Most ack ids sent in one acknowledge or modify_ack_deadline request
+ACK_IDS_PER_REQUEST = 1000
+LANE_WORKERS = int(os.getenv('LANE_WORKERS', 10))
+LANE_MAX_WAIT = float(os.getenv('LANE_MAX_WAIT', 60))
+# Admission control for decodes. Before decoding, a message reads the image
+# header, estimates the bytes its decode and filters hold at their peak and
+# reserves them from a pod-wide budget of MEMORY_BUDGET_BYTES, by default
+# MEMORY_BUDGET_FRACTION of the container's memory limit (no limit and no
+# MEMORY_BUDGET_BYTES turns it off). An image that does not fit waits up to
+# ADMISSION_TIMEOUT seconds for running ones to finish and is then nacked,
+# while smaller images that fit keep going. An image bigger than the whole
+# budget runs alone once the images already running are done.
+MEMORY_BUDGET_BYTES = int(os.getenv('MEMORY_BUDGET_BYTES', 0))
+MEMORY_BUDGET_FRACTION = float(os.getenv('MEMORY_BUDGET_FRACTION', 0.7))
+ADMISSION_TIMEOUT = float(os.getenv('ADMISSION_TIMEOUT', 10))
+# Peak bytes per byte of the decoded bitmap: the source, the filtered image
+# and one intermediate
+MEMORY_ESTIMATE_FACTOR = float(os.getenv('MEMORY_ESTIMATE_FACTOR', 3))
+# Bytes per ranged read while looking for the header
+ADMISSION_HEADER_BYTES = int(os.getenv('ADMISSION_HEADER_BYTES', 64 * 1024))
 
 # Initialize clients for Google Cloud services
 storage_client = storage.Client()
@@ -29,9 +128,15 @@ logging.basicConfig(level=logging.INFO)
 
 
 def callback(message):
+    start_peak_rss_window()
+    message_start = time.perf_counter()
+    timings = {}
+    outcome = 'nacked'
+    reserved = 0
     try:
         logging.info(f"Received message: {message.data.decode('utf-8')}")
-        time.sleep(15)  # Add a delay of 15 seconds
+        with stage_timer(timings, 'sleep'):
+            time.sleep(15)  # Add a delay of 15 seconds
         # logging.info("Simulated processing completed.")
         data = message.data.decode('utf-8')
         request_data = json.loads(data)
@@ -41,6 +146,7 @@ def callback(message):
         filters = request_data['filters']
         # email = request_data['email']
         batch_id = request_data['batch_id']
+        encoder_profile = request_data.get('encoder_profile') or ENCODER_PROFILE
 
         # Determine the file extension and MIME type
         file_extension = image_name.split('.')[-1].lower()
@@ -51,99 +157,1732 @@ def callback(message):
         if file_extension not in valid_extensions:
             logging.error(f"Error processing {image_name}: unsupported file extension {file_extension}")
             message.nack()  # Reject message and do not process unsupported image formats
+            outcome = 'rejected'
             return
 
-        # Download the image from Google Cloud Storage
         bucket = storage_client.bucket(BUCKET_NAME)
-        blob = bucket.blob(f'{batch_id}/input/{image_name}')  # Keep the extension in the path
-        logging.info(f"Downloading image from GCS: {batch_id}/input/{image_name}")
-        image_data = blob.download_as_bytes()
-
-        # Apply specified filters
-        logging.info(f"Applying filters: {filters}")
-        processed_image = apply_filters(image_data, filters)
-        logging.info(f"Processed image size: {len(processed_image)} bytes")
-        # Upload the processed image to the output folder in GCS
-        output_bucket = storage_client.bucket(BUCKET_NAME)
-        output_blob = output_bucket.blob(f'{batch_id}/output/{image_name}')  # Keep the extension in the path
-        logging.info(f"Uploading processed image to GCS: {batch_id}/output/{image_name}")
-        output_blob.upload_from_file(io.BytesIO(processed_image), content_type=f'image/{file_extension}')
-
-        # Update the status in the interaction service
-        logging.info(f"Updating image status for doc_id {doc_id} and batch_id {batch_id}")
-        update_image_status_to_interaction_service(doc_id, batch_id)
-
-        message.ack()  # Acknowledge the message after successful processing
+        input_blob_name = f'{batch_id}/input/{image_name}'  # Keep the extension in the path
+        output_blob_name = f'{batch_id}/output/{image_name}'
+        derivatives = parse_derivatives(DERIVATIVES)
+
+        # Look up the input's checksum without downloading it
+        with stage_timer(timings, 'lookup'):
+            blob = bucket.get_blob(input_blob_name)
+        if blob is None:
+            raise FileNotFoundError(f"Input image not found in GCS: {input_blob_name}")
+        cache_key = result_cache_key(blob, filters, derivatives, encoder_profile)
+
+        with stage_timer(timings, 'cache'):
+            served_from_cache = serve_from_result_cache(bucket, cache_key, batch_id, image_name, derivatives)
+        if not served_from_cache and memory_budget is not None:
+            with stage_timer(timings, 'admission'):
+                reserved = admit_decode(blob, filters, derivatives)
+        if served_from_cache:
+            logging.info(f"Served {output_blob_name} from the result cache")
+        elif STREAMING_IO and EXECUTION_MODE != 'process':
+            output_blob = bucket.blob(output_blob_name)
+            logging.info(f"Streaming {input_blob_name} through filters {filters} to {output_blob_name}")
+            outputs = stream_filters(blob, output_blob, filters, derivatives, encoder_profile, timings)
+            metrics.increment('image_processor_bytes_in_total', blob.size or 0)
+            _, content_type = outputs.pop('output')
+            with stage_timer(timings, 'upload'):
+                results = upload_outputs(bucket, batch_id, image_name, outputs)
+            results['output'] = (output_blob, None, content_type)
+            with stage_timer(timings, 'cache'):
+                store_in_result_cache(bucket, cache_key, results)
+        else:
+            # Download the image from Google Cloud Storage
+            logging.info(f"Downloading image from GCS: {input_blob_name}")
+            with stage_timer(timings, 'download'):
+                image_data = blob.download_as_bytes()
+            metrics.increment('image_processor_bytes_in_total', len(image_data))
+
+            # Apply specified filters
+            logging.info(f"Applying filters: {filters}")
+            outputs = run_process_image(image_data, filters, derivatives, encoder_profile, timings)
+            logging.info(f"Processed image size: {len(outputs['output'][0])} bytes")
+            # Upload the processed image and its derivatives to GCS
+            logging.info(f"Uploading processed image to GCS: {output_blob_name}")
+            with stage_timer(timings, 'upload'):
+                results = upload_outputs(bucket, batch_id, image_name, outputs)
+            with stage_timer(timings, 'cache'):
+                store_in_result_cache(bucket, cache_key, results)
+
+        # Update the status in the interaction service. The message is acked
+        # once the status is accepted; until then Pub/Sub holds on to it and
+        # redelivers it if this pod dies.
+        logging.info(f"Queueing image status update for doc_id {doc_id} and batch_id {batch_id}")
+        update_image_status_to_interaction_service(doc_id, batch_id, message)
+        outcome = 'processed'
         logging.info(f"Successfully processed message for {image_name}")
 
+    except PermanentImageError as e:
+        logging.error(f"Rejecting message, it cannot be processed: {e}")
+        # Redelivering it would fail the same way, so the image is reported
+        # failed and the message acked once the interaction service has that
+        update_image_status_to_interaction_service(doc_id, batch_id, message, error=str(e))
+        outcome = 'rejected'
+    except AdmissionDeferred as e:
+        logging.info(f"Deferring message: {e}")
+        message.nack()  # Redelivered once running images have freed memory
+        outcome = 'deferred'
     except Exception as e:
         logging.error(f"Error processing message: {e}")
         message.nack()  # Return the message to the queue if processing fails
+    finally:
+        if reserved:
+            memory_budget.release(reserved)
+        timings['message'] = time.perf_counter() - message_start
+        record_message_metrics(timings, outcome)
+        logging.info("Stage timings: " + ', '.join(f"{stage} {seconds:.3f}s" for stage, seconds in timings.items()))
+        peak_rss, concurrent_messages = end_peak_rss_window()
+        logging.info(f"Peak RSS while handling message: {peak_rss / (1024 * 1024):.1f} MiB "
+                     f"({concurrent_messages} messages in flight)")
 
 
-def apply_filters(image_data, filters):
-    logging.info(f"Starting image filter application")
-    # Open the image
-    image = Image.open(io.BytesIO(image_data))
+# Filters that map every pixel value independently of its neighbours. Runs of
+# consecutive point filters are compiled into lookup tables and applied with a
+# single Image.point pass instead of one ImageEnhance pass per filter.
+POINT_FILTERS = ['brightness', 'contrast', 'grayscale']
+FUSABLE_MODES = ['L', 'RGB', 'RGBA']
+FUSE_POINT_FILTERS = os.getenv('FUSE_POINT_FILTERS', 'true').lower() == 'true'
+
+RESIZE_FILTERS = ['resize', 'thumbnail']
+# Move downscales to the front of the pipeline where that does not change the
+# result beyond rounding
+HOIST_RESIZE = os.getenv('HOIST_RESIZE', 'true').lower() == 'true'
+DRAFT_REDUCING_GAP = float(os.getenv('DRAFT_REDUCING_GAP', 2.0))
+# Largest output a resize may ask for. Bigger targets are rejected rather than
+# allocated, as they would take the pod down on every redelivery.
+MAX_OUTPUT_PIXELS = int(os.getenv('MAX_OUTPUT_PIXELS', Image.MAX_IMAGE_PIXELS))
+
+
+class PermanentImageError(ValueError):
+    # A job that fails the same way however often it is retried, so its
+    # message is acked instead of nacked
+    pass
+
+# ITU-R 601-2 luma weights in the fixed point form Pillow uses for convert('L')
+LUMA_WEIGHTS = (19595, 38470, 7471)
+IDENTITY_RAMP = Image.frombytes('L', (256, 1), bytes(range(256)))
+
+# Images with at least this many pixels run brightness, contrast, grayscale
+# and blur strip by strip, so filter intermediates stay within one strip
+TILED_PIXEL_THRESHOLD = int(os.getenv('TILED_PIXEL_THRESHOLD', 24000000))
+TILE_STRIP_ROWS = int(os.getenv('TILE_STRIP_ROWS', 256))
+
+
+def compile_filters(filters):
+    # Group the filter list into stages: ('point', [filters...]) for a run of
+    # consecutive point filters, ('filter', filter_info) for everything else
+    stages = []
+    for filter_info in filters:
+        if filter_info['filter_type'] in POINT_FILTERS:
+            if stages and stages[-1][0] == 'point':
+                stages[-1][1].append(filter_info)
+            else:
+                stages.append(('point', [filter_info]))
+        else:
+            stages.append(('filter', filter_info))
+    return stages
+
+
+def apply_filter(image, filter_info):
+    filter_type = filter_info['filter_type']
+    filter_value = filter_info['filter_value']
+
+    logging.info(f"Applying filter: {filter_type} with value {filter_value}")
+    if filter_type == 'rotate':
+        image = image.rotate(int(filter_value))
+    elif filter_type == 'grayscale':
+        image = image.convert('L')
+    elif filter_type == 'blur':
+        image = image.filter(ImageFilter.GaussianBlur(float(filter_value)))
+    elif filter_type == 'brightness':
+        enhancer = ImageEnhance.Brightness(image)
+        image = enhancer.enhance(float(filter_value))
+    elif filter_type == 'contrast':
+        enhancer = ImageEnhance.Contrast(image)
+        image = enhancer.enhance(float(filter_value))
+    elif filter_type in RESIZE_FILTERS:
+        image = image.resize(resize_target(image.size, filter_info), Image.LANCZOS)
+    # Add other filter types as needed
+    return image
 
-    # Apply each filter in sequence
+
+def parse_size(value):
+    # Width and height requested by a resize/thumbnail value: 'WxH', or
+    # {'width': W, 'height': H} as sent by the frontend. A missing side is
+    # None.
+    if isinstance(value, dict):
+        width, height = value.get('width'), value.get('height')
+    else:
+        width, _, height = str(value).lower().partition('x')
+    return int(width) if width else None, int(height) if height else None
+
+
+def resize_target(size, filter_info):
+    # Output size of a resize or thumbnail filter for an input of the given
+    # size. resize takes 'WxH', a {'width', 'height'} object where a missing
+    # side keeps the aspect ratio, or a scale factor such as '0.5'.
+    # thumbnail takes a bounding box in the same forms, or 'N' for N x N, and
+    # keeps the aspect ratio without ever enlarging.
+    width, height = size
+    value = filter_info['filter_value']
+    if filter_info['filter_type'] == 'thumbnail':
+        if not isinstance(value, dict) and 'x' not in str(value).lower():
+            value = f'{value}x{value}'
+        box_width, box_height = parse_size(value)
+        scale = min(box_width / width if box_width else 1, box_height / height if box_height else 1, 1)
+    elif isinstance(value, dict) or 'x' in str(value).lower():
+        target_width, target_height = parse_size(value)
+        if target_width and target_height:
+            return check_output_size((target_width, target_height))
+        if not target_width and not target_height:
+            return size
+        scale = target_width / width if target_width else target_height / height
+    else:
+        scale = float(value)
+    return check_output_size((max(1, round(width * scale)), max(1, round(height * scale))))
+
+
+def check_output_size(target):
+    if target[0] * target[1] > MAX_OUTPUT_PIXELS:
+        raise PermanentImageError(f"Resize to {target[0]}x{target[1]} exceeds {MAX_OUTPUT_PIXELS} pixels")
+    return target
+
+
+def plan_resize_filters(filters, size, hoist):
+    # Rewrite resize/thumbnail filters as explicit 'WxH' resizes and, when
+    # hoist is set, move each downscale in front of the filters before it
+    # that it commutes with, so they run on fewer pixels: point filters, and
+    # blur when the scale is uniform (its radius is scaled to match). The
+    # result is visually equivalent to the original order, not bit-identical.
+    planned = []
     for filter_info in filters:
+        if filter_info['filter_type'] not in RESIZE_FILTERS:
+            planned.append(filter_info)
+            continue
+
+        target = resize_target(size, filter_info)
+        resize = {'filter_type': 'resize', 'filter_value': f'{target[0]}x{target[1]}'}
+        scale_x, scale_y = target[0] / size[0], target[1] / size[1]
+        uniform = abs(target[0] - size[0] * scale_y) < 1 and abs(target[1] - size[1] * scale_x) < 1
+        position = len(planned)
+        if hoist and target[0] * target[1] < size[0] * size[1]:
+            while position > 0:
+                previous = planned[position - 1]
+                if previous['filter_type'] in POINT_FILTERS:
+                    position -= 1
+                elif previous['filter_type'] == 'blur' and uniform:
+                    planned[position - 1] = {'filter_type': 'blur',
+                                             'filter_value': str(float(previous['filter_value']) * scale_x)}
+                    position -= 1
+                else:
+                    break
+        planned.insert(position, resize)
+        size = target
+    return planned
+
+
+def draft_for_resize(image, target, min_decode_size=None):
+    # JPEG can be decoded at 1/2, 1/4 or 1/8 scale straight from the DCT
+    # coefficients, so a leading downscale never builds the full-size bitmap.
+    # Like Image.thumbnail, keep DRAFT_REDUCING_GAP times the target size for
+    # the final resample.
+    # Only an image that has not been loaded yet still has tiles to decode
+    if image.format != 'JPEG' or not image.tile:
+        return
+    requested = (int(target[0] * DRAFT_REDUCING_GAP), int(target[1] * DRAFT_REDUCING_GAP))
+    if min_decode_size:
+        requested = (max(requested[0], min_decode_size[0]), max(requested[1], min_decode_size[1]))
+    if requested[0] < image.width and requested[1] < image.height:
+        full_size = image.size
+        image.draft(image.mode, requested)
+        logging.info(f"Decoding JPEG at {image.size} instead of {full_size} for resize to {target}")
+
+
+def blend_table(degenerate_level, factor):
+    # Run Pillow's own blend over every possible input value, so the table
+    # reproduces the truncation and clipping of ImageEnhance exactly
+    degenerate = Image.new('L', (256, 1), degenerate_level)
+    return list(Image.blend(degenerate, IDENTITY_RAMP, factor).tobytes())
+
+
+def grey_mean(histogram, luts, pixel_count):
+    # Mean of the image ImageEnhance.Contrast would see, i.e. convert('L') of
+    # the image after the tables built so far, derived from the histogram of
+    # the image before them
+    channel_means = []
+    for band, lut in enumerate(luts):
+        band_histogram = histogram[band * 256:(band + 1) * 256]
+        channel_means.append(sum(count * lut[value] for value, count in enumerate(band_histogram)) / pixel_count)
+    if len(channel_means) == 1:
+        return int(channel_means[0] + 0.5)
+    mean = sum(weight * channel_mean for weight, channel_mean in zip(LUMA_WEIGHTS, channel_means)) / 65536
+    return int(mean + 0.5)
+
+
+def plan_point_stage(mode, point_filters, stage_histogram):
+    # Compile a run of point filters for an image of the given mode into
+    # steps: ('lut', luts) with one table per colour band, or
+    # ('grayscale', None). stage_histogram(steps) must return the histogram
+    # of the stage input after the given steps; it is only called for
+    # contrast, once per grayscale-separated segment.
+    color_bands = 1 if mode == 'L' else 3
+    luts = [list(range(256)) for _ in range(color_bands)]
+    steps = []
+    histogram = None
+    changed = False
+
+    for filter_info in point_filters:
         filter_type = filter_info['filter_type']
-        filter_value = filter_info['filter_value']
+        if filter_type == 'grayscale':
+            if mode != 'L':
+                if changed:
+                    steps.append(('lut', luts))
+                steps.append(('grayscale', None))
+                mode = 'L'
+                luts = [list(range(256))]
+                histogram = None
+                changed = False
+            else:
+                # convert('L') on an 'L' image is a copy; keep the same contract
+                changed = True
+            continue
+
+        factor = float(filter_info['filter_value'])
+        if filter_type == 'brightness':
+            table = blend_table(0, factor)
+        else:
+            if histogram is None:
+                histogram = stage_histogram(steps)
+            table = blend_table(grey_mean(histogram, luts, sum(histogram[:256])), factor)
+        luts = [[table[value] for value in lut] for lut in luts]
+        changed = True
+
+    if changed:
+        steps.append(('lut', luts))
+    return steps
+
 
-        logging.info(f"Applying filter: {filter_type} with value {filter_value}")
-        if filter_type == 'rotate':
-            image = image.rotate(int(filter_value))
-        elif filter_type == 'grayscale':
+def apply_point_steps(image, steps):
+    for step_type, luts in steps:
+        if step_type == 'grayscale':
             image = image.convert('L')
-        elif filter_type == 'blur':
-            image = image.filter(ImageFilter.GaussianBlur(float(filter_value)))
-        elif filter_type == 'brightness':
-            enhancer = ImageEnhance.Brightness(image)
-            image = enhancer.enhance(float(filter_value))
-        elif filter_type == 'contrast':
-            enhancer = ImageEnhance.Contrast(image)
-            image = enhancer.enhance(float(filter_value))
-        # Add other filter types as needed
+        else:
+            image = point_with_luts(image, luts)
+    return image
 
-    # Save the processed image to bytes
-    output_io = io.BytesIO()
-    logging.info(f"image format {image.format}")
-    # Ensure the processed image is saved in the correct format
-    if image.format in ['JPEG', 'JPG']:
-        image.save(output_io, format='JPEG')
-    elif image.format == 'PNG':
-        image.save(output_io, format='PNG')
+
+def apply_point_stage(image, point_filters):
+    # Fused equivalent of applying point_filters one by one with apply_filter.
+    #
+    # Brightness and grayscale are bit-identical to the unfused path, as is
+    # contrast on 'L' images. For contrast on colour images the grey mean is
+    # computed from per-channel histograms rather than from a converted copy
+    # of the image, which can move it by one level; each such contrast step
+    # can then shift a pixel by at most ceil(|1 - factor|) levels, scaled by
+    # any brightness/contrast factor applied after it in the same run.
+    if image.mode not in FUSABLE_MODES:
+        for filter_info in point_filters:
+            image = apply_filter(image, filter_info)
+        return image
+
+    logging.info(f"Applying fused point filters: {point_filters}")
+    # Keep the image after the steps needed for a histogram, so the final
+    # pass does not redo them
+    intermediate = {'image': image, 'steps': 0}
+
+    def stage_histogram(steps):
+        intermediate['image'] = apply_point_steps(intermediate['image'], steps[intermediate['steps']:])
+        intermediate['steps'] = len(steps)
+        return intermediate['image'].histogram()
+
+    steps = plan_point_stage(image.mode, point_filters, stage_histogram)
+    return apply_point_steps(intermediate['image'], steps[intermediate['steps']:])
+
+
+def point_with_luts(image, luts):
+    lut = []
+    for band_lut in luts:
+        lut.extend(band_lut)
+    if image.mode == 'RGBA':
+        # Brightness and contrast leave alpha untouched
+        lut.extend(range(256))
+    return image.point(lut)
+
+
+def blur_halo(radius):
+    # Rows a Gaussian blur reads beyond the rows it writes. Pillow
+    # approximates it with three box blurs of radius at most floor(radius) + 1
+    # each, so a strip with this much overlap blurs exactly like the full image.
+    return 3 * (int(radius) + 1)
+
+
+def strips(height, halo):
+    # (top, bottom, halo_top, halo_bottom) row ranges covering the image
+    for top in range(0, height, TILE_STRIP_ROWS):
+        bottom = min(top + TILE_STRIP_ROWS, height)
+        yield top, bottom, max(0, top - halo), min(height, bottom + halo)
+
+
+def tiled_histogram(image, steps):
+    # Histogram of the image after the given point steps, built strip by strip
+    if not steps:
+        return image.histogram()
+    histogram = None
+    for top, bottom, _, _ in strips(image.height, 0):
+        strip_histogram = apply_point_steps(image.crop((0, top, image.width, bottom)), steps).histogram()
+        if histogram is None:
+            histogram = strip_histogram
+        else:
+            histogram = [total + count for total, count in zip(histogram, strip_histogram)]
+    return histogram
+
+
+def run_tiled_segment(image, operations):
+    # Plan the point stages against the whole segment input, then run every
+    # operation on each strip (plus the blur halo) and paste the rows it owns
+    # into the output, so intermediates never exceed one strip
+    planned = []
+    mode = image.mode
+    for operation_type, operation in operations:
+        if operation_type == 'point':
+            steps = plan_point_stage(mode, operation, lambda steps: tiled_histogram(image, steps))
+            if any(step_type == 'grayscale' for step_type, _ in steps):
+                mode = 'L'
+            planned.append(('point', steps))
+        else:
+            planned.append(('blur', operation))
+
+    halo = sum(blur_halo(operation) for operation_type, operation in planned if operation_type == 'blur')
+    logging.info(f"Applying {operations} in strips of {TILE_STRIP_ROWS} rows with a {halo} row halo")
+    output = Image.new(mode, image.size)
+    for top, bottom, halo_top, halo_bottom in strips(image.height, halo):
+        strip = image.crop((0, halo_top, image.width, halo_bottom))
+        for operation_type, operation in planned:
+            if operation_type == 'point':
+                strip = apply_point_steps(strip, operation)
+            else:
+                strip = strip.filter(ImageFilter.GaussianBlur(operation))
+        output.paste(strip.crop((0, top - halo_top, image.width, bottom - halo_top)), (0, top))
+    return output
+
+
+def run_filters_tiled(image, filters):
+    # Tiled equivalent of run_filters with fused point filters; output is
+    # pixel for pixel the same. Consecutive point and blur stages are
+    # collected into segments of ('point', filters) and ('blur', radius)
+    # operations; anything else runs on the whole image.
+    operations = []
+    mode = image.mode
+    for stage_type, stage in compile_filters(filters):
+        tileable = mode in FUSABLE_MODES and (stage_type == 'point' or stage['filter_type'] == 'blur')
+        if not tileable:
+            if operations:
+                image = run_tiled_segment(image, operations)
+                operations = []
+            image = apply_point_stage(image, stage) if stage_type == 'point' else apply_filter(image, stage)
+            mode = image.mode
+        elif stage_type == 'point':
+            # Contrast needs the histogram of its input. That can be built
+            # strip by strip for a segment's input, but not for an input that
+            # only ever exists one strip at a time, so contrast starts a new
+            # segment.
+            if operations and any(filter_info['filter_type'] == 'contrast' for filter_info in stage):
+                image = run_tiled_segment(image, operations)
+                operations = []
+            operations.append(('point', stage))
+            if any(filter_info['filter_type'] == 'grayscale' for filter_info in stage):
+                mode = 'L'
+        else:
+            operations.append(('blur', float(stage['filter_value'])))
+
+    if operations:
+        image = run_tiled_segment(image, operations)
+    return image
+
+
+def plan_decode(image, filters, min_decode_size=None):
+    # Reorder the filters and, for a leading downscale of a JPEG that is not
+    # loaded yet, pick a reduced decode scale. Returns the planned filters;
+    # planning them again on the decoded image changes nothing.
+    # min_decode_size keeps a reduced-scale decode at least this large, for
+    # callers that need more of the source than the filters do.
+    filters = plan_resize_filters(filters, image.size, HOIST_RESIZE)
+    if filters and filters[0]['filter_type'] == 'resize':
+        draft_for_resize(image, resize_target(image.size, filters[0]), min_decode_size)
+    return filters
+
+
+def run_filters(image, filters, fuse_point_filters=None, tiled=None, min_decode_size=None):
+    filters = plan_decode(image, filters, min_decode_size)
+
+    if fuse_point_filters is None:
+        fuse_point_filters = FUSE_POINT_FILTERS
+    if not fuse_point_filters:
+        for filter_info in filters:
+            image = apply_filter(image, filter_info)
+        return image
+
+    # The tiled engine builds on the fused point stage
+    if tiled is None:
+        tiled = image.width * image.height >= TILED_PIXEL_THRESHOLD
+    if tiled:
+        return run_filters_tiled(image, filters)
+
+    for stage_type, stage in compile_filters(filters):
+        if stage_type == 'point':
+            image = apply_point_stage(image, stage)
+        else:
+            image = apply_filter(image, stage)
+    return image
+
+
+# Save options per profile and output format. fast favours encode time,
+# small favours bytes on the wire, balanced sits in between.
+ENCODER_PROFILES = {
+    'fast': {
+        'JPEG': {'quality': 75},
+        'PNG': {'compress_level': 1},
+        'WEBP': {'quality': 75, 'method': 0}
+    },
+    'balanced': {
+        'JPEG': {'quality': 75, 'optimize': True},
+        'PNG': {'compress_level': 6},
+        'WEBP': {'quality': 75, 'method': 4}
+    },
+    'small': {
+        'JPEG': {'quality': 75, 'optimize': True, 'progressive': True, 'subsampling': '4:2:0'},
+        'PNG': {'optimize': True},
+        'WEBP': {'quality': 75, 'method': 6}
+    }
+}
+FORMAT_CONTENT_TYPES = {'JPEG': 'image/jpeg', 'PNG': 'image/png', 'WEBP': 'image/webp'}
+
+
+def encoder_settings(source_format, profile):
+    # Output format and save options for an image decoded from source_format
+    if profile not in ENCODER_PROFILES:
+        logging.error(f"Unknown encoder profile {profile}, using {ENCODER_PROFILE}")
+        profile = ENCODER_PROFILE
+    if profile == 'small' and ENCODER_WEBP:
+        output_format = 'WEBP'
+    elif source_format in ['JPEG', 'PNG']:
+        output_format = source_format
     else:
-        image.save(output_io, format='PNG')
-        logging.error(f"Unsupported format for saving: {image.format}")
-        # raise ValueError(f"Unsupported format: {image.format}")
-    output_io.seek(0)
+        output_format = 'PNG'
+        logging.error(f"Unsupported format for saving: {source_format}")
+    return output_format, ENCODER_PROFILES[profile][output_format]
+
+
+def save_image(image, output_io, output_format, options):
+    logging.info(f"Saving image as {output_format} with {options}")
+    if output_format == 'JPEG' and image.mode not in ['L', 'RGB', 'CMYK']:
+        image = image.convert('RGB')
+    elif output_format == 'WEBP' and image.mode not in ['RGB', 'RGBA']:
+        image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+    image.save(output_io, format=output_format, **options)
+
+
+def stream_filters(blob, output_blob, filters, derivatives=None, encoder_profile=None, timings=None):
+    # Pillow reads the input through the blob reader as it decodes and
+    # writes the encoded output into the blob writer, which uploads a chunk
+    # at a time; an exception cancels the resumable upload. Derivatives are
+    # small, so they are returned as bytes like in process_image, and
+    # 'output' maps to (None, content_type). Stage timings are recorded as in
+    # process_image, except that decode includes the download and encode
+    # includes the upload of the output.
+    if timings is None:
+        timings = {}
+    logging.info(f"Starting streamed image filter application")
+    derivatives = derivatives or []
+    with blob.open('rb', chunk_size=STREAMING_CHUNK_SIZE) as reader:
+        with stage_timer(timings, 'decode'):
+            source = Image.open(reader)
+            output_format, options = encoder_settings(source.format, encoder_profile or ENCODER_PROFILE)
+            filters = plan_decode(source, filters, derivative_decode_size(source.size, derivatives))
+            source.load()
+        with stage_timer(timings, 'filters'):
+            image = run_filters(source, filters)
+        with stage_timer(timings, 'derivatives'):
+            outputs = make_derivatives(source, 'input', derivatives)
+            outputs.update(make_derivatives(image, 'output', derivatives))
+        content_type = FORMAT_CONTENT_TYPES[output_format]
+        with stage_timer(timings, 'encode'):
+            with output_blob.open('wb', chunk_size=STREAMING_CHUNK_SIZE, ignore_flush=True,
+                                  content_type=content_type) as writer:
+                save_image(image, writer, output_format, options)
+                metrics.increment('image_processor_bytes_out_total', writer.tell())
+    outputs['output'] = (None, content_type)
     logging.info(f"Finished applying filters")
-    return output_io.getvalue()
+    return outputs
+
+
+def process_image(image_data, filters, derivatives, encoder_profile=None, timings=None):
+    # Decode once, apply the filters and encode the output along with the
+    # derivatives of both the input and the output. Returns
+    # {'output' or 'derivatives/{name}/{input|output}': (bytes, content_type)}.
+    # Seconds spent on decode, filters, derivatives and encode are added to
+    # timings if given.
+    if timings is None:
+        timings = {}
+    logging.info(f"Starting image filter application")
+    with stage_timer(timings, 'decode'):
+        # Open the image
+        source = Image.open(io.BytesIO(image_data))
+        # Filters drop image.format, so decide the output format from the source
+        output_format, options = encoder_settings(source.format, encoder_profile or ENCODER_PROFILE)
+        # Decode up front, after choosing the decode scale, so decode and
+        # filter time can be told apart
+        filters = plan_decode(source, filters, derivative_decode_size(source.size, derivatives))
+        source.load()
+
+    # Apply the filters, fusing consecutive point filters into one pass
+    with stage_timer(timings, 'filters'):
+        image = run_filters(source, filters)
+    with stage_timer(timings, 'derivatives'):
+        derivative_outputs = make_derivatives(source, 'input', derivatives)
+        derivative_outputs.update(make_derivatives(image, 'output', derivatives))
+
+    # Save the processed image to bytes
+    with stage_timer(timings, 'encode'):
+        output_io = io.BytesIO()
+        save_image(image, output_io, output_format, options)
+    outputs = {'output': (output_io.getvalue(), FORMAT_CONTENT_TYPES[output_format])}
+    outputs.update(derivative_outputs)
+    logging.info(f"Finished applying filters")
+    return outputs
+
+
+def apply_filters(image_data, filters):
+    return process_image(image_data, filters, [])['output'][0]
+
+
+def parse_derivatives(spec):
+    # 'thumbnail:256,preview:1024' -> [('thumbnail', 256), ('preview', 1024)]
+    derivatives = []
+    for entry in spec.split(','):
+        if entry.strip():
+            name, _, box = entry.partition(':')
+            derivatives.append((name.strip(), int(box)))
+    return derivatives
+
+
+def derivative_suffixes(derivatives):
+    return [f'derivatives/{name}/{kind}' for name, _ in derivatives for kind in ['input', 'output']]
+
+
+def derivative_decode_size(size, derivatives):
+    # Smallest decode that still yields the largest input derivative
+    if not derivatives:
+        return None
+    box = max(box for _, box in derivatives)
+    return resize_target(size, {'filter_type': 'thumbnail', 'filter_value': str(box)})
+
+
+def make_derivatives(image, kind, derivatives):
+    # Downscale largest first, so each smaller derivative is resampled from
+    # the previous one rather than from the full-size image
+    derivative_outputs = {}
+    if derivatives and image.mode not in ['L', 'RGB', 'RGBA']:
+        image = image.convert('RGBA' if 'transparency' in image.info or image.mode.endswith('A') else 'RGB')
+    for name, box in sorted(derivatives, key=lambda derivative: derivative[1], reverse=True):
+        target = resize_target(image.size, {'filter_type': 'thumbnail', 'filter_value': str(box)})
+        if target != image.size:
+            image = image.resize(target, Image.LANCZOS, reducing_gap=3.0)
+        output_io = io.BytesIO()
+        if image.mode == 'RGBA':
+            image.save(output_io, format='PNG')
+            content_type = 'image/png'
+        else:
+            image.save(output_io, format='JPEG', quality=DERIVATIVE_JPEG_QUALITY)
+            content_type = 'image/jpeg'
+        derivative_outputs[f'derivatives/{name}/{kind}'] = (output_io.getvalue(), content_type)
+    return derivative_outputs
+
+
+def upload_outputs(bucket, batch_id, image_name, outputs):
+    # Upload {suffix: (bytes, content_type)} to {batch_id}/{suffix}/{image_name}.
+    # Returns {suffix: (blob, bytes, content_type)} for the result cache.
+    results = {}
+    for suffix, (data, content_type) in outputs.items():
+        blob = bucket.blob(f'{batch_id}/{suffix}/{image_name}')
+        logging.info(f"Uploading {blob.name} ({len(data)} bytes)")
+        blob.upload_from_file(io.BytesIO(data), content_type=content_type)
+        metrics.increment('image_processor_bytes_out_total', len(data))
+        results[suffix] = (blob, data, content_type)
+    return results
+
+
+process_pool = None
+process_pool_lock = threading.Lock()
+
+
+def get_process_pool():
+    global process_pool
+    with process_pool_lock:
+        if process_pool is None:
+            # Spawn rather than fork: the parent already holds gRPC channels
+            # for the subscriber, which are not fork safe
+            logging.info(f"Starting process pool with {PROCESS_POOL_SIZE} workers")
+            process_pool = ProcessPoolExecutor(max_workers=PROCESS_POOL_SIZE,
+                                               mp_context=multiprocessing.get_context('spawn'))
+        return process_pool
+
+
+def reset_process_pool(broken_pool):
+    global process_pool
+    with process_pool_lock:
+        if process_pool is broken_pool:
+            process_pool = None
+    broken_pool.shutdown(wait=False)
+
 
+def timed_process_image(image_data, filters, derivatives, encoder_profile):
+    # Process pool entry point; stage timings measured in a worker are
+    # returned along with the outputs
+    timings = {}
+    outputs = process_image(image_data, filters, derivatives, encoder_profile, timings)
+    return outputs, timings
 
-def update_image_status_to_interaction_service(doc_id, batch_id):
+
+def run_process_image(image_data, filters, derivatives, encoder_profile=None, timings=None):
+    # Run the CPU-bound decode/filter/encode in the configured execution mode.
+    # GCS I/O and ack/nack stay on the calling callback thread either way.
+    if EXECUTION_MODE != 'process':
+        return process_image(image_data, filters, derivatives, encoder_profile, timings)
+
+    pool = get_process_pool()
     try:
-        logging.info(f"Sending status update to Interaction Pod for doc_id {doc_id}, batch_id {batch_id}")
-        response = requests.get(f'{INTERACTION_POD_URL}/update_image_status?doc_id={doc_id}&batch_id={batch_id}')
-        response.raise_for_status()
-        logging.info(f"Successfully updated image status for doc_id {doc_id} and batch_id {batch_id}")
-    except requests.exceptions.RequestException as e:
-        logging.error(f"Error updating status: {e}")
+        start = time.perf_counter()
+        outputs, worker_timings = pool.submit(timed_process_image, image_data, filters, derivatives,
+                                              encoder_profile).result()
+        if timings is not None:
+            timings.update(worker_timings)
+            # Waiting for a free worker plus pickling the image both ways
+            timings['pool_wait'] = time.perf_counter() - start - sum(worker_timings.values())
+        return outputs
+    except BrokenProcessPool:
+        # A worker died (e.g. OOM killed); replace the pool for later messages
+        logging.error("Process pool worker died, restarting the pool")
+        reset_process_pool(pool)
+        raise
 
 
-if __name__ == '__main__':
-    # Set up a subscription path and listen for messages
+class AdmissionDeferred(Exception):
+    # The image does not fit in the memory budget right now
+    pass
+
+
+# Bytes per pixel Pillow allocates for a mode; every other mode is stored
+# in 4 bytes per pixel
+MODE_PIXEL_BYTES = {'1': 1, 'L': 1, 'P': 1, 'I;16': 2, 'I;16L': 2, 'I;16B': 2}
+
+
+def read_memory_limit():
+    # The container's memory limit in bytes from cgroup v2 or v1, or None
+    for path in ['/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes']:
+        try:
+            with open(path) as limit_file:
+                value = limit_file.read().strip()
+        except OSError:
+            continue
+        # cgroup v1 reports no limit as a number close to 2^63
+        if value != 'max' and int(value) < 2 ** 60:
+            return int(value)
+        return None
+    return None
+
+
+class MemoryBudget:
+    # Pod-wide budget of decoded image bytes. Reservations are not queued in
+    # order: whatever fits when memory is freed goes first, so small images
+    # keep flowing past a large one that is waiting. An image bigger than
+    # the whole budget runs alone: it takes all of it once nothing else is
+    # running, and no new reservation starts while it waits for that.
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.reserved = 0
+        self.waiting_alone = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, nbytes, timeout):
+        # Returns the bytes reserved for nbytes within timeout seconds, to be
+        # released later, or 0 if they could not be
+        with self.condition:
+            if nbytes > self.capacity:
+                self.waiting_alone += 1
+                try:
+                    admitted = self.condition.wait_for(lambda: self.reserved == 0, timeout)
+                finally:
+                    self.waiting_alone -= 1
+                    self.condition.notify_all()
+                nbytes = self.capacity
+            else:
+                admitted = self.condition.wait_for(
+                    lambda: not self.waiting_alone and self.reserved + nbytes <= self.capacity, timeout)
+            if not admitted:
+                return 0
+            self.reserved += nbytes
+            return nbytes
+
+    def release(self, nbytes):
+        with self.condition:
+            self.reserved -= nbytes
+            self.condition.notify_all()
+
+
+def get_memory_budget():
+    capacity = MEMORY_BUDGET_BYTES
+    if not capacity:
+        memory_limit = read_memory_limit()
+        capacity = int(memory_limit * MEMORY_BUDGET_FRACTION) if memory_limit else 0
+    if not capacity:
+        return None
+    logging.info(f"Admitting decodes within a memory budget of {capacity // (1024 * 1024)} MiB")
+    return MemoryBudget(capacity)
+
+
+def estimate_decode_bytes(image_file, filters, derivatives):
+    # Peak bytes of decoding and filtering the image, from its header alone:
+    # the planned decode size (a JPEG drafted for a leading downscale is
+    # decoded smaller) or the largest resize after it, whichever is bigger.
+    # Images big enough for the tiled engine hold the source and the output
+    # in full, but their filter intermediates only a strip at a time.
+    image = Image.open(image_file)
+    filters = plan_decode(image, filters, derivative_decode_size(image.size, derivatives))
+    pixel_bytes = MODE_PIXEL_BYTES.get(image.mode, 4)
+    size = image.size
+    largest = size[0] * size[1]
+    for filter_info in filters:
+        if filter_info['filter_type'] == 'resize':
+            size = resize_target(size, filter_info)
+            largest = max(largest, size[0] * size[1])
+    if FUSE_POINT_FILTERS and image.width * image.height >= TILED_PIXEL_THRESHOLD:
+        strip_pixels = image.width * TILE_STRIP_ROWS
+        return int((2 * largest + MEMORY_ESTIMATE_FACTOR * strip_pixels) * pixel_bytes)
+    return int(largest * pixel_bytes * MEMORY_ESTIMATE_FACTOR)
+
+
+def admit_decode(blob, filters, derivatives):
+    # Reserves the blob's estimated decode footprint, reading only as much
+    # of it as the header takes. Returns the bytes to release once the
+    # message is done.
+    with blob.open('rb', chunk_size=ADMISSION_HEADER_BYTES) as reader:
+        estimate = estimate_decode_bytes(reader, filters, derivatives)
+    reserved = memory_budget.acquire(estimate, ADMISSION_TIMEOUT)
+    if not reserved:
+        raise AdmissionDeferred(f"{blob.name} needs about {estimate // (1024 * 1024)} MiB, "
+                                f"{memory_budget.reserved // (1024 * 1024)} MiB of "
+                                f"{memory_budget.capacity // (1024 * 1024)} MiB reserved")
+    if estimate > reserved:
+        logging.info(f"{blob.name} needs about {estimate // (1024 * 1024)} MiB, more than the whole budget, "
+                     f"running it alone")
+    return reserved
+
+
+def get_flow_control():
+    if EXECUTION_MODE == 'process':
+        return pubsub_v1.types.FlowControl(max_messages=PROCESS_POOL_SIZE * LEASED_MESSAGES_PER_WORKER)
+    return pubsub_v1.types.FlowControl()
+
+
+class LeaseCountingScheduler(ThreadScheduler):
+    # Counts messages the subscriber has handed over whose callback has not
+    # finished, including those still waiting for a callback thread
+
+    def __init__(self, executor=None):
+        super().__init__(executor)
+        self.leased = 0
+        self.leased_lock = threading.Lock()
+
+    def schedule(self, callback, *args, **kwargs):
+        with self.leased_lock:
+            self.leased += 1
+        # shutdown expects the message to stay the first argument
+        super().schedule(functools.partial(self.run_leased, callback), *args, **kwargs)
+
+    def run_leased(self, callback, *args, **kwargs):
+        try:
+            callback(*args, **kwargs)
+        finally:
+            with self.leased_lock:
+                self.leased -= 1
+
+    def shutdown(self, await_msg_callbacks=False):
+        # Messages dropped from the queue never reach run_leased
+        dropped_messages = super().shutdown(await_msg_callbacks)
+        with self.leased_lock:
+            self.leased -= len(dropped_messages)
+        return dropped_messages
+
+
+def get_scheduler(flow_control):
+    if EXECUTION_MODE == 'process':
+        # One I/O thread per leased message, each blocks on its pool future
+        return LeaseCountingScheduler(ThreadPoolExecutor(max_workers=flow_control.max_messages))
+    return LeaseCountingScheduler()
+
+
+def parse_lanes(spec):
+    # [(lane, max_images)] from 'small:10,medium:200,large'; the last lane
+    # takes batches of any size
+    lanes = []
+    for entry in filter(None, (entry.strip() for entry in spec.split(','))):
+        name, _, max_images = entry.partition(':')
+        lanes.append((name, int(max_images) if max_images else None))
+    return lanes
+
+
+def lane_for_batch(lanes, image_count):
+    for name, max_images in lanes:
+        if max_images is None or image_count <= max_images:
+            return name
+    return lanes[-1][0]
+
+
+class LaneQueues:
+    # Messages waiting for a worker, by lane and then by batch. Not
+    # thread-safe; FairScheduler and the scheduling simulation drive it.
+
+    def __init__(self, lanes, max_wait):
+        self.lanes = lanes
+        self.max_wait = max_wait
+        # lane -> OrderedDict of batch_id -> deque of (queued at, item), with
+        # the batch whose turn it is first
+        self.queues = {lane: OrderedDict() for lane in lanes}
+        self.depths = dict.fromkeys(lanes, 0)
+        # Since when each lane with items has gone without a worker
+        self.waiting_since = {}
+
+    def add(self, lane, batch_id, item, now):
+        self.queues[lane].setdefault(batch_id, deque()).append((now, item))
+        self.depths[lane] += 1
+        self.waiting_since.setdefault(lane, now)
+
+    def oldest(self, lane):
+        # When the lane's longest waiting item was queued; batches are FIFO,
+        # so it is at the head of one of them
+        return min((items[0][0] for items in self.queues[lane].values()), default=None)
+
+    def pop(self, now):
+        # Next (lane, item): from the lane that has gone longest without a
+        # worker if that is max_wait or more, else from the highest priority
+        # lane with items. None when nothing is waiting.
+        waiting = [lane for lane in self.lanes if self.depths[lane]]
+        if not waiting:
+            return None
+        starved = [(self.waiting_since[lane], lane) for lane in waiting
+                   if now - self.waiting_since[lane] >= self.max_wait]
+        lane = min(starved)[1] if starved else waiting[0]
+        batches = self.queues[lane]
+        batch_id, items = next(iter(batches.items()))
+        _, item = items.popleft()
+        # The batch goes behind the others of its lane
+        del batches[batch_id]
+        if items:
+            batches[batch_id] = items
+        self.depths[lane] -= 1
+        if self.depths[lane]:
+            self.waiting_since[lane] = now
+        else:
+            del self.waiting_since[lane]
+        return lane, item
+
+    def remove_lane(self, lane):
+        items = [item for batch in self.queues[lane].values() for _, item in batch]
+        self.queues[lane].clear()
+        self.depths[lane] = 0
+        self.waiting_since.pop(lane, None)
+        return items
+
+
+def message_batch_id(message):
+    try:
+        return json.loads(message.data.decode('utf-8'))['batch_id']
+    except Exception:
+        # The callback rejects it; it only needs a turn
+        return None
+
+
+class FairScheduler:
+    # Runs the callbacks of every lane's messages on shared worker threads,
+    # in the order LaneQueues picks. Each lane's subscriber gets a
+    # LaneScheduler feeding it.
+
+    def __init__(self, lanes, workers, max_wait):
+        self.queues = LaneQueues(lanes, max_wait)
+        self.condition = threading.Condition()
+        self.running = 0
+        for _ in range(workers):
+            threading.Thread(target=self.work, daemon=True).start()
+
+    def lane_scheduler(self, lane):
+        return LaneScheduler(self, lane)
+
+    def add(self, lane, callback, message):
+        with self.condition:
+            self.queues.add(lane, message_batch_id(message), (callback, message), time.monotonic())
+            self.condition.notify()
+
+    def work(self):
+        while True:
+            with self.condition:
+                picked = self.queues.pop(time.monotonic())
+                while picked is None:
+                    self.condition.wait()
+                    picked = self.queues.pop(time.monotonic())
+                self.running += 1
+            lane, (callback, message) = picked
+            try:
+                callback(message)
+            except Exception as e:
+                logging.error(f"Error in callback of a {lane} lane message: {e}")
+            finally:
+                with self.condition:
+                    self.running -= 1
+
+    def remove_lane(self, lane):
+        with self.condition:
+            return [message for _, message in self.queues.remove_lane(lane)]
+
+    @property
+    def leased(self):
+        with self.condition:
+            return sum(self.queues.depths.values()) + self.running
+
+    def lane_depths(self):
+        with self.condition:
+            return {(('lane', lane),): depth for lane, depth in self.queues.depths.items()}
+
+    def lane_oldest_waits(self):
+        now = time.monotonic()
+        with self.condition:
+            return {(('lane', lane),): now - oldest if oldest is not None else 0
+                    for lane, oldest in ((lane, self.queues.oldest(lane)) for lane in self.queues.lanes)}
+
+
+class LaneScheduler(Scheduler):
+    # The scheduler of one lane's subscriber, handing its messages to the
+    # shared FairScheduler
+
+    def __init__(self, fair_scheduler, lane):
+        self.fair_scheduler = fair_scheduler
+        self.lane = lane
+        self._queue = queue.Queue()
+
+    @property
+    def queue(self):
+        return self._queue
+
+    def schedule(self, callback, *args, **kwargs):
+        self.fair_scheduler.add(self.lane, functools.partial(callback, **kwargs), *args)
+
+    def shutdown(self, await_msg_callbacks=False):
+        # Messages not yet handed to a worker go back to the subscriber
+        return self.fair_scheduler.remove_lane(self.lane)
+
+
+class ResultCache:
+    # Thread-safe LRU of processed results bounded by entry count and total
+    # size in bytes, with hit/miss/eviction counters
+
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, size=None):
+        if size is None:
+            size = len(value)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[1]
+            self.entries[key] = (value, size)
+            self.size += size
+            while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+                self.evictions += 1
+
+    def record_hit(self):
+        with self.lock:
+            self.hits += 1
+
+    def record_miss(self):
+        with self.lock:
+            self.misses += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self.entries),
+                'bytes': self.size
+            }
+
+
+result_cache = ResultCache(RESULT_CACHE_MAX_ENTRIES, RESULT_CACHE_MAX_BYTES)
+
+
+def canonical_filters(filters):
+    # Same filters in the same order give the same string, however the
+    # values were typed in the request (1.5 vs "1.5", object key order)
+    return json.dumps([{'filter_type': filter_info['filter_type'],
+                        'filter_value': canonical_filter_value(filter_info['filter_value'])}
+                       for filter_info in filters],
+                      sort_keys=True, separators=(',', ':'))
+
+
+def canonical_filter_value(value):
+    if isinstance(value, str):
+        return value
+    return json.dumps(value, sort_keys=True, separators=(',', ':'))
+
+
+def result_cache_key(blob, filters, derivatives, encoder_profile):
+    # GCS already stores a checksum of every object, so the input bytes can
+    # be identified without downloading them. Composite objects have no MD5
+    # hash, but always have a CRC32C one.
+    content_hash = blob.md5_hash or f'crc32c:{blob.crc32c}'
+    key_source = (f'{content_hash}:{blob.size}:{canonical_filters(filters)}:fused={FUSE_POINT_FILTERS}'
+                  f':derivatives={derivatives}:encoder={encoder_profile}:webp={ENCODER_WEBP}')
+    return hashlib.sha256(key_source.encode('utf-8')).hexdigest()
+
+
+def serve_from_result_cache(bucket, cache_key, batch_id, image_name, derivatives):
+    if RESULT_CACHE_MODE == 'gcs':
+        try:
+            for suffix in ['output'] + derivative_suffixes(derivatives):
+                bucket.copy_blob(bucket.blob(f'{RESULT_CACHE_PREFIX}/{cache_key}/{suffix}'), bucket,
+                                 f'{batch_id}/{suffix}/{image_name}')
+        except NotFound:
+            result_cache.record_miss()
+            logging.info(f"Result cache miss for {cache_key}: {result_cache.stats()}")
+            return False
+        result_cache.record_hit()
+        logging.info(f"Result cache hit for {cache_key}: {result_cache.stats()}")
+        return True
+
+    if RESULT_CACHE_MODE == 'local':
+        outputs = result_cache.get(cache_key)
+        logging.info(f"Result cache {'miss' if outputs is None else 'hit'} for {cache_key}: "
+                     f"{result_cache.stats()}")
+        if outputs is None:
+            return False
+        upload_outputs(bucket, batch_id, image_name, outputs)
+        return True
+
+    return False
+
+
+def store_in_result_cache(bucket, cache_key, results):
+    # results is {suffix: (uploaded blob, bytes or None, content_type)}
+    try:
+        if RESULT_CACHE_MODE == 'gcs':
+            for suffix, (blob, _, _) in results.items():
+                bucket.copy_blob(blob, bucket, f'{RESULT_CACHE_PREFIX}/{cache_key}/{suffix}')
+        elif RESULT_CACHE_MODE == 'local' and all(data is not None for _, data, _ in results.values()):
+            # Streamed outputs never exist as bytes in this process
+            outputs = {suffix: (data, content_type) for suffix, (_, data, content_type) in results.items()}
+            result_cache.put(cache_key, outputs, size=sum(len(data) for data, _ in outputs.values()))
+    except Exception as e:
+        # The outputs are already uploaded; a failed cache write only costs a later recompute
+        logging.error(f"Error storing result in cache: {e}")
+
+
+messages_in_flight = 0
+messages_in_flight_lock = threading.Lock()
+
+
+def read_peak_rss():
+    # Peak resident set size of this process in bytes
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def reset_peak_rss():
+    # Linux lets a process reset its peak RSS so later readings only cover
+    # what happened after this point
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except OSError:
+        pass
+
+
+def start_peak_rss_window():
+    global messages_in_flight
+    with messages_in_flight_lock:
+        messages_in_flight += 1
+        # Only reset when no other message is being measured
+        if messages_in_flight == 1:
+            reset_peak_rss()
+
+
+def end_peak_rss_window():
+    # Returns the process's peak RSS since the in-flight count last rose from
+    # zero, and how many messages were in flight; process pool workers are
+    # not included
+    global messages_in_flight
+    with messages_in_flight_lock:
+        concurrent_messages = messages_in_flight
+        messages_in_flight -= 1
+    return read_peak_rss(), concurrent_messages
+
+
+# Upper bounds in seconds of the stage latency histogram buckets. The message
+# stage includes the 15 second delay; the status stage runs from queueing the
+# update to acking the message.
+STAGE_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 15, 20, 30, 60, 120]
+STAGE_QUANTILES = [0.5, 0.95, 0.99]
+METRIC_DESCRIPTIONS = {
+    'image_processor_messages_total': ('counter', 'Messages handled, by outcome'),
+    'image_processor_status_updates_total': ('counter', 'Image status updates sent to the interaction service, by result'),
+    'image_processor_status_updates_pending': ('gauge', 'Image status updates waiting to be sent'),
+    'image_processor_bytes_in_total': ('counter', 'Input image bytes read from GCS'),
+    'image_processor_bytes_out_total': ('counter', 'Output and derivative bytes written to GCS'),
+    'image_processor_messages_in_flight': ('gauge', 'Messages whose callback is running'),
+    'image_processor_messages_leased': ('gauge', 'Leased messages, running or waiting for a callback thread'),
+    'image_processor_lease_limit': ('gauge', 'Most messages the subscriber leases at once'),
+    'image_processor_lane_queue_depth': ('gauge', 'Leased messages waiting for a worker, by scheduling lane'),
+    'image_processor_lane_oldest_wait_seconds': ('gauge', 'Seconds the oldest waiting message of each lane has waited'),
+    'image_processor_memory_budget_bytes': ('gauge', 'Decoded image bytes the pod admits at once'),
+    'image_processor_memory_reserved_bytes': ('gauge', 'Decoded image bytes reserved by running messages')
+}
+
+
+def format_labels(labels):
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels) + '}' if labels else ''
+
+
+class Metrics:
+    # Thread-safe per-stage latency histograms with quantiles over a recent
+    # window, plus counters and gauges, rendered in the Prometheus text format
+
+    def __init__(self, buckets, window):
+        self.buckets = buckets
+        self.window = window
+        # stage -> [cumulative bucket counts, sum, count]
+        self.histograms = {}
+        self.recent = {}
+        # (name, labels) -> value
+        self.counters = {}
+        # name -> function returning the current value
+        self.gauges = {}
+        self.lock = threading.Lock()
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            if stage not in self.histograms:
+                self.histograms[stage] = [[0] * len(self.buckets), 0.0, 0]
+                self.recent[stage] = deque(maxlen=self.window)
+            histogram = self.histograms[stage]
+            for index, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram[0][index] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+            self.recent[stage].append(seconds)
+
+    def increment(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def set_gauge(self, name, function):
+        with self.lock:
+            self.gauges[name] = function
+
+    def quantiles(self, stage):
+        # Nearest-rank quantiles of the stage's recent durations
+        with self.lock:
+            samples = sorted(self.recent.get(stage, []))
+        if not samples:
+            return {}
+        return {quantile: samples[max(0, math.ceil(quantile * len(samples)) - 1)] for quantile in STAGE_QUANTILES}
+
+    def render(self):
+        with self.lock:
+            histograms = {stage: (list(counts), total, count) for stage, (counts, total, count) in self.histograms.items()}
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+
+        lines = ['# HELP image_processor_stage_duration_seconds Seconds spent per message in each stage',
+                 '# TYPE image_processor_stage_duration_seconds histogram']
+        for stage, (counts, total, count) in sorted(histograms.items()):
+            for bound, bucket_count in zip(self.buckets, counts):
+                lines.append(f'image_processor_stage_duration_seconds_bucket{{stage="{stage}",le="{bound}"}} {bucket_count}')
+            lines.append(f'image_processor_stage_duration_seconds_bucket{{stage="{stage}",le="+Inf"}} {count}')
+            lines.append(f'image_processor_stage_duration_seconds_sum{{stage="{stage}"}} {total}')
+            lines.append(f'image_processor_stage_duration_seconds_count{{stage="{stage}"}} {count}')
+
+        lines += [f'# HELP image_processor_stage_duration_recent_seconds Stage duration quantiles over the last '
+                  f'{self.window} messages',
+                  '# TYPE image_processor_stage_duration_recent_seconds gauge']
+        for stage in sorted(histograms):
+            for quantile, seconds in self.quantiles(stage).items():
+                lines.append(f'image_processor_stage_duration_recent_seconds{{stage="{stage}",quantile="{quantile}"}} '
+                             f'{seconds}')
+
+        for name, (metric_type, description) in METRIC_DESCRIPTIONS.items():
+            if metric_type == 'counter':
+                samples = [(labels, value) for (counter, labels), value in sorted(counters.items()) if counter == name]
+            elif name in gauges:
+                value = gauges[name]()
+                # Labelled gauges return {labels: value}
+                if isinstance(value, dict):
+                    samples = sorted(value.items())
+                else:
+                    samples = [((), value)] if value is not None else []
+            else:
+                samples = []
+            if not samples and metric_type == 'counter' and not name.endswith('messages_total'):
+                samples = [((), 0)]
+            if not samples:
+                continue
+            lines += [f'# HELP {name} {description}', f'# TYPE {name} {metric_type}']
+            lines += [f'{name}{format_labels(labels)} {value}' for labels, value in samples]
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics(STAGE_BUCKETS, METRICS_WINDOW)
+metrics.set_gauge('image_processor_messages_in_flight', lambda: messages_in_flight)
+memory_budget = get_memory_budget()
+if memory_budget is not None:
+    metrics.set_gauge('image_processor_memory_budget_bytes', lambda: memory_budget.capacity)
+    metrics.set_gauge('image_processor_memory_reserved_bytes', lambda: memory_budget.reserved)
+
+
+@contextmanager
+def stage_timer(timings, stage):
+    # Adds the seconds spent in the block to timings[stage]
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = timings.get(stage, 0) + time.perf_counter() - start
+
+
+def record_message_metrics(timings, outcome):
+    for stage, seconds in timings.items():
+        metrics.observe(stage, seconds)
+    metrics.increment('image_processor_messages_total', outcome=outcome)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes would otherwise log a line every few seconds
+        pass
+
+
+def start_metrics_server(port):
+    server = ThreadingHTTPServer(('', port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.info(f"Serving metrics on port {server.server_port}")
+    return server
+
+
+class StatusReporter:
+    # Sends image status updates to the interaction service from a
+    # background thread, many per request over one pooled session, and acks
+    # or nacks each update's message by its result. Nothing is acked before
+    # the interaction service has its status, so the Pub/Sub message is the
+    # durable copy of an update until then.
+
+    def __init__(self, base_url, batch_size, batch_delay, timeout):
+        self.base_url = base_url
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.timeout = timeout
+        self.session = requests.Session()
+        # Marking an image processed is idempotent, so POSTs are retried too
+        retries = Retry(total=3, backoff_factor=0.5, status_forcelist=[502, 503, 504], allowed_methods=None,
+                        raise_on_status=False)
+        self.session.mount('http://', HTTPAdapter(max_retries=retries))
+        self.session.mount('https://', HTTPAdapter(max_retries=retries))
+        # (queued at, doc_id, batch_id, message, error)
+        self.pending = []
+        self.condition = threading.Condition()
+        self.thread = None
+        self.stopped = False
+
+    def submit(self, doc_id, batch_id, message, error=None):
+        # error reports an image that failed for good, so its batch can
+        # still complete
+        with self.condition:
+            # Also replaces a thread that died, so updates are never stranded
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            self.pending.append((time.perf_counter(), doc_id, batch_id, message, error))
+            if len(self.pending) >= self.batch_size:
+                self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.stopped:
+                    self.condition.wait()
+                if not self.pending:
+                    return
+                # Wait for a full batch, but not past the oldest update's deadline
+                deadline = self.pending[0][0] + self.batch_delay
+                while len(self.pending) < self.batch_size and not self.stopped:
+                    remaining = deadline - time.perf_counter()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+                updates = self.pending[:self.batch_size]
+                del self.pending[:self.batch_size]
+            try:
+                self.send(updates)
+            except Exception as e:
+                # Pub/Sub redelivers whatever was not acked yet; nacking an
+                # acked message does nothing
+                logging.error(f"Error sending {len(updates)} image status updates: {e}")
+                for _, _, _, message, _ in updates:
+                    try:
+                        message.nack()
+                    except Exception as nack_error:
+                        logging.error(f"Error returning a message to the queue: {nack_error}")
+
+    def send(self, updates):
+        results = self.post_updates([(doc_id, batch_id, error) for _, doc_id, batch_id, _, error in updates])
+        for (queued_at, doc_id, batch_id, message, _), delivered in zip(updates, results):
+            if delivered:
+                message.ack()
+            else:
+                logging.error(f"Status update for doc_id {doc_id} and batch_id {batch_id} failed, "
+                              f"returning the message to the queue")
+                message.nack()
+            metrics.observe('status', time.perf_counter() - queued_at)
+            metrics.increment('image_processor_status_updates_total', result='delivered' if delivered else 'failed')
+        logging.info(f"Sent {len(updates)} image status updates, {sum(results)} delivered")
+
+    def post_updates(self, updates):
+        # Returns whether each (doc_id, batch_id, error) update was applied
+        try:
+            response = self.session.post(f'{self.base_url}/update_image_statuses',
+                                         json={'updates': [dict({'doc_id': doc_id, 'batch_id': batch_id},
+                                                                **({'error': error} if error else {}))
+                                                           for doc_id, batch_id, error in updates]},
+                                         timeout=self.timeout)
+            if response.status_code == 404:
+                # An interaction service without the bulk endpoint
+                return [self.get_update(doc_id, batch_id, error) for doc_id, batch_id, error in updates]
+            response.raise_for_status()
+            results = [result['status'] == 'success' for result in response.json()['results']]
+            if len(results) != len(updates):
+                raise ValueError(f"Expected {len(updates)} results, got {len(results)}")
+            return results
+        except Exception as e:
+            # Includes malformed response bodies
+            logging.error(f"Error updating status: {e}")
+            return [False] * len(updates)
+
+    def get_update(self, doc_id, batch_id, error=None):
+        try:
+            response = self.session.get(f'{self.base_url}/update_image_status',
+                                        params=dict({'doc_id': doc_id, 'batch_id': batch_id},
+                                                    **({'error': error} if error else {})),
+                                        timeout=self.timeout)
+            response.raise_for_status()
+            return True
+        except requests.exceptions.RequestException as e:
+            logging.error(f"Error updating status: {e}")
+            return False
+
+    def queued(self):
+        with self.condition:
+            return len(self.pending)
+
+    def stop(self, timeout=None):
+        # Send everything still queued, then end the thread
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+            thread = self.thread
+        if thread is not None:
+            thread.join(timeout)
+
+
+status_reporter = StatusReporter(INTERACTION_POD_URL, STATUS_BATCH_SIZE, STATUS_BATCH_DELAY, STATUS_TIMEOUT)
+metrics.set_gauge('image_processor_status_updates_pending', status_reporter.queued)
+
+
+def update_image_status_to_interaction_service(doc_id, batch_id, message, error=None):
+    logging.info(f"Queueing status update to Interaction Pod for doc_id {doc_id}, batch_id {batch_id}")
+    status_reporter.submit(doc_id, batch_id, message, error)
+
+
+class PullLeaser:
+    # Acks, nacks and lease extensions of synchronously pulled messages,
+    # collected from the callbacks and sent in bulk from a background thread.
+    # A message is extended until it is acked or nacked.
+
+    def __init__(self, subscriber_client, subscription_path, ack_deadline, flush_interval):
+        self.subscriber_client = subscriber_client
+        self.subscription_path = subscription_path
+        self.ack_deadline = ack_deadline
+        self.flush_interval = flush_interval
+        # ack_id -> when its lease runs out
+        self.leases = {}
+        self.acks = []
+        self.nacks = []
+        self.condition = threading.Condition()
+        self.thread = None
+        self.stopped = False
+
+    def add(self, ack_ids):
+        # A pull leases messages for the subscription's ack deadline, which
+        # may be much shorter than ack_deadline, so they are extended to it
+        # right away and from then on every half deadline
+        expires = time.monotonic() + self.ack_deadline
+        with self.condition:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            self.leases.update((ack_id, expires) for ack_id in ack_ids)
+        try:
+            self.modify_ack_deadline(ack_ids, self.ack_deadline)
+        except Exception as e:
+            logging.error(f"Error extending the leases of {len(ack_ids)} pulled messages: {e}")
+            # Retried on the next flush
+            with self.condition:
+                for ack_id in ack_ids:
+                    if ack_id in self.leases:
+                        self.leases[ack_id] = 0
+
+    def ack(self, ack_id):
+        with self.condition:
+            if self.leases.pop(ack_id, None) is not None:
+                self.acks.append(ack_id)
+
+    def nack(self, ack_id):
+        with self.condition:
+            if self.leases.pop(ack_id, None) is not None:
+                self.nacks.append(ack_id)
+
+    def leased(self):
+        with self.condition:
+            return len(self.leases)
+
+    def run(self):
+        while True:
+            with self.condition:
+                self.condition.wait(self.flush_interval)
+                stopped = self.stopped
+            try:
+                self.flush()
+            except Exception as e:
+                # The messages are redelivered once their leases run out
+                logging.error(f"Error sending acks and lease extensions: {e}")
+            if stopped:
+                return
+
+    def flush(self):
+        now = time.monotonic()
+        with self.condition:
+            acks, self.acks = self.acks, []
+            nacks, self.nacks = self.nacks, []
+            # Extended once less than half the deadline is left
+            extend = [ack_id for ack_id, expires in self.leases.items() if expires - now < self.ack_deadline / 2]
+            for ack_id in extend:
+                self.leases[ack_id] = now + self.ack_deadline
+        for start in range(0, len(acks), ACK_IDS_PER_REQUEST):
+            self.subscriber_client.acknowledge(request={'subscription': self.subscription_path,
+                                                        'ack_ids': acks[start:start + ACK_IDS_PER_REQUEST]})
+        self.modify_ack_deadline(nacks, 0)
+        self.modify_ack_deadline(extend, self.ack_deadline)
+
+    def modify_ack_deadline(self, ack_ids, deadline):
+        for start in range(0, len(ack_ids), ACK_IDS_PER_REQUEST):
+            self.subscriber_client.modify_ack_deadline(request={
+                'subscription': self.subscription_path,
+                'ack_ids': ack_ids[start:start + ACK_IDS_PER_REQUEST],
+                'ack_deadline_seconds': deadline})
+
+    def stop(self, timeout=None):
+        # Send what is collected, then end the thread
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+            thread = self.thread
+        if thread is not None:
+            thread.join(timeout)
+
+
+class PulledMessage:
+    # A synchronously pulled message, acked and nacked like a streaming pull
+    # message so the same callback handles both
+
+    def __init__(self, received_message, leaser):
+        self.ack_id = received_message.ack_id
+        self.data = received_message.message.data
+        self.message_id = received_message.message.message_id
+        self.leaser = leaser
+
+    def ack(self):
+        self.leaser.ack(self.ack_id)
+
+    def nack(self):
+        self.leaser.nack(self.ack_id)
+
+
+def run_pull_worker(leaser, handle, batch_size, stop=None):
+    # Pulls up to batch_size messages at a time and runs handle on all of
+    # them at once, pulling the next batch once they finish; their acks go
+    # out in bulk through leaser as the status updates are accepted. Runs
+    # until stop is set, returning how many messages were handled.
+    subscriber_client = leaser.subscriber_client
+    subscription_path = leaser.subscription_path
+    metrics.set_gauge('image_processor_messages_leased', leaser.leased)
+    metrics.set_gauge('image_processor_lease_limit', lambda: batch_size)
+    handled = 0
+    failures = 0
+    with ThreadPoolExecutor(max_workers=batch_size) as executor:
+        while stop is None or not stop.is_set():
+            try:
+                response = subscriber_client.pull(request={'subscription': subscription_path,
+                                                           'max_messages': batch_size}, timeout=PULL_TIMEOUT)
+                failures = 0
+            except Exception as e:
+                failures += 1
+                logging.error(f"Error pulling messages: {e}")
+                time.sleep(min(0.5 * 2 ** (failures - 1), 30))
+                continue
+            received_messages = list(response.received_messages)
+            if not received_messages:
+                continue
+            leaser.add([received_message.ack_id for received_message in received_messages])
+            messages = [PulledMessage(received_message, leaser) for received_message in received_messages]
+            # handle does its own error handling; list() waits for the batch
+            list(executor.map(handle, messages))
+            handled += len(messages)
+    return handled
+
+
+def subscribe_lanes(lanes):
+    # Subscribes to every lane's subscription, with their messages run by one
+    # FairScheduler. Returns the streaming pull futures.
+    if EXECUTION_MODE == 'process':
+        get_process_pool()
+        workers = get_flow_control().max_messages
+    else:
+        workers = LANE_WORKERS
+    fair_scheduler = FairScheduler(lanes, workers, LANE_MAX_WAIT)
+    # Any lane can keep every worker busy on its own
+    flow_control = pubsub_v1.types.FlowControl(max_messages=workers)
+    status_reporter.batch_size = min(STATUS_BATCH_SIZE, workers)
+    metrics.set_gauge('image_processor_messages_leased', lambda: fair_scheduler.leased)
+    metrics.set_gauge('image_processor_lease_limit', lambda: workers * len(lanes))
+    metrics.set_gauge('image_processor_lane_queue_depth', fair_scheduler.lane_depths)
+    metrics.set_gauge('image_processor_lane_oldest_wait_seconds', fair_scheduler.lane_oldest_waits)
+    futures = []
+    for lane in lanes:
+        subscription_path = subscriber.subscription_path(PROJECT_ID, f'{SUBSCRIPTION_NAME}-{lane}')
+        logging.info(f"Listening for {lane} lane messages on {subscription_path}")
+        futures.append(subscriber.subscribe(subscription_path, callback=callback, flow_control=flow_control,
+                                            scheduler=fair_scheduler.lane_scheduler(lane)))
+    return futures
+
+
+def subscribe_queue():
+    # Subscribes to PUBSUB_SUBSCRIPTION alone. Returns the streaming pull futures.
     subscription_path = subscriber.subscription_path(PROJECT_ID, SUBSCRIPTION_NAME)
-    logging.info(f"Listening for messages on {subscription_path}")
+    logging.info(f"Listening for messages on {subscription_path} in {EXECUTION_MODE} mode")
+
+    if EXECUTION_MODE == 'process':
+        # Start the workers before leasing any messages
+        get_process_pool()
+    flow_control = get_flow_control()
+    scheduler = get_scheduler(flow_control)
+    # Updates waiting to be sent hold leases, so a batch can never grow past
+    # the lease limit
+    status_reporter.batch_size = min(STATUS_BATCH_SIZE, flow_control.max_messages)
+    metrics.set_gauge('image_processor_messages_leased', lambda: scheduler.leased)
+    metrics.set_gauge('image_processor_lease_limit', lambda: flow_control.max_messages)
 
     # Start the subscriber to listen for messages continuously
-    streaming_pull_future = subscriber.subscribe(subscription_path, callback=callback)
+    return [subscriber.subscribe(subscription_path, callback=callback, flow_control=flow_control,
+                                 scheduler=scheduler)]
+
+
+if __name__ == '__main__':
+    lanes = [lane for lane, _ in parse_lanes(SCHEDULING_LANES)]
+    streaming_pull_futures = []
+    leaser = None
+    if WORKER_MODE == 'pull':
+        subscription_path = subscriber.subscription_path(PROJECT_ID, SUBSCRIPTION_NAME)
+        logging.info(f"Pulling batches of {PULL_BATCH_SIZE} messages from {subscription_path} "
+                     f"in {EXECUTION_MODE} mode")
+        if EXECUTION_MODE == 'process':
+            get_process_pool()
+        leaser = PullLeaser(subscriber, subscription_path, PULL_ACK_DEADLINE, PULL_FLUSH_INTERVAL)
+        # The updates of a whole batch go out as soon as it is processed
+        status_reporter.batch_size = min(STATUS_BATCH_SIZE, PULL_BATCH_SIZE)
+    elif lanes:
+        logging.info(f"Scheduling lanes {lanes} in {EXECUTION_MODE} mode")
+        streaming_pull_futures = subscribe_lanes(lanes)
+    else:
+        streaming_pull_futures = subscribe_queue()
+    if METRICS_PORT:
+        start_metrics_server(METRICS_PORT)
 
     # Keep the subscriber running
     try:
-        streaming_pull_future.result()  # Block the main thread indefinitely
+        if leaser is not None:
+            run_pull_worker(leaser, callback, PULL_BATCH_SIZE)
+        for streaming_pull_future in streaming_pull_futures:
+            streaming_pull_future.result()  # Block the main thread indefinitely
     except KeyboardInterrupt:
-        streaming_pull_future.cancel()  # Stop listening if interrupted
+        # Ack what is already processed before the subscriber stops
+        status_reporter.stop(STATUS_TIMEOUT)
+        for streaming_pull_future in streaming_pull_futures:
+            streaming_pull_future.cancel()  # Stop listening if interrupted
+        if leaser is not None:
+            leaser.stop(PULL_TIMEOUT)
         logging.info("Stopped listening for Pub/Sub messages.")
+    finally:
+        if process_pool is not None:
+            process_pool.shutdown()
@@ -0,0 +1,113 @@
+import heapq
+import argparse
+from collections import deque
+import image_processor
+
+# A mixed workload: one large batch at the start and small batches arriving
+# steadily behind it, all served by the same workers at a fixed time per image
+DEFAULT_LANES = 'small:10,medium:200,large'
+
+
+def make_workload(large_images, small_batches, small_images, small_interval):
+    # [(arrival time, batch_id, image count)]
+    workload = [(0.0, 'large-0', large_images)]
+    workload += [(small_interval * (index + 1), f'small-{index}', small_images) for index in range(small_batches)]
+    return workload
+
+
+class FifoQueue:
+    # One queue in publish order, as with the single image-processing topic
+    def __init__(self):
+        self.items = deque()
+
+    def add(self, batch_id, item, now):
+        self.items.append(item)
+
+    def pop(self, now):
+        return self.items.popleft() if self.items else None
+
+
+class LaneQueue:
+    # The image processor's lanes, fed the way the interaction service
+    # publishes batches
+    def __init__(self, lanes, max_wait):
+        self.lanes = lanes
+        self.queues = image_processor.LaneQueues([lane for lane, _ in lanes], max_wait)
+        self.batch_lanes = {}
+
+    def add(self, batch_id, item, now):
+        self.queues.add(self.batch_lanes[batch_id], batch_id, item, now)
+
+    def pop(self, now):
+        picked = self.queues.pop(now)
+        return picked[1] if picked else None
+
+
+def simulate(workload, scheduler, workers, service_time):
+    # Returns {batch_id: (arrival, completion time)}
+    if isinstance(scheduler, LaneQueue):
+        for _, batch_id, image_count in workload:
+            scheduler.batch_lanes[batch_id] = image_processor.lane_for_batch(scheduler.lanes, image_count)
+    arrivals = deque(sorted(workload))
+    remaining = {batch_id: image_count for _, batch_id, image_count in workload}
+    arrived_at = {batch_id: arrival for arrival, batch_id, _ in workload}
+    completed = {}
+    # (finish time, batch_id) of the images being processed
+    running = []
+    now = 0.0
+    while arrivals or running or any(remaining.values()):
+        while arrivals and arrivals[0][0] <= now:
+            arrival, batch_id, image_count = arrivals.popleft()
+            for index in range(image_count):
+                scheduler.add(batch_id, batch_id, arrival)
+        while running and running[0][0] <= now:
+            _, batch_id = heapq.heappop(running)
+            remaining[batch_id] -= 1
+            if not remaining[batch_id]:
+                completed[batch_id] = (arrived_at[batch_id], now)
+        while len(running) < workers:
+            batch_id = scheduler.pop(now)
+            if batch_id is None:
+                break
+            heapq.heappush(running, (now + service_time, batch_id))
+        next_times = [time for time in [arrivals[0][0] if arrivals else None,
+                                        running[0][0] if running else None] if time is not None]
+        if not next_times:
+            break
+        now = min(next_times)
+    return completed
+
+
+def percentile(values, quantile):
+    values = sorted(values)
+    return values[max(0, min(len(values) - 1, int(round(quantile * len(values))) - 1))]
+
+
+def summarize(name, completed):
+    small = [done - arrival for batch_id, (arrival, done) in completed.items() if batch_id.startswith('small')]
+    large = [done - arrival for batch_id, (arrival, done) in completed.items() if batch_id.startswith('large')]
+    print(f"{name:<8}{percentile(small, 0.5):>12.1f}s{percentile(small, 0.95):>12.1f}s{max(small):>12.1f}s"
+          f"{max(large):>14.1f}s")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Simulate batch latencies of a mixed workload with one queue '
+                                                 'and with the scheduling lanes')
+    parser.add_argument('--workers', type=int, default=10, help='Images processed at once across all pods')
+    parser.add_argument('--service-time', type=float, default=15.0, help='Seconds per image')
+    parser.add_argument('--large-images', type=int, default=10000)
+    parser.add_argument('--small-batches', type=int, default=200)
+    parser.add_argument('--small-images', type=int, default=3)
+    parser.add_argument('--small-interval', type=float, default=30.0, help='Seconds between small batches')
+    parser.add_argument('--lanes', default=DEFAULT_LANES)
+    parser.add_argument('--max-wait', type=float, default=image_processor.LANE_MAX_WAIT,
+                        help='Starvation guard, as LANE_MAX_WAIT')
+    args = parser.parse_args()
+
+    workload = make_workload(args.large_images, args.small_batches, args.small_images, args.small_interval)
+    print(f"{args.large_images}-image batch at 0s, {args.small_batches} batches of {args.small_images} images "
+          f"every {args.small_interval}s, {args.workers} workers at {args.service_time}s per image")
+    print(f"{'queue':<8}{'small p50':>13}{'small p95':>13}{'small max':>13}{'large done':>15}")
+    summarize('fifo', simulate(workload, FifoQueue(), args.workers, args.service_time))
+    summarize('lanes', simulate(workload, LaneQueue(image_processor.parse_lanes(args.lanes), args.max_wait),
+                                args.workers, args.service_time))
@@ -1,6 +1,6 @@
 import pytest
 from unittest.mock import Mock, patch
-from PIL import Image
+from PIL import Image, JpegImagePlugin
 import io
 import json
 import image_processor
@@ -61,4 +61,835 @@ def test_callback_unsupported_format():
     image_processor.callback(message)
 
     # Verify the message was not acknowledged (nack'd)
-    message.nack.assert_called_once()
\ No newline at end of file
+    message.nack.assert_called_once()
+
+@pytest.fixture
+def gradient_image():
+    # A colour gradient so every filter produces a range of values
+    img = Image.new('RGB', (256, 64))
+    img.putdata([(x, (x * 3 + y) % 256, 255 - x) for y in range(64) for x in range(256)])
+    return img
+
+
+def test_compile_filters_groups_point_filters():
+    """Test that consecutive point filters are grouped into one stage"""
+    filters = [
+        {'filter_type': 'brightness', 'filter_value': '1.2'},
+        {'filter_type': 'contrast', 'filter_value': '1.5'},
+        {'filter_type': 'rotate', 'filter_value': '90'},
+        {'filter_type': 'grayscale', 'filter_value': '1'},
+        {'filter_type': 'brightness', 'filter_value': '0.8'}
+    ]
+
+    stages = image_processor.compile_filters(filters)
+
+    assert [stage_type for stage_type, _ in stages] == ['point', 'filter', 'point']
+    assert stages[0][1] == filters[:2]
+    assert stages[2][1] == filters[3:]
+
+
+def test_fused_point_filters_match_unfused(gradient_image):
+    """Test that the fused point stage stays within the documented tolerance"""
+    filters = [
+        {'filter_type': 'brightness', 'filter_value': '1.2'},
+        {'filter_type': 'contrast', 'filter_value': '1.5'},
+        {'filter_type': 'brightness', 'filter_value': '0.9'}
+    ]
+
+    # Brightness and contrast on 'L' images are bit-identical
+    gray = gradient_image.convert('L')
+    unfused = image_processor.run_filters(gray, filters, fuse_point_filters=False)
+    fused = image_processor.run_filters(gray, filters, fuse_point_filters=True)
+    assert fused.tobytes() == unfused.tobytes()
+
+    # Colour contrast may move the grey mean by one level
+    unfused = image_processor.run_filters(gradient_image, filters, fuse_point_filters=False)
+    fused = image_processor.run_filters(gradient_image, filters, fuse_point_filters=True)
+    assert fused.mode == unfused.mode
+    assert max(abs(a - b) for a, b in zip(fused.tobytes(), unfused.tobytes())) <= 1
+
+
+def test_fused_grayscale_chain_is_exact(gradient_image):
+    """Test that a chain crossing a grayscale conversion matches the unfused path"""
+    filters = [
+        {'filter_type': 'brightness', 'filter_value': '0.8'},
+        {'filter_type': 'grayscale', 'filter_value': '1'},
+        {'filter_type': 'contrast', 'filter_value': '1.4'}
+    ]
+
+    unfused = image_processor.run_filters(gradient_image, filters, fuse_point_filters=False)
+    fused = image_processor.run_filters(gradient_image, filters, fuse_point_filters=True)
+
+    assert fused.mode == 'L'
+    assert fused.tobytes() == unfused.tobytes()
+
+
+def test_process_mode_matches_thread_mode(sample_image):
+    """Test that the process pool produces the same output as the callback thread"""
+    filters = [
+        {'filter_type': 'grayscale', 'filter_value': '1'},
+        {'filter_type': 'blur', 'filter_value': '2.0'}
+    ]
+
+    derivatives = [('thumbnail', 32)]
+
+    expected = image_processor.run_process_image(sample_image, filters, derivatives)
+    timings = {}
+    with patch.object(image_processor, 'EXECUTION_MODE', 'process'), \
+            patch.object(image_processor, 'PROCESS_POOL_SIZE', 1):
+        try:
+            result = image_processor.run_process_image(sample_image, filters, derivatives, timings=timings)
+        finally:
+            image_processor.process_pool.shutdown()
+            image_processor.process_pool = None
+
+    assert result == expected
+    # Timings measured in the worker come back with the result
+    assert set(timings) == {'decode', 'filters', 'derivatives', 'encode', 'pool_wait'}
+
+
+def test_flow_control_tied_to_pool_size():
+    """Test that process mode leases no more messages than workers can take"""
+    with patch.object(image_processor, 'EXECUTION_MODE', 'process'), \
+            patch.object(image_processor, 'PROCESS_POOL_SIZE', 4), \
+            patch.object(image_processor, 'LEASED_MESSAGES_PER_WORKER', 2):
+        flow_control = image_processor.get_flow_control()
+        scheduler = image_processor.get_scheduler(flow_control)
+
+    assert flow_control.max_messages == 8
+    assert scheduler._executor._max_workers == 8
+    scheduler.shutdown()
+
+
+def test_result_cache_evicts_least_recently_used():
+    """Test that the result cache stays within its entry and byte limits"""
+    cache = image_processor.ResultCache(max_entries=2, max_bytes=10)
+    cache.put('a', b'1234')
+    cache.put('b', b'1234')
+    assert cache.get('a') == b'1234'
+    cache.put('c', b'1234')
+
+    assert cache.get('b') is None
+    assert cache.get('c') == b'1234'
+    cache.put('d', b'12345678')
+    assert cache.stats() == {'hits': 2, 'misses': 1, 'evictions': 3, 'entries': 1, 'bytes': 8}
+
+
+def test_callback_reuses_cached_result(sample_message, sample_image):
+    """Test that a repeated job is served from the cache instead of being recomputed"""
+    input_blob = Mock(md5_hash='abc==', crc32c='xyz==', size=len(sample_image))
+    input_blob.download_as_bytes.return_value = sample_image
+
+    with patch.object(image_processor, 'storage_client') as mock_storage, \
+            patch.object(image_processor, 'result_cache', image_processor.ResultCache(10, 1024 * 1024)), \
+            patch.object(image_processor, 'RESULT_CACHE_MODE', 'local'), \
+            patch.object(image_processor, 'DERIVATIVES', 'thumbnail:32'), \
+            patch.object(image_processor, 'run_process_image', wraps=image_processor.run_process_image) as mock_run, \
+            patch('image_processor.update_image_status_to_interaction_service') as mock_status, \
+            patch('image_processor.time.sleep'):
+        mock_bucket = mock_storage.bucket.return_value
+        mock_bucket.get_blob.return_value = input_blob
+
+        image_processor.callback(sample_message)
+        image_processor.callback(sample_message)
+
+        assert mock_run.call_count == 1
+        assert input_blob.download_as_bytes.call_count == 1
+        # Output plus input and output thumbnails, twice
+        assert mock_bucket.blob.return_value.upload_from_file.call_count == 6
+        assert image_processor.result_cache.stats()['hits'] == 1
+    assert mock_status.call_count == 2
+
+
+def test_cache_key_ignores_filter_value_types():
+    """Test that equivalent filter lists share a cache key"""
+    blob = Mock(md5_hash='abc==', crc32c='xyz==', size=10)
+    derivatives = [('thumbnail', 256)]
+    filters = [{'filter_type': 'rotate', 'filter_value': 45}]
+    key = image_processor.result_cache_key(blob, filters, derivatives, 'balanced')
+
+    assert key == image_processor.result_cache_key(blob, [{'filter_value': '45', 'filter_type': 'rotate'}],
+                                                   derivatives, 'balanced')
+    assert key != image_processor.result_cache_key(blob, [{'filter_type': 'rotate', 'filter_value': '90'}],
+                                                   derivatives, 'balanced')
+    assert key != image_processor.result_cache_key(blob, filters, [], 'balanced')
+    assert key != image_processor.result_cache_key(blob, filters, derivatives, 'small')
+
+
+def test_stream_filters_matches_apply_filters(sample_image):
+    """Test that the streamed path reads through a blob reader and writes the same bytes"""
+    from google.cloud.storage.fileio import BlobReader
+
+    filters = [{'filter_type': 'rotate', 'filter_value': '90'}]
+    input_blob = Mock(size=len(sample_image))
+    input_blob.download_as_bytes.side_effect = lambda start=0, end=None, **kwargs: sample_image[start:end + 1]
+    input_blob.open.side_effect = lambda mode, chunk_size: BlobReader(input_blob, chunk_size=chunk_size)
+
+    written = io.BytesIO()
+    output_blob = Mock()
+    output_blob.open.return_value.__enter__ = Mock(return_value=written)
+    output_blob.open.return_value.__exit__ = Mock(return_value=False)
+
+    outputs = image_processor.stream_filters(input_blob, output_blob, filters)
+
+    assert outputs == {'output': (None, 'image/jpeg')}
+    assert written.getvalue() == image_processor.apply_filters(sample_image, filters)
+    output_blob.open.assert_called_once_with('wb', chunk_size=image_processor.STREAMING_CHUNK_SIZE,
+                                             ignore_flush=True, content_type='image/jpeg')
+
+
+def test_peak_rss_window_reports_concurrency():
+    """Test that peak RSS is reported along with the number of messages in flight"""
+    image_processor.start_peak_rss_window()
+    image_processor.start_peak_rss_window()
+    _, concurrent_messages = image_processor.end_peak_rss_window()
+    peak_rss, last_concurrent_messages = image_processor.end_peak_rss_window()
+
+    assert concurrent_messages == 2
+    assert last_concurrent_messages == 1
+    assert peak_rss > 0
+
+
+@pytest.mark.parametrize('mode', ['RGB', 'RGBA', 'L'])
+@pytest.mark.parametrize('filters', [
+    [{'filter_type': 'blur', 'filter_value': '2.5'}],
+    [{'filter_type': 'brightness', 'filter_value': '1.3'},
+     {'filter_type': 'blur', 'filter_value': '4'},
+     {'filter_type': 'contrast', 'filter_value': '1.6'}],
+    [{'filter_type': 'contrast', 'filter_value': '0.7'},
+     {'filter_type': 'grayscale', 'filter_value': '1'},
+     {'filter_type': 'contrast', 'filter_value': '1.8'},
+     {'filter_type': 'blur', 'filter_value': '9'},
+     {'filter_type': 'rotate', 'filter_value': '45'},
+     {'filter_type': 'blur', 'filter_value': '1'}]
+])
+def test_tiled_filters_match_full_image(gradient_image, mode, filters):
+    """Test that strip-by-strip processing is pixel for pixel the same as the full image path"""
+    image = gradient_image.convert(mode)
+
+    # Strips smaller than the blur halo so rows are shared across several strips
+    with patch.object(image_processor, 'TILE_STRIP_ROWS', 7):
+        tiled = image_processor.run_filters(image, filters, fuse_point_filters=True, tiled=True)
+    full = image_processor.run_filters(image, filters, fuse_point_filters=True, tiled=False)
+
+    assert tiled.mode == full.mode
+    assert tiled.size == full.size
+    assert tiled.tobytes() == full.tobytes()
+
+
+def test_tiled_mode_selected_above_pixel_threshold(gradient_image):
+    """Test that large images switch to the tiled engine automatically"""
+    filters = [{'filter_type': 'blur', 'filter_value': '1'}]
+
+    with patch.object(image_processor, 'TILED_PIXEL_THRESHOLD', 256 * 64), \
+            patch.object(image_processor, 'run_filters_tiled', wraps=image_processor.run_filters_tiled) as mock_tiled:
+        image_processor.run_filters(gradient_image.crop((0, 0, 256, 63)), filters)
+        assert not mock_tiled.called
+        image_processor.run_filters(gradient_image, filters)
+        assert mock_tiled.called
+
+
+def test_plan_resize_filters_hoists_downscale():
+    """Test that a downscale moves in front of point filters and blur"""
+    filters = [
+        {'filter_type': 'rotate', 'filter_value': '45'},
+        {'filter_type': 'brightness', 'filter_value': '1.2'},
+        {'filter_type': 'blur', 'filter_value': '4'},
+        {'filter_type': 'thumbnail', 'filter_value': '200'}
+    ]
+
+    planned = image_processor.plan_resize_filters(filters, (800, 600), hoist=True)
+
+    assert planned == [
+        {'filter_type': 'rotate', 'filter_value': '45'},
+        {'filter_type': 'resize', 'filter_value': '200x150'},
+        {'filter_type': 'brightness', 'filter_value': '1.2'},
+        {'filter_type': 'blur', 'filter_value': '1.0'}
+    ]
+    assert image_processor.plan_resize_filters(filters, (800, 600), hoist=False)[3] == \
+        {'filter_type': 'resize', 'filter_value': '200x150'}
+
+
+def test_resize_uses_jpeg_draft_decode():
+    """Test that a leading downscale decodes the JPEG at reduced scale"""
+    img = Image.new('RGB', (1600, 1200), color='blue')
+    img_byte_arr = io.BytesIO()
+    img.save(img_byte_arr, format='JPEG')
+    filters = [
+        {'filter_type': 'grayscale', 'filter_value': '1'},
+        {'filter_type': 'resize', 'filter_value': '0.1'}
+    ]
+
+    jpeg_draft = JpegImagePlugin.JpegImageFile.draft
+    with patch.object(JpegImagePlugin.JpegImageFile, 'draft', autospec=True, side_effect=jpeg_draft) as mock_draft:
+        result = image_processor.apply_filters(img_byte_arr.getvalue(), filters)
+
+    mock_draft.assert_called_once()
+    processed_image = Image.open(io.BytesIO(result))
+    assert processed_image.size == (160, 120)
+    assert processed_image.mode == 'L'
+
+
+@pytest.mark.parametrize('filter_type, filter_value, expected', [
+    ('resize', {'width': 400, 'height': None}, (400, 300)),
+    ('resize', {'width': 100, 'height': 100}, (100, 100)),
+    ('resize', '0.5', (400, 300)),
+    ('thumbnail', '200', (200, 150)),
+    ('thumbnail', '200x50', (67, 50)),
+    ('thumbnail', '2000', (800, 600))
+])
+def test_resize_target(filter_type, filter_value, expected):
+    """Test resize and thumbnail sizes, including the frontend's width/height object"""
+    filter_info = {'filter_type': filter_type, 'filter_value': filter_value}
+
+    assert image_processor.resize_target((800, 600), filter_info) == expected
+
+
+@pytest.mark.parametrize('filter_value', [{'width': 100000}, '256', '100000x75000'])
+def test_resize_target_rejects_oversized_output(filter_value):
+    """Test that resizes beyond MAX_OUTPUT_PIXELS are rejected before anything is allocated"""
+    with pytest.raises(image_processor.PermanentImageError):
+        image_processor.resize_target((4000, 3000), {'filter_type': 'resize', 'filter_value': filter_value})
+
+
+def test_callback_reports_oversized_resize_as_failed(sample_message, sample_image):
+    """Test that a job that can never succeed is reported failed, not redelivered"""
+    request_data = json.loads(sample_message.data)
+    request_data['filters'] = [{'filter_type': 'resize', 'filter_value': {'width': 100000}}]
+    sample_message.data = json.dumps(request_data).encode('utf-8')
+
+    with patch('image_processor.storage_client') as mock_storage, \
+            patch('image_processor.time.sleep'), \
+            patch('image_processor.RESULT_CACHE_MODE', 'off'), \
+            patch('image_processor.update_image_status_to_interaction_service') as mock_status:
+        mock_blob = mock_storage.bucket.return_value.get_blob.return_value
+        mock_blob.download_as_bytes.return_value = sample_image
+        image_processor.callback(sample_message)
+
+    # Acked by the status reporter once the failure is recorded
+    mock_status.assert_called_once()
+    assert mock_status.call_args.args == ('test-doc-123', 'batch-123', sample_message)
+    assert 'exceeds' in mock_status.call_args.kwargs['error']
+    sample_message.nack.assert_not_called()
+
+
+def test_process_image_makes_derivatives_from_one_decode(sample_image):
+    """Test that derivatives of the input and output come from the same decode"""
+    filters = [{'filter_type': 'grayscale', 'filter_value': '1'}]
+
+    with patch.object(image_processor.Image, 'open', wraps=image_processor.Image.open) as mock_open:
+        derivative_outputs = image_processor.process_image(sample_image, filters,
+                                                           [('thumbnail', 20), ('preview', 50)])
+
+    assert mock_open.call_count == 1
+    assert sorted(derivative_outputs) == sorted(['output'] + image_processor.derivative_suffixes(
+        [('thumbnail', 20), ('preview', 50)]))
+    thumbnail_data, content_type = derivative_outputs['derivatives/thumbnail/output']
+    thumbnail = Image.open(io.BytesIO(thumbnail_data))
+    assert content_type == 'image/jpeg'
+    assert thumbnail.size == (20, 20)
+    assert thumbnail.mode == 'L'
+    assert Image.open(io.BytesIO(derivative_outputs['derivatives/preview/input'][0])).mode == 'RGB'
+
+
+def test_callback_uploads_derivatives_next_to_output(sample_message, sample_image):
+    """Test that derivatives are stored under predictable prefixes"""
+    input_blob = Mock(md5_hash='abc==', crc32c='xyz==', size=len(sample_image))
+    input_blob.download_as_bytes.return_value = sample_image
+
+    with patch.object(image_processor, 'storage_client') as mock_storage, \
+            patch.object(image_processor, 'RESULT_CACHE_MODE', 'off'), \
+            patch.object(image_processor, 'DERIVATIVES', 'thumbnail:32'), \
+            patch('image_processor.update_image_status_to_interaction_service') as mock_status, \
+            patch('image_processor.time.sleep'):
+        mock_bucket = mock_storage.bucket.return_value
+        mock_bucket.get_blob.return_value = input_blob
+        image_processor.callback(sample_message)
+
+    blob_names = [call.args[0] for call in mock_bucket.blob.call_args_list]
+    assert blob_names == ['batch-123/output/test.jpg',
+                          'batch-123/derivatives/thumbnail/input/test.jpg',
+                          'batch-123/derivatives/thumbnail/output/test.jpg']
+    # The status reporter acks the message once the status is accepted
+    mock_status.assert_called_once_with('test-doc-123', 'batch-123', sample_message)
+    sample_message.ack.assert_not_called()
+
+
+@pytest.mark.parametrize('source_format', ['JPEG', 'PNG'])
+@pytest.mark.parametrize('encoder_profile', ['fast', 'balanced', 'small'])
+def test_output_keeps_source_format(gradient_image, source_format, encoder_profile):
+    """Test that the output format survives filters that drop image.format"""
+    img_byte_arr = io.BytesIO()
+    gradient_image.save(img_byte_arr, format=source_format)
+    filters = [
+        {'filter_type': 'rotate', 'filter_value': '90'},
+        {'filter_type': 'grayscale', 'filter_value': '1'}
+    ]
+
+    outputs = image_processor.process_image(img_byte_arr.getvalue(), filters, [], encoder_profile)
+
+    output_data, content_type = outputs['output']
+    assert Image.open(io.BytesIO(output_data)).format == source_format
+    assert content_type == image_processor.FORMAT_CONTENT_TYPES[source_format]
+
+
+def test_small_profile_writes_webp_when_enabled(sample_image):
+    """Test the optional WebP output of the small profile"""
+    with patch.object(image_processor, 'ENCODER_WEBP', True):
+        small = image_processor.process_image(sample_image, [], [], 'small')['output']
+        balanced = image_processor.process_image(sample_image, [], [], 'balanced')['output']
+
+    assert small[1] == 'image/webp'
+    assert Image.open(io.BytesIO(small[0])).format == 'WEBP'
+    assert balanced[1] == 'image/jpeg'
+
+
+def test_metrics_histogram_and_quantiles():
+    """Test that stage durations are bucketed and summarised over the recent window"""
+    metrics = image_processor.Metrics([0.1, 1], window=4)
+    for seconds in [0.05, 0.5, 0.5, 2, 3]:
+        metrics.observe('decode', seconds)
+    metrics.increment('image_processor_bytes_in_total', 100)
+    metrics.increment('image_processor_messages_total', outcome='processed')
+    metrics.set_gauge('image_processor_messages_leased', lambda: 3)
+
+    # The oldest sample has left the window
+    assert metrics.quantiles('decode') == {0.5: 0.5, 0.95: 3, 0.99: 3}
+    lines = metrics.render().splitlines()
+    assert 'image_processor_stage_duration_seconds_bucket{stage="decode",le="0.1"} 1' in lines
+    assert 'image_processor_stage_duration_seconds_bucket{stage="decode",le="1"} 3' in lines
+    assert 'image_processor_stage_duration_seconds_bucket{stage="decode",le="+Inf"} 5' in lines
+    assert 'image_processor_stage_duration_seconds_count{stage="decode"} 5' in lines
+    assert 'image_processor_stage_duration_recent_seconds{stage="decode",quantile="0.95"} 3' in lines
+    assert 'image_processor_bytes_in_total 100' in lines
+    assert 'image_processor_bytes_out_total 0' in lines
+    assert 'image_processor_messages_total{outcome="processed"} 1' in lines
+    assert 'image_processor_messages_leased 3' in lines
+
+
+def test_callback_records_stage_timings(sample_message, sample_image):
+    """Test that every stage of a processed message is timed and its bytes counted"""
+    input_blob = Mock(md5_hash='abc==', crc32c='xyz==', size=len(sample_image))
+    input_blob.download_as_bytes.return_value = sample_image
+    metrics = image_processor.Metrics(image_processor.STAGE_BUCKETS, 16)
+
+    with patch.object(image_processor, 'storage_client') as mock_storage, \
+            patch.object(image_processor, 'metrics', metrics), \
+            patch.object(image_processor, 'RESULT_CACHE_MODE', 'off'), \
+            patch.object(image_processor, 'DERIVATIVES', 'thumbnail:32'), \
+            patch('image_processor.update_image_status_to_interaction_service'), \
+            patch('image_processor.time.sleep'):
+        mock_storage.bucket.return_value.get_blob.return_value = input_blob
+        image_processor.callback(sample_message)
+
+    assert set(metrics.histograms) == {'sleep', 'lookup', 'cache', 'download', 'decode', 'filters',
+                                       'derivatives', 'encode', 'upload', 'message'}
+    assert metrics.counters[('image_processor_messages_total', (('outcome', 'processed'),))] == 1
+    assert metrics.counters[('image_processor_bytes_in_total', ())] == len(sample_image)
+    assert metrics.counters[('image_processor_bytes_out_total', ())] > 0
+
+
+def test_metrics_endpoint_serves_prometheus_text():
+    """Test that /metrics serves the registry and other paths are not found"""
+    import requests
+
+    server = image_processor.start_metrics_server(0)
+    try:
+        response = requests.get(f'http://localhost:{server.server_port}/metrics', timeout=5)
+        missing = requests.get(f'http://localhost:{server.server_port}/other', timeout=5)
+    finally:
+        server.shutdown()
+
+    assert response.status_code == 200
+    assert response.headers['Content-Type'].startswith('text/plain; version=0.0.4')
+    assert '# TYPE image_processor_stage_duration_seconds histogram' in response.text
+    assert 'image_processor_messages_in_flight' in response.text
+    assert missing.status_code == 404
+
+
+def test_scheduler_counts_leased_messages():
+    """Test that messages waiting for a callback thread count as leased"""
+    import threading
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+
+    release = threading.Event()
+    scheduler = image_processor.LeaseCountingScheduler(ThreadPoolExecutor(max_workers=1))
+    running, waiting = Mock(), Mock()
+    scheduler.schedule(lambda message: release.wait(), running)
+    scheduler.schedule(lambda message: release.wait(), waiting)
+    assert scheduler.leased == 2
+
+    # The subscriber nacks the messages shutdown drops from the queue
+    assert scheduler.shutdown() == [waiting]
+    assert scheduler.leased == 1
+    release.set()
+    deadline = time.monotonic() + 5
+    while scheduler.leased and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert scheduler.leased == 0
+
+
+def status_response(status_code, results=None):
+    response = Mock(status_code=status_code)
+    response.json.return_value = {'status': 'success', 'results': results}
+    if status_code >= 400:
+        response.raise_for_status.side_effect = image_processor.requests.exceptions.HTTPError(str(status_code))
+    return response
+
+
+def test_status_reporter_sends_one_bulk_update():
+    """Test that queued status updates go out in one request and each message is acked by its result"""
+    reporter = image_processor.StatusReporter('http://interaction', batch_size=3, batch_delay=5, timeout=2)
+    reporter.session = Mock()
+    reporter.session.post.return_value = status_response(200, [
+        {'doc_id': 'doc-1', 'status': 'success'},
+        {'doc_id': 'doc-2', 'status': 'error', 'message': 'not found'},
+        {'doc_id': 'doc-3', 'status': 'success'}
+    ])
+    messages = [Mock(), Mock(), Mock()]
+    reporter.submit('doc-1', 'batch-1', messages[0])
+    reporter.submit('doc-2', 'batch-1', messages[1])
+    # An image that failed for good is reported with its error
+    reporter.submit('doc-3', 'batch-1', messages[2], error='Too large')
+    reporter.stop(timeout=5)
+
+    reporter.session.post.assert_called_once_with('http://interaction/update_image_statuses', json={'updates': [
+        {'doc_id': 'doc-1', 'batch_id': 'batch-1'},
+        {'doc_id': 'doc-2', 'batch_id': 'batch-1'},
+        {'doc_id': 'doc-3', 'batch_id': 'batch-1', 'error': 'Too large'}
+    ]}, timeout=2)
+    messages[0].ack.assert_called_once()
+    messages[1].nack.assert_called_once()
+    messages[1].ack.assert_not_called()
+    messages[2].ack.assert_called_once()
+
+
+def test_status_reporter_flushes_after_delay():
+    """Test that a partial batch is sent once its oldest update has waited long enough"""
+    import threading
+
+    reporter = image_processor.StatusReporter('http://interaction', batch_size=10, batch_delay=0.05, timeout=2)
+    reporter.session = Mock()
+    reporter.session.post.return_value = status_response(200, [{'doc_id': 'doc-1', 'status': 'success'}])
+    acked = threading.Event()
+    message = Mock()
+    message.ack.side_effect = acked.set
+    reporter.submit('doc-1', 'batch-1', message)
+
+    assert acked.wait(timeout=5)
+    reporter.stop(timeout=5)
+
+
+def test_status_reporter_falls_back_to_single_updates():
+    """Test that updates are sent one by one to an interaction service without the bulk endpoint"""
+    reporter = image_processor.StatusReporter('http://interaction', batch_size=2, batch_delay=5, timeout=2)
+    reporter.session = Mock()
+    reporter.session.post.return_value = status_response(404)
+    reporter.session.get.side_effect = [status_response(200), status_response(500)]
+    messages = [Mock(), Mock()]
+    reporter.submit('doc-1', 'batch-1', messages[0])
+    reporter.submit('doc-2', 'batch-1', messages[1])
+    reporter.stop(timeout=5)
+
+    reporter.session.get.assert_any_call('http://interaction/update_image_status',
+                                         params={'doc_id': 'doc-1', 'batch_id': 'batch-1'}, timeout=2)
+    messages[0].ack.assert_called_once()
+    messages[1].nack.assert_called_once()
+
+
+def test_status_reporter_survives_bad_responses_and_acks():
+    """Test that a malformed response or a failing ack nacks the batch without stopping later updates"""
+    reporter = image_processor.StatusReporter('http://interaction', batch_size=1, batch_delay=5, timeout=2)
+    reporter.session = Mock()
+    malformed = Mock(status_code=200)
+    malformed.json.return_value = {'status': 'success', 'results': None}
+    reporter.session.post.side_effect = [
+        malformed,
+        status_response(200, [{'doc_id': 'doc-2', 'status': 'success'}]),
+        status_response(200, [{'doc_id': 'doc-3', 'status': 'success'}])
+    ]
+    messages = [Mock(), Mock(), Mock()]
+    messages[1].ack.side_effect = RuntimeError('ack failed')
+    for index, message in enumerate(messages):
+        reporter.submit(f'doc-{index + 1}', 'batch-1', message)
+        # One update at a time, so each gets its own response
+        while reporter.queued():
+            image_processor.time.sleep(0.01)
+    reporter.stop(timeout=5)
+
+    messages[0].nack.assert_called_once()
+    messages[1].nack.assert_called_once()
+    messages[2].ack.assert_called_once()
+    assert reporter.session.post.call_count == 3
+
+
+def test_parse_lanes_and_lane_for_batch():
+    """Test that a batch goes to the first lane it fits"""
+    lanes = image_processor.parse_lanes('small:10, medium:200,large')
+    assert lanes == [('small', 10), ('medium', 200), ('large', None)]
+    assert image_processor.lane_for_batch(lanes, 3) == 'small'
+    assert image_processor.lane_for_batch(lanes, 200) == 'medium'
+    assert image_processor.lane_for_batch(lanes, 10000) == 'large'
+
+
+def test_lane_queues_serve_small_batches_first_and_batches_in_turn():
+    """Test that higher priority lanes go first and batches of a lane take turns"""
+    queues = image_processor.LaneQueues(['small', 'large'], max_wait=60)
+    for index in range(3):
+        queues.add('large', 'big-1', f'big-1/{index}', now=0)
+    queues.add('large', 'big-2', 'big-2/0', now=1)
+    queues.add('small', 'tiny', 'tiny/0', now=2)
+
+    order = [queues.pop(now=3) for _ in range(5)]
+
+    assert order == [('small', 'tiny/0'), ('large', 'big-1/0'), ('large', 'big-2/0'),
+                     ('large', 'big-1/1'), ('large', 'big-1/2')]
+    assert queues.pop(now=3) is None
+    assert queues.depths == {'small': 0, 'large': 0}
+
+
+def test_lane_queues_serve_starved_lanes():
+    """Test that a lane without a worker for max_wait goes before higher priority lanes, once per max_wait"""
+    queues = image_processor.LaneQueues(['small', 'large'], max_wait=60)
+    for index in range(2):
+        queues.add('large', 'big', f'big/{index}', now=0)
+    for index in range(4):
+        queues.add('small', f'tiny-{index}', f'tiny-{index}/0', now=30)
+
+    assert queues.pop(now=59) == ('small', 'tiny-0/0')
+    assert queues.pop(now=60) == ('large', 'big/0')
+    # Served, so the large lane waits its turn again
+    assert queues.pop(now=61) == ('small', 'tiny-1/0')
+    assert queues.pop(now=119) == ('small', 'tiny-2/0')
+    assert queues.pop(now=120) == ('large', 'big/1')
+
+
+def test_fair_scheduler_runs_lanes_on_shared_workers():
+    """Test that lane schedulers feed one worker pool and hand back messages not started"""
+    import threading
+    release = threading.Event()
+    started = []
+
+    def run(message):
+        started.append(message)
+        release.wait(5)
+
+    fair_scheduler = image_processor.FairScheduler(['small', 'large'], workers=1, max_wait=60)
+    small, large = fair_scheduler.lane_scheduler('small'), fair_scheduler.lane_scheduler('large')
+    first, waiting_large, waiting_small = [Mock(data=json.dumps({'batch_id': batch_id}).encode('utf-8'))
+                                           for batch_id in ['a', 'b', 'c']]
+    large.schedule(run, first)
+    deadline = image_processor.time.monotonic() + 5
+    while not started and image_processor.time.monotonic() < deadline:
+        image_processor.time.sleep(0.01)
+    large.schedule(run, waiting_large)
+    small.schedule(run, waiting_small)
+
+    assert fair_scheduler.leased == 3
+    assert fair_scheduler.lane_depths() == {(('lane', 'small'),): 1, (('lane', 'large'),): 1}
+    # The subscriber nacks what shutdown returns
+    assert large.shutdown() == [waiting_large]
+    release.set()
+    while len(started) < 2 and image_processor.time.monotonic() < deadline:
+        image_processor.time.sleep(0.01)
+    assert started == [first, waiting_small]
+
+
+def test_metrics_render_labelled_gauges():
+    """Test that gauges returning {labels: value} render a sample per lane"""
+    metrics = image_processor.Metrics([1], window=4)
+    metrics.set_gauge('image_processor_lane_queue_depth', lambda: {(('lane', 'large'),): 7, (('lane', 'small'),): 0})
+
+    text = metrics.render()
+
+    assert 'image_processor_lane_queue_depth{lane="large"} 7' in text
+    assert 'image_processor_lane_queue_depth{lane="small"} 0' in text
+
+
+def test_pull_leaser_sends_acks_nacks_and_extensions_in_bulk():
+    """Test that acks and nacks go out in one request each and leases near expiry are extended"""
+    subscriber_client = Mock()
+    leaser = image_processor.PullLeaser(subscriber_client, 'subscription', ack_deadline=60, flush_interval=5)
+    with patch('image_processor.time.monotonic', return_value=1000):
+        leaser.add(['ack-1', 'ack-2', 'ack-3', 'ack-4'])
+    leaser.ack('ack-1')
+    leaser.ack('ack-2')
+    leaser.nack('ack-3')
+    # Acking twice does nothing
+    leaser.ack('ack-1')
+
+    with patch('image_processor.time.monotonic', return_value=1000 + 31):
+        leaser.flush()
+        # Nothing left to send
+        leaser.stop(timeout=5)
+
+    subscriber_client.acknowledge.assert_called_once_with(
+        request={'subscription': 'subscription', 'ack_ids': ['ack-1', 'ack-2']})
+    assert [call.kwargs['request'] for call in subscriber_client.modify_ack_deadline.call_args_list] == [
+        # Leased for the full deadline as soon as they are pulled
+        {'subscription': 'subscription', 'ack_ids': ['ack-1', 'ack-2', 'ack-3', 'ack-4'],
+         'ack_deadline_seconds': 60},
+        {'subscription': 'subscription', 'ack_ids': ['ack-3'], 'ack_deadline_seconds': 0},
+        {'subscription': 'subscription', 'ack_ids': ['ack-4'], 'ack_deadline_seconds': 60}
+    ]
+    assert leaser.leased() == 1
+
+
+def received(index):
+    return Mock(ack_id=f'ack-{index}', message=Mock(data=b'{}', message_id=str(index)))
+
+
+def test_pull_worker_handles_a_batch_at_once():
+    """Test that pull mode leases a batch in one request and runs its messages concurrently"""
+    import threading
+    subscriber_client = Mock()
+    stop = threading.Event()
+    responses = [Mock(received_messages=[received(index) for index in range(3)])]
+
+    def pull(request, timeout):
+        if responses:
+            return responses.pop()
+        stop.set()
+        return Mock(received_messages=[])
+
+    subscriber_client.pull.side_effect = pull
+    # Each message waits for the others, so this only finishes if they overlap
+    barrier = threading.Barrier(3, timeout=5)
+
+    def handle(message):
+        barrier.wait()
+        message.ack()
+
+    leaser = image_processor.PullLeaser(subscriber_client, 'subscription', ack_deadline=60, flush_interval=0.01)
+    handled = image_processor.run_pull_worker(leaser, handle, batch_size=3, stop=stop)
+    leaser.stop(timeout=5)
+
+    assert handled == 3
+    assert not barrier.broken
+    assert subscriber_client.pull.call_args_list[0].kwargs['request'] == {'subscription': 'subscription',
+                                                                          'max_messages': 3}
+    acked = [ack_id for call in subscriber_client.acknowledge.call_args_list
+             for ack_id in call.kwargs['request']['ack_ids']]
+    assert sorted(acked) == ['ack-0', 'ack-1', 'ack-2']
+    # The batch's leases were extended before it was handled
+    assert subscriber_client.modify_ack_deadline.call_args_list[0].kwargs['request'] == {
+        'subscription': 'subscription', 'ack_ids': ['ack-0', 'ack-1', 'ack-2'],
+        'ack_deadline_seconds': image_processor.PULL_ACK_DEADLINE}
+
+
+def test_estimate_decode_bytes_reads_only_the_header():
+    """Test that the decode footprint comes from the header, drafted for a leading downscale"""
+    noise = Image.effect_noise((2000, 1000), 64).convert('RGB')
+    jpeg = io.BytesIO()
+    noise.save(jpeg, format='JPEG')
+    assert jpeg.tell() > 64 * 1024
+
+    jpeg.seek(0)
+    assert image_processor.estimate_decode_bytes(jpeg, [], []) == 2000 * 1000 * 4 * 3
+    assert jpeg.tell() < 64 * 1024
+
+    jpeg.seek(0)
+    # A 200x100 resize decodes at a quarter scale
+    resize = [{'filter_type': 'resize', 'filter_value': '200x100'}]
+    assert image_processor.estimate_decode_bytes(jpeg, resize, []) == 500 * 250 * 4 * 3
+
+    jpeg.seek(0)
+    enlarge = [{'filter_type': 'grayscale', 'filter_value': '1'},
+               {'filter_type': 'resize', 'filter_value': '4000x2000'}]
+    assert image_processor.estimate_decode_bytes(jpeg, enlarge, []) == 4000 * 2000 * 4 * 3
+
+
+def test_memory_budget_lets_small_images_past_a_waiting_large_one():
+    """Test that reservations that fit go ahead while a bigger one waits for memory"""
+    import threading
+    budget = image_processor.MemoryBudget(100)
+    assert budget.acquire(60, timeout=0)
+    admitted = []
+    waiting_large = threading.Thread(target=lambda: admitted.append(budget.acquire(50, timeout=5)))
+    waiting_large.start()
+
+    assert budget.acquire(30, timeout=0)
+    assert not budget.acquire(20, timeout=0)
+    budget.release(60)
+    waiting_large.join(timeout=5)
+
+    assert admitted == [50]
+    assert budget.reserved == 80
+
+
+def test_memory_budget_runs_images_bigger_than_the_budget_alone():
+    """Test that an image bigger than the whole budget waits for the rest to finish, then takes all of it"""
+    import threading
+    budget = image_processor.MemoryBudget(100)
+    assert budget.acquire(101, timeout=0) == 100
+    assert not budget.acquire(1, timeout=0)
+    budget.release(100)
+
+    assert budget.acquire(30, timeout=0) == 30
+    admitted = []
+    waiting_huge = threading.Thread(target=lambda: admitted.append(budget.acquire(500, timeout=5)))
+    waiting_huge.start()
+    deadline = image_processor.time.monotonic() + 5
+    while not budget.waiting_alone and image_processor.time.monotonic() < deadline:
+        image_processor.time.sleep(0.01)
+    # Nothing new starts while it waits for the pod to drain
+    assert not budget.acquire(10, timeout=0)
+    budget.release(30)
+    waiting_huge.join(timeout=5)
+
+    assert admitted == [100]
+    # Given up after the timeout, it no longer holds others back
+    budget.release(100)
+    assert budget.acquire(30, timeout=0) == 30
+    assert not budget.acquire(500, timeout=0)
+    assert budget.acquire(10, timeout=0) == 10
+
+
+def test_estimate_decode_bytes_of_tiled_images_counts_strips():
+    """Test that images the tiled engine filters are not charged for full-size intermediates"""
+    png = io.BytesIO()
+    Image.new('RGB', (4000, 3000)).save(png, format='PNG')
+    png.seek(0)
+
+    with patch.object(image_processor, 'TILED_PIXEL_THRESHOLD', 4000 * 3000):
+        estimate = image_processor.estimate_decode_bytes(png, [{'filter_type': 'blur', 'filter_value': '2'}], [])
+
+    assert estimate == (2 * 4000 * 3000 + 3 * 4000 * image_processor.TILE_STRIP_ROWS) * 4
+
+
+def test_callback_defers_images_that_do_not_fit(sample_message, sample_image):
+    """Test that an image that does not fit is nacked before it is downloaded, and a fitting one is released"""
+    budget = image_processor.MemoryBudget(100 * 100 * 4 * 3)
+    with patch('image_processor.storage_client') as mock_storage, \
+            patch('image_processor.memory_budget', budget), \
+            patch('image_processor.ADMISSION_TIMEOUT', 0), \
+            patch('image_processor.RESULT_CACHE_MODE', 'off'), \
+            patch('image_processor.time.sleep'), \
+            patch('image_processor.update_image_status_to_interaction_service') as mock_status:
+        mock_blob = mock_storage.bucket.return_value.get_blob.return_value
+        mock_blob.open.side_effect = lambda *args, **kwargs: io.BytesIO(sample_image)
+        mock_blob.download_as_bytes.return_value = sample_image
+
+        assert budget.acquire(1, timeout=0)
+        image_processor.callback(sample_message)
+        sample_message.nack.assert_called_once()
+        mock_blob.download_as_bytes.assert_not_called()
+
+        budget.release(1)
+        image_processor.callback(sample_message)
+        mock_status.assert_called_once()
+        assert budget.reserved == 0
+
+
+def test_pull_leaser_retries_failed_lease_extension_on_next_flush():
+    """Test that a pulled batch whose first extension fails is extended on the next flush"""
+    subscriber_client = Mock()
+    subscriber_client.modify_ack_deadline.side_effect = [Exception("unavailable"), None]
+    leaser = image_processor.PullLeaser(subscriber_client, 'subscription', ack_deadline=60, flush_interval=5)
+    leaser.add(['ack-1'])
+    leaser.flush()
+    leaser.stop(timeout=5)
+
+    assert [call.kwargs['request']['ack_ids'] for call in subscriber_client.modify_ack_deadline.call_args_list] == \
+        [['ack-1'], ['ack-1']]
@@ -0,0 +1,132 @@
+import os
+import time
+import logging
+import argparse
+import threading
+import statistics
+from concurrent.futures import Future
+from google.api_core.exceptions import AlreadyExists
+from google.cloud import pubsub_v1
+import interaction_pod
+
+
+class FakePublisher:
+    # Stand-in for PublisherClient that batches like it does: a batch is sent
+    # once it holds max_messages messages or its first message has waited
+    # max_latency seconds, and its futures resolve one round trip later.
+    # Message size limits are not modelled.
+
+    def __init__(self, round_trip, max_messages, max_latency):
+        self.round_trip = round_trip
+        self.max_messages = max_messages
+        self.max_latency = max_latency
+        self.batch = []
+        self.timer = None
+        self.lock = threading.Lock()
+
+    def publish(self, topic, data):
+        future = Future()
+        with self.lock:
+            self.batch.append(future)
+            if len(self.batch) >= self.max_messages:
+                self.send_batch()
+            elif self.timer is None:
+                self.timer = threading.Timer(self.max_latency, self.send_when_due)
+                self.timer.start()
+        return future
+
+    def send_when_due(self):
+        with self.lock:
+            self.send_batch()
+
+    def send_batch(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.batch = self.batch, []
+        if batch:
+            threading.Timer(self.round_trip, lambda: [future.set_result('message-id') for future in batch]).start()
+
+
+class TimedPublisher:
+    # Records the time from publish to the future resolving for every message
+
+    def __init__(self, publisher):
+        self.publisher = publisher
+        self.latencies = []
+        self.lock = threading.Lock()
+
+    def publish(self, topic, data):
+        start = time.perf_counter()
+        future = self.publisher.publish(topic, data)
+        future.add_done_callback(lambda _: self.record(time.perf_counter() - start))
+        return future
+
+    def record(self, latency):
+        with self.lock:
+            self.latencies.append(latency)
+
+
+def image_messages(count):
+    return [{'doc_id': f'benchmark_{index}.jpg', 'image_name': f'{index}.jpg', 'email': 'benchmark@example.com',
+             'batch_id': 'benchmark', 'filters': [{'filter_type': 'grayscale', 'filter_value': '1'}],
+             'encoder_profile': None} for index in range(count)]
+
+
+def publish_sequentially(image_data_list):
+    # What process_batch did before: wait for each message before the next
+    for image_data in image_data_list:
+        interaction_pod.push_to_image_pub_sub(image_data).result()
+    return []
+
+
+def run(name, publish, publisher, image_data_list):
+    timed = TimedPublisher(publisher)
+    interaction_pod.publisher = timed
+    start = time.perf_counter()
+    failures = publish(image_data_list)
+    elapsed = time.perf_counter() - start
+    # Done callbacks may run just after result() returns
+    while len(timed.latencies) < len(image_data_list) - len(failures):
+        time.sleep(0.001)
+    latencies = sorted(timed.latencies)
+    percentiles = statistics.quantiles(latencies, n=100)
+    print(f"{name:<12}{len(image_data_list):>10}{elapsed:>10.3f}{len(image_data_list) / elapsed:>12.0f}"
+          f"{percentiles[49] * 1000:>10.1f}{percentiles[94] * 1000:>10.1f}{percentiles[98] * 1000:>10.1f}"
+          f"{len(failures):>10}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark process_batch fan-out to the image processing topic')
+    parser.add_argument('--messages', type=int, default=1000)
+    parser.add_argument('--round-trip', type=float, default=0.03,
+                        help='Seconds per publish request of the fake publisher')
+    parser.add_argument('--emulator', action='store_true',
+                        help='Publish to the Pub/Sub emulator at PUBSUB_EMULATOR_HOST instead of a fake publisher')
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    if args.emulator:
+        if not os.getenv('PUBSUB_EMULATOR_HOST'):
+            parser.error('--emulator needs PUBSUB_EMULATOR_HOST')
+        publisher = sequential_publisher = interaction_pod.publisher
+        try:
+            publisher.create_topic(name=interaction_pod.IMAGE_PUBSUB_TOPIC)
+        except AlreadyExists:
+            pass
+        print(f"Pub/Sub emulator at {os.getenv('PUBSUB_EMULATOR_HOST')}")
+    else:
+        publisher = FakePublisher(args.round_trip, interaction_pod.PUBLISH_MAX_MESSAGES,
+                                  interaction_pod.PUBLISH_MAX_LATENCY)
+        # The sequential path ran with the client's default batch settings
+        defaults = pubsub_v1.types.BatchSettings()
+        sequential_publisher = FakePublisher(args.round_trip, defaults.max_messages, defaults.max_latency)
+        print(f"Fake publisher, {args.round_trip * 1000:.0f} ms per request")
+    print(f"Batches of up to {interaction_pod.PUBLISH_MAX_MESSAGES} messages, "
+          f"{interaction_pod.PUBLISH_MAX_LATENCY * 1000:.0f} ms max latency")
+
+    image_data_list = image_messages(args.messages)
+    print(f"{'mode':<12}{'messages':>10}{'seconds':>10}{'msgs/sec':>12}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+          f"{'failed':>10}")
+    run('sequential', publish_sequentially, sequential_publisher, image_data_list)
+    run('fan-out', interaction_pod.publish_image_messages, publisher, image_data_list)
@@ -1,11 +1,19 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 from google.cloud import storage, firestore
 from google.cloud import pubsub_v1
+from google.api_core.exceptions import AlreadyExists
 from PIL import Image, ImageEnhance, ImageFilter
 import io
 import os
+import math
+import time
+import random
 import logging
 import json
+import queue
+import socket
+import threading
+from collections import Counter
 from dotenv import load_dotenv
 from flask_cors import CORS
 current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -25,12 +33,141 @@ EMAIL_PUBSUB_TOPIC = os.getenv('EMAIL_PUBSUB_TOPIC', 'projects/dcsc-project-4406
 IMAGE_PUBSUB_TOPIC = os.getenv('IMAGE_PUBSUB_TOPIC', 'projects/dcsc-project-440602/topics/image-processing-queue')
 BATCH_TABLE_NAME=os.getenv('BATCH_TABLE_NAME','batch_uploads')
 IMAGE_METADATA_TABLE_NAME=os.getenv('IMAGE_METADATA_TABLE_NAME','image_metadata')
+# Firestore commits at most 500 writes in one batched write or transaction
+FIRESTORE_BATCH_LIMIT = 500
+# Each batch counts its unprocessed images in BATCH_TABLE_NAME/{batch_id}/
+# remaining_shards, one shard per REMAINING_SHARD_SIZE images up to
+# REMAINING_MAX_SHARDS, so completions of a large batch do not all contend
+# for one document
+REMAINING_SHARDS_COLLECTION = 'remaining_shards'
+REMAINING_SHARD_SIZE = int(os.getenv('REMAINING_SHARD_SIZE', 100))
+REMAINING_MAX_SHARDS = int(os.getenv('REMAINING_MAX_SHARDS', 16))
+# The publisher client sends a batch of messages once it holds
+# PUBLISH_MAX_MESSAGES messages or PUBLISH_MAX_BYTES bytes, or its first
+# message has waited PUBLISH_MAX_LATENCY seconds. process_batch publishes
+# every image before waiting on any, and republishes failures up to
+# PUBLISH_RETRIES times.
+PUBLISH_MAX_MESSAGES = int(os.getenv('PUBLISH_MAX_MESSAGES', 100))
+PUBLISH_MAX_BYTES = int(os.getenv('PUBLISH_MAX_BYTES', 1000000))
+PUBLISH_MAX_LATENCY = float(os.getenv('PUBLISH_MAX_LATENCY', 0.05))
+PUBLISH_RETRIES = int(os.getenv('PUBLISH_RETRIES', 3))
+PUBLISH_TIMEOUT = float(os.getenv('PUBLISH_TIMEOUT', 60))
 
-publisher = pubsub_v1.PublisherClient()
+# Size-based priority lanes, 'name:max_images' pairs from highest priority
+# down with the last lane unbounded, e.g. 'small:10,medium:200,large'. A
+# batch is published to IMAGE_PUBSUB_TOPIC-{lane} of the first lane it fits,
+# so a large batch no longer holds up small ones; image processors serve the
+# lanes by priority. Empty publishes every batch to IMAGE_PUBSUB_TOPIC.
+SCHEDULING_LANES = os.getenv('SCHEDULING_LANES', '')
+# Progress events of a batch reach its /batches/<batch_id>/events watchers
+# through a fan-out: "local" delivers them to watchers on the pod that took
+# the status update, "pubsub" shares them between pods through
+# BATCH_EVENTS_TOPIC, each pod reading its own subscription. A watcher more
+# than SSE_QUEUE_SIZE events behind is dropped and told to reconnect.
+EVENT_FANOUT = os.getenv('EVENT_FANOUT', 'local')
+BATCH_EVENTS_TOPIC = os.getenv('BATCH_EVENTS_TOPIC', 'projects/dcsc-project-440602/topics/batch-events')
+BATCH_EVENTS_SUBSCRIPTION = os.getenv('BATCH_EVENTS_SUBSCRIPTION',
+                                      f'projects/dcsc-project-440602/subscriptions/batch-events-{socket.gethostname()}')
+SSE_QUEUE_SIZE = int(os.getenv('SSE_QUEUE_SIZE', 1000))
+SSE_KEEPALIVE_SECONDS = float(os.getenv('SSE_KEEPALIVE_SECONDS', 15))
+
+publisher = pubsub_v1.PublisherClient(batch_settings=pubsub_v1.types.BatchSettings(
+    max_messages=PUBLISH_MAX_MESSAGES, max_bytes=PUBLISH_MAX_BYTES, max_latency=PUBLISH_MAX_LATENCY))
 storage_client = storage.Client(project=PROJECT_ID)
 firestore_client = firestore.Client(project=PROJECT_ID)
 
 
+class BatchWatcher:
+    # Events for one /batches/<batch_id>/events response
+    def __init__(self):
+        self.events = queue.Queue(maxsize=SSE_QUEUE_SIZE)
+        self.dropped = False
+
+class LocalEventFanout:
+    # Delivers the events of a batch to every watcher of it on this pod, so
+    # watchers share the status updates instead of each polling Firestore
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.watchers = {}
+
+    def subscribe(self, batch_id):
+        watcher = BatchWatcher()
+        with self.lock:
+            self.watchers.setdefault(batch_id, set()).add(watcher)
+        return watcher
+
+    def unsubscribe(self, batch_id, watcher):
+        with self.lock:
+            watchers = self.watchers.get(batch_id, set())
+            watchers.discard(watcher)
+            if not watchers:
+                self.watchers.pop(batch_id, None)
+
+    def publish(self, batch_id, event):
+        self.deliver(batch_id, event)
+
+    def deliver(self, batch_id, event):
+        with self.lock:
+            watchers = list(self.watchers.get(batch_id, ()))
+        for watcher in watchers:
+            try:
+                watcher.events.put_nowait(event)
+            except queue.Full:
+                logging.warning(f"Dropping a watcher of batch {batch_id} that fell behind")
+                watcher.dropped = True
+                self.unsubscribe(batch_id, watcher)
+
+class PubSubEventFanout(LocalEventFanout):
+    # Publishes events to BATCH_EVENTS_TOPIC and delivers those of every pod
+    # to the watchers on this one. The pod's subscription is created and
+    # pulled from with its first watcher.
+    def __init__(self):
+        super().__init__()
+        self.streaming_pull = None
+
+    def subscribe(self, batch_id):
+        with self.lock:
+            if self.streaming_pull is None or self.streaming_pull.done():
+                self.streaming_pull = self.start_pull()
+        return super().subscribe(batch_id)
+
+    def start_pull(self):
+        subscriber = pubsub_v1.SubscriberClient()
+        try:
+            subscriber.create_subscription(request={
+                'name': BATCH_EVENTS_SUBSCRIPTION,
+                'topic': BATCH_EVENTS_TOPIC,
+                # Removed a day after its pod stops pulling
+                'expiration_policy': {'ttl': {'seconds': 24 * 60 * 60}}
+            })
+        except AlreadyExists:
+            pass
+        return subscriber.subscribe(BATCH_EVENTS_SUBSCRIPTION, callback=self.on_message)
+
+    def on_message(self, message):
+        try:
+            event = json.loads(message.data.decode('utf-8'))
+            self.deliver(event['batch_id'], event)
+        except Exception as e:
+            logging.error(f"Dropping malformed batch event: {e}")
+        message.ack()
+
+    def publish(self, batch_id, event):
+        publisher.publish(BATCH_EVENTS_TOPIC, json.dumps(event).encode('utf-8'))
+
+batch_events = PubSubEventFanout() if EVENT_FANOUT == 'pubsub' else LocalEventFanout()
+
+def publish_batch_event(batch_id, event_type, **fields):
+    # Progress is best effort: a lost event must not fail a status update
+    try:
+        batch_events.publish(batch_id, {'type': event_type, 'batch_id': batch_id, **fields})
+    except Exception as e:
+        logging.error(f"Failed to publish {event_type} event of batch {batch_id}: {e}")
+
+def format_sse(event):
+    return f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
+
+
 def get_batch_details(batch_id):
     try:
         doc_ref = firestore_client.collection(BATCH_TABLE_NAME).document(batch_id)
@@ -60,7 +197,9 @@ def get_formatted_metadata_by_batch_id(batch_id, email):
             "image_name": doc.get("image_name"),
             "email": email,
             "batch_id": doc.get("batch_id"),
-            "filters": doc.get("filter_json")
+            "filters": doc.get("filter_json"),
+            # Missing on documents written before encoder profiles existed
+            "encoder_profile": doc.to_dict().get("encoder_profile")
         }
         for doc in docs
     ]
@@ -73,9 +212,123 @@ def get_formatted_metadata_by_batch_id(batch_id, email):
 
     return formatted_metadata_list
 
-def mark_image_as_processed(doc_id):
-    obj = firestore_client.collection(IMAGE_METADATA_TABLE_NAME).document(doc_id)
-    obj.update({'is_processed': True})
+def get_formatted_metadata_from_manifest(manifest):
+    # Same messages as get_formatted_metadata_by_batch_id, built from the manifest
+    # the image handler posts with the batch so dispatch reads nothing back
+    batch_id = manifest['batch_id']
+    return [
+        {
+            "doc_id": image['doc_id'],
+            "image_name": image['image_name'],
+            "email": manifest.get('email'),
+            "batch_id": batch_id,
+            "filters": image.get('filters', []),
+            "encoder_profile": image.get('encoder_profile')
+        }
+        for image in manifest['images']
+    ]
+
+def is_valid_manifest(manifest):
+    if not isinstance(manifest, dict) or not manifest.get('batch_id') or not isinstance(manifest.get('images'), list):
+        return False
+    return all(isinstance(image, dict) and image.get('doc_id') and image.get('image_name')
+               for image in manifest['images'])
+
+def remaining_shard_refs(batch_id, shards):
+    batch_ref = firestore_client.collection(BATCH_TABLE_NAME).document(batch_id)
+    return [batch_ref.collection(REMAINING_SHARDS_COLLECTION).document(str(shard)) for shard in range(shards)]
+
+@firestore.transactional
+def start_remaining_count_in_transaction(transaction, batch_id, image_count):
+    batch_ref = firestore_client.collection(BATCH_TABLE_NAME).document(batch_id)
+    batch = batch_ref.get(transaction=transaction)
+    # A repeated process_batch must not reset a count that is already running
+    if (batch.to_dict() or {}).get('remaining_shards'):
+        return False
+    shards = min(REMAINING_MAX_SHARDS, max(1, math.ceil(image_count / REMAINING_SHARD_SIZE)))
+    # The count only matters summed over the shards, so it all starts in one
+    for shard, shard_ref in enumerate(remaining_shard_refs(batch_id, shards)):
+        transaction.set(shard_ref, {'count': image_count if shard == 0 else 0})
+    transaction.update(batch_ref, {'remaining_shards': shards})
+    return True
+
+def start_remaining_count(batch_id, image_count):
+    return start_remaining_count_in_transaction(firestore_client.transaction(), batch_id, image_count)
+
+def get_remaining_shards(batch_ids):
+    # {batch_id: number of remaining count shards}, None for batches started
+    # before the remaining count existed
+    batch_refs = [firestore_client.collection(BATCH_TABLE_NAME).document(batch_id) for batch_id in batch_ids]
+    return {snapshot.id: (snapshot.to_dict() or {}).get('remaining_shards')
+            for snapshot in firestore_client.get_all(batch_refs, field_paths=['remaining_shards']) if snapshot.exists}
+
+@firestore.transactional
+def mark_images_in_transaction(transaction, requested, remaining_shards, errors=None):
+    # Marks the still unprocessed images of requested ({doc_id: batch_id})
+    # processed and takes them off their batch's remaining count, so an image
+    # reported twice is only counted once. Images in errors ({doc_id: reason})
+    # could not be processed and are marked done with their error. Returns
+    # {doc_id: batch_id} of the images that exist.
+    errors = errors or {}
+    collection = firestore_client.collection(IMAGE_METADATA_TABLE_NAME)
+    snapshots = transaction.get_all([collection.document(doc_id) for doc_id in requested])
+    found = {}
+    newly_processed = Counter()
+    for snapshot in snapshots:
+        if not snapshot.exists:
+            continue
+        data = snapshot.to_dict()
+        found[snapshot.id] = data.get('batch_id')
+        if data.get('batch_id') == requested[snapshot.id] and not data.get('is_processed'):
+            fields = {'is_processed': True}
+            if errors.get(snapshot.id):
+                fields['error'] = errors[snapshot.id]
+            transaction.update(snapshot.reference, fields)
+            newly_processed[data.get('batch_id')] += 1
+
+    # A random shard, so concurrent updates of a large batch rarely contend
+    for batch_id, count in newly_processed.items():
+        shards = remaining_shards.get(batch_id)
+        if shards:
+            shard_ref = remaining_shard_refs(batch_id, shards)[random.randrange(shards)]
+            transaction.update(shard_ref, {'count': firestore.Increment(-count)})
+    return found
+
+def mark_images_as_processed(updates):
+    # Marks many images processed, a transaction per FIRESTORE_BATCH_LIMIT / 2
+    # images to leave room for the counter writes. updates is a list of
+    # {'doc_id', 'batch_id'}, plus 'error' for an image that failed for good;
+    # returns a result per update, in order, and the remaining count shards
+    # of the batches involved.
+    results = [{'doc_id': update.get('doc_id'), 'batch_id': update.get('batch_id'), 'status': 'success'}
+               for update in updates]
+    for result in results:
+        if not (result['doc_id'] and result['batch_id']):
+            result.update({'status': 'error', 'message': 'doc_id and batch_id are required'})
+    valid = [result for result in results if result['status'] == 'success']
+    remaining_shards = get_remaining_shards(list(dict.fromkeys(result['batch_id'] for result in valid)))
+
+    requested = {result['doc_id']: result['batch_id'] for result in valid}
+    errors = {update.get('doc_id'): update['error'] for update in updates if update.get('error')}
+    doc_ids = list(requested)
+    chunk_size = FIRESTORE_BATCH_LIMIT // 2
+    for start in range(0, len(doc_ids), chunk_size):
+        chunk = {doc_id: requested[doc_id] for doc_id in doc_ids[start:start + chunk_size]}
+        try:
+            found = mark_images_in_transaction(firestore_client.transaction(), chunk, remaining_shards, errors)
+        except Exception as e:
+            logging.error(f"Error marking {len(chunk)} images as processed: {e}")
+            found = None
+        for result in valid:
+            if result['doc_id'] not in chunk:
+                continue
+            if found is None:
+                result.update({'status': 'error', 'message': 'Could not update the image'})
+            elif result['doc_id'] not in found:
+                result.update({'status': 'error', 'message': 'No such image'})
+            elif found[result['doc_id']] != result['batch_id']:
+                result.update({'status': 'error', 'message': 'Image is not in this batch'})
+    return results, remaining_shards
 
 def check_if_all_images_in_the_batch_are_processed(batch_id):
     query = firestore_client.collection(IMAGE_METADATA_TABLE_NAME).where('batch_id', '==', batch_id).where('is_processed', '==', False)
@@ -83,25 +336,115 @@ def check_if_all_images_in_the_batch_are_processed(batch_id):
     count = sum(1 for _ in docs)
     return True if count==0 else False
 
-def update_batch_status_to_completed(batch_id):
-    obj = firestore_client.collection(BATCH_TABLE_NAME).document(batch_id)
-    obj.update({'job_status': "Completed"})
+def get_remaining_image_count(batch_id, shards):
+    return sum((snapshot.to_dict() or {}).get('count', 0)
+               for snapshot in firestore_client.get_all(remaining_shard_refs(batch_id, shards)))
 
-def push_to_image_pub_sub(message_data):
-    try:        
-        # Serialize the message to JSON format
-        data = json.dumps(message_data).encode('utf-8')
-        
-        # Publish the message to Pub/Sub
-        future = publisher.publish(IMAGE_PUBSUB_TOPIC, data)
-        future.result()  # Block until the message is published
-        print("Pushed to Image Processing Pub/Sub")
-        logging.info("Pushed to Image Processing Pub/Sub")
-        
-    except Exception as e:
-        print(str(e))
-        logging.error(str(e))  # Use error logging for exceptions
-        # return jsonify({'status': 'error', 'message': str(e)}), 500
+@firestore.transactional
+def claim_batch_completion_in_transaction(transaction, batch_id):
+    # Marks the batch completed. Only the one caller that changes it gets
+    # True, so concurrent last updates send a single email.
+    batch_ref = firestore_client.collection(BATCH_TABLE_NAME).document(batch_id)
+    batch = batch_ref.get(transaction=transaction)
+    if (batch.to_dict() or {}).get('email_sent'):
+        return False
+    transaction.update(batch_ref, {'job_status': "Completed", 'email_sent': True})
+    return True
+
+def complete_batch_if_all_images_processed(batch_id, remaining_shards=None):
+    # Every update reads the count after its own decrement committed, so the
+    # last one to do so sees zero even when several finish at once
+    if remaining_shards:
+        all_processed = get_remaining_image_count(batch_id, remaining_shards) <= 0
+    else:
+        all_processed = check_if_all_images_in_the_batch_are_processed(batch_id)
+    if not all_processed or not claim_batch_completion_in_transaction(firestore_client.transaction(), batch_id):
+        return
+    _, status_code = push_to_email_notification_pub_sub(batch_id)
+    if status_code != 200:
+        # Release the claim so the caller's retry sends the email
+        firestore_client.collection(BATCH_TABLE_NAME).document(batch_id).update({'email_sent': False})
+        raise RuntimeError(f"Could not send the completion email for batch {batch_id}")
+    publish_batch_event(batch_id, 'completed')
+
+def apply_image_status_updates(updates):
+    # Marks the images processed and completes the batches they finish
+    results, remaining_shards = mark_images_as_processed(updates)
+    for update, result in zip(updates, results):
+        if result['status'] == 'success' and update.get('error'):
+            publish_batch_event(result['batch_id'], 'image', doc_id=result['doc_id'], error=update['error'])
+        elif result['status'] == 'success':
+            publish_batch_event(result['batch_id'], 'image', doc_id=result['doc_id'])
+
+    # Check completion once per batch rather than once per image. Batches of
+    # images that were already processed are checked too, so a retry after a
+    # failed completion completes the batch.
+    for batch_id in dict.fromkeys(result['batch_id'] for result in results if result['status'] == 'success'):
+        try:
+            complete_batch_if_all_images_processed(batch_id, remaining_shards.get(batch_id))
+        except Exception as e:
+            # The images are marked; failing them makes the caller retry,
+            # which runs the completion check again
+            logging.error(f"Error completing batch {batch_id}: {e}")
+            for result in results:
+                if result['batch_id'] == batch_id and result['status'] == 'success':
+                    result.update({'status': 'error', 'message': str(e)})
+    return results
+
+def parse_lanes(spec):
+    # [(lane, max_images)] from 'small:10,medium:200,large'
+    lanes = []
+    for entry in filter(None, (entry.strip() for entry in spec.split(','))):
+        name, _, max_images = entry.partition(':')
+        lanes.append((name, int(max_images) if max_images else None))
+    return lanes
+
+def image_topic_for_batch(image_count):
+    # Topic of the lane a batch of image_count images is published to
+    lanes = parse_lanes(SCHEDULING_LANES)
+    if not lanes:
+        return IMAGE_PUBSUB_TOPIC
+    for name, max_images in lanes:
+        if max_images is None or image_count <= max_images:
+            return f'{IMAGE_PUBSUB_TOPIC}-{name}'
+    return f'{IMAGE_PUBSUB_TOPIC}-{lanes[-1][0]}'
+
+def push_to_image_pub_sub(message_data, topic=IMAGE_PUBSUB_TOPIC):
+    # Hands the message to the publisher's current batch and returns its
+    # future without waiting for it
+    data = json.dumps(message_data).encode('utf-8')
+    return publisher.publish(topic, data)
+
+def publish_image_messages(image_data_list, topic=IMAGE_PUBSUB_TOPIC):
+    # Publishes all messages, then waits on their futures together, and
+    # republishes the failed ones with backoff. Returns [(image_data, error)]
+    # for messages that could not be published.
+    pending = image_data_list
+    failures = []
+    for attempt in range(PUBLISH_RETRIES + 1):
+        if attempt:
+            time.sleep(min(0.5 * 2 ** (attempt - 1), 10))
+            logging.info(f"Retrying {len(pending)} failed publishes, attempt {attempt + 1}")
+        futures = []
+        failures = []
+        for image_data in pending:
+            try:
+                futures.append((push_to_image_pub_sub(image_data, topic), image_data))
+            except Exception as e:
+                failures.append((image_data, e))
+        # Every message is already on its way, so waiting on them in turn
+        # takes as long as the slowest
+        deadline = time.monotonic() + PUBLISH_TIMEOUT
+        for future, image_data in futures:
+            try:
+                future.result(timeout=max(0, deadline - time.monotonic()))
+            except Exception as e:
+                failures.append((image_data, e))
+        if not failures:
+            break
+        pending = [image_data for image_data, _ in failures]
+    logging.info(f"Pushed {len(image_data_list) - len(failures)} of {len(image_data_list)} images to Image Processing Pub/Sub")
+    return failures
 
 def push_to_email_notification_pub_sub(batch_id):
     try:
@@ -129,23 +472,48 @@ def push_to_email_notification_pub_sub(batch_id):
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
 # DONE
-@app.route('/process_batch', methods=['GET'])
+# GET ?batch_id= reads the batch back from Firestore. POST takes the batch
+# manifest from the image handler instead:
+# {"batch_id": ..., "email": ..., "images": [{"doc_id", "image_name", "filters", "encoder_profile"}]}
+@app.route('/process_batch', methods=['GET', 'POST'])
 def process_batch():
     logging.info("coming to process images")
     client_ip = request.remote_addr
     logging.debug(f"Received request from IP: {client_ip}")
+    if request.method == 'POST':
+        manifest = request.get_json(silent=True)
+        if not is_valid_manifest(manifest):
+            return jsonify({'status': 'error',
+                            'message': 'Expected {"batch_id": ..., "email": ..., "images": [...]}'}), 400
     try:
-        batch_id = request.args.get('batch_id')
-        logging.info(f"processing for batch: {batch_id} for the image upload")
-        batch_obj=get_batch_details(batch_id)
-        email = batch_obj['email']
-        image_data_list = get_formatted_metadata_by_batch_id(batch_id, email)
+        if request.method == 'POST':
+            batch_id = manifest['batch_id']
+            logging.info(f"processing manifest for batch: {batch_id} with {len(manifest['images'])} images")
+            image_data_list = get_formatted_metadata_from_manifest(manifest)
+        else:
+            batch_id = request.args.get('batch_id')
+            logging.info(f"processing for batch: {batch_id} for the image upload")
+            batch_obj=get_batch_details(batch_id)
+            email = batch_obj['email']
+            image_data_list = get_formatted_metadata_by_batch_id(batch_id, email)
         logging.info(f"after metadata: {image_data_list}")
-        for image_data in image_data_list:
-            push_to_image_pub_sub(image_data)
+        # Before publishing, so no image can finish before the count exists
+        start_remaining_count(batch_id, len(image_data_list))
+        topic = image_topic_for_batch(len(image_data_list))
+        logging.info(f"Publishing {len(image_data_list)} images of batch {batch_id} to {topic}")
+        failures = publish_image_messages(image_data_list, topic)
 
         doc_ref = firestore_client.collection(BATCH_TABLE_NAME).document(batch_id)
         doc_ref.update({"job_status": 'In Progress'})  
+        if failures:
+            for image_data, error in failures:
+                logging.error(f"Failed to push {image_data['image_name']} to Pub/Sub: {error}")
+            return jsonify({
+                'status': 'error',
+                'message': f'{len(failures)} of {len(image_data_list)} images could not be pushed to Pub/Sub',
+                'failed_images': [{'doc_id': image_data['doc_id'], 'image_name': image_data['image_name'],
+                                   'error': str(error)} for image_data, error in failures]
+            }), 500
         return jsonify({'status': 'success', 'message': 'Pushed to Pub/Sub for processing'}), 200
     except Exception as e:
         print(str(e))
@@ -161,17 +529,84 @@ def update_image_status():
     try:
         image_doc_id = request.args.get('doc_id')
         batch_id= request.args.get('batch_id')
+        # Set when the image failed for good
+        error = request.args.get('error')
+
+        result = apply_image_status_updates([{'doc_id': image_doc_id, 'batch_id': batch_id, 'error': error}])[0]
+        if result['status'] != 'success':
+            raise RuntimeError(result['message'])
 
-        mark_image_as_processed(image_doc_id)
-        if check_if_all_images_in_the_batch_are_processed(batch_id):
-            update_batch_status_to_completed(batch_id)
-            push_to_email_notification_pub_sub(batch_id)
-        
         return jsonify({'status': 'success', 'message': 'Request Completed'}), 200
     except Exception as e:
         print(str(e))
         logging.error(str(e))  # Use error logging for exceptions
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
+
+@app.route('/update_image_statuses', methods=['POST'])
+def update_image_statuses():
+    # Bulk /update_image_status: {"updates": [{"doc_id": ..., "batch_id": ..., "error": ...}]},
+    # error only for images that failed for good.
+    # Responds with a result per update so the caller retries only failures.
+    client_ip = request.remote_addr
+    logging.info(f"Received request from IP: {client_ip}")
+    body = request.get_json(silent=True) or {}
+    updates = body.get('updates')
+    if not isinstance(updates, list) or not all(isinstance(update, dict) for update in updates):
+        return jsonify({'status': 'error', 'message': 'Expected a list of updates'}), 400
+    try:
+        results = apply_image_status_updates(updates)
+        logging.info(f"Updated {sum(result['status'] == 'success' for result in results)} of {len(results)} image statuses")
+        return jsonify({'status': 'success', 'results': results}), 200
+    except Exception as e:
+        print(str(e))
+        logging.error(str(e))  # Use error logging for exceptions
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+# Server-sent events of a batch's progress: a "status" event with the batch
+# as it is when the watcher connects, then an "image" event per processed
+# image, with its error if it failed, and a "completed" event, which ends the
+# stream. A "reset" event asks a watcher that fell behind to reconnect.
+@app.route('/batches/<batch_id>/events', methods=['GET'])
+def batch_events_stream(batch_id):
+    # Subscribed before the batch is read, so no update falls in between
+    watcher = batch_events.subscribe(batch_id)
+    try:
+        batch = firestore_client.collection(BATCH_TABLE_NAME).document(batch_id).get()
+        if not batch.exists:
+            batch_events.unsubscribe(batch_id, watcher)
+            return jsonify({'status': 'error', 'message': 'No such batch'}), 404
+        data = batch.to_dict()
+        status = {'type': 'status', 'batch_id': batch_id, 'job_status': data.get('job_status'),
+                  'image_count': data.get('image_count')}
+        if data.get('remaining_shards') and data.get('job_status') != 'Completed':
+            status['remaining'] = get_remaining_image_count(batch_id, data['remaining_shards'])
+    except Exception as e:
+        batch_events.unsubscribe(batch_id, watcher)
+        logging.error(f"Failed to read batch {batch_id}: {e}")
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+    def stream():
+        try:
+            yield format_sse(status)
+            if status['job_status'] == 'Completed':
+                return
+            while not watcher.dropped or not watcher.events.empty():
+                try:
+                    event = watcher.events.get(timeout=SSE_KEEPALIVE_SECONDS)
+                except queue.Empty:
+                    # Also finds out when the watcher has gone
+                    yield ": keepalive\n\n"
+                    continue
+                yield format_sse(event)
+                if event['type'] == 'completed':
+                    return
+            yield format_sse({'type': 'reset', 'batch_id': batch_id})
+        finally:
+            batch_events.unsubscribe(batch_id, watcher)
+
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=8080, debug=True)
@@ -1,8 +1,10 @@
 import pytest
 from unittest.mock import Mock, patch
 from flask import Flask
+import interaction_pod
 from interaction_pod import app
 import json
+from collections import Counter
 
 
 @pytest.fixture
@@ -15,6 +17,8 @@ def client():
 @pytest.fixture
 def mock_firestore():
     with patch('interaction_pod.firestore_client') as mock_client:
+        # Enough of a transaction for firestore.transactional to run it once
+        mock_client.transaction.return_value = Mock(_max_attempts=1, _read_only=False)
         yield mock_client
 
 
@@ -85,27 +89,30 @@ def test_process_batch_success(client, mock_firestore, mock_publisher):
     assert mock_publisher.publish.call_count == 2
 
 
+def image_snapshot(doc_id, batch_id, is_processed=False):
+    return Mock(id=doc_id, exists=True, reference=Mock(id=doc_id),
+                to_dict=Mock(return_value={'batch_id': batch_id, 'is_processed': is_processed}))
+
+
+def set_up_batch(mock_firestore, batch, remaining):
+    # batch is the batch document; remaining the counts of its counter shards
+    mock_batch_doc = Mock(id='test-batch-456', exists=True)
+    mock_batch_doc.to_dict.return_value = batch
+    mock_batch_doc.get = lambda field: batch.get(field)
+    mock_firestore.collection.return_value.document.return_value.get.return_value = mock_batch_doc
+    shards = [Mock(to_dict=Mock(return_value={'count': count})) for count in remaining]
+    mock_firestore.get_all.side_effect = [[mock_batch_doc], shards]
+
+
 def test_update_image_status_completion(client, mock_firestore, mock_publisher):
     # Mock data
     doc_id = "test-doc-123"
     batch_id = "test-batch-456"
 
-    # Mock no remaining unprocessed images
-    mock_docs = []
-    mock_query = Mock()
-    mock_query.stream.return_value = mock_docs
-    mock_where2 = Mock()
-    mock_where2.where.return_value = mock_query
-    mock_firestore.collection.return_value.where.return_value = mock_where2
-
-    # Mock batch details for email notification
-    mock_doc_dict = {
-        'email': 'test@example.com',
-        'image_count': 1
-    }
-    mock_batch_doc = Mock()
-    mock_batch_doc.get = lambda x: mock_doc_dict.get(x)
-    mock_firestore.collection.return_value.document.return_value.get.return_value = mock_batch_doc
+    transaction = mock_firestore.transaction.return_value
+    transaction.get_all.return_value = [image_snapshot(doc_id, batch_id)]
+    set_up_batch(mock_firestore, {'email': 'test@example.com', 'image_count': 1, 'email_sent': False,
+                                  'remaining_shards': 1}, remaining=[0])
 
     # Mock publisher
     future = Mock()
@@ -121,9 +128,349 @@ def test_update_image_status_completion(client, mock_firestore, mock_publisher):
     assert response_data['status'] == 'success'
     assert response_data['message'] == 'Request Completed'
 
-    # Verify Firestore updates
-    mock_firestore.collection.return_value.document.return_value.update.assert_any_call({'is_processed': True})
-    mock_firestore.collection.return_value.document.return_value.update.assert_any_call({'job_status': 'Completed'})
+    # The image is marked and taken off the remaining count in one transaction
+    update_calls = [call.args for call in transaction.update.call_args_list]
+    assert update_calls[0][1] == {'is_processed': True}
+    assert update_calls[1][1]['count'].value == -1
+    # The completion claim also marks the batch completed
+    assert update_calls[2][1] == {'job_status': 'Completed', 'email_sent': True}
+    # Completion comes from the counter, not from querying unprocessed images
+    mock_firestore.collection.return_value.where.assert_not_called()
 
     # Verify email notification was sent
-    mock_publisher.publish.assert_called_once()
\ No newline at end of file
+    mock_publisher.publish.assert_called_once()
+
+
+def test_update_image_status_counts_each_image_once(client, mock_firestore, mock_publisher):
+    # A redelivered update for an image that is already processed
+    transaction = mock_firestore.transaction.return_value
+    transaction.get_all.return_value = [image_snapshot('test-doc-123', 'test-batch-456', is_processed=True)]
+    set_up_batch(mock_firestore, {'email_sent': False, 'remaining_shards': 1}, remaining=[1])
+
+    response = client.get('/update_image_status?doc_id=test-doc-123&batch_id=test-batch-456')
+
+    assert response.status_code == 200
+    transaction.update.assert_not_called()
+    mock_publisher.publish.assert_not_called()
+
+
+def test_update_image_status_sends_one_email(client, mock_firestore, mock_publisher):
+    # Another update has already completed the batch
+    transaction = mock_firestore.transaction.return_value
+    transaction.get_all.return_value = [image_snapshot('test-doc-123', 'test-batch-456')]
+    set_up_batch(mock_firestore, {'email_sent': True, 'remaining_shards': 2}, remaining=[1, -1])
+
+    response = client.get('/update_image_status?doc_id=test-doc-123&batch_id=test-batch-456')
+
+    assert response.status_code == 200
+    assert len(transaction.update.call_args_list) == 2
+    mock_publisher.publish.assert_not_called()
+
+
+def test_process_batch_starts_remaining_count(client, mock_firestore, mock_publisher):
+    batch_id = "test-batch-789"
+    mock_batch_doc = Mock()
+    mock_batch_doc.to_dict.return_value = {'email': 'test@example.com', 'image_count': 250}
+    mock_firestore.collection.return_value.document.return_value.get.return_value = mock_batch_doc
+    metadata = {'image_name': 'test1.jpg', 'batch_id': batch_id, 'filter_json': []}
+    mock_docs = [Mock(id=f'doc{index}', get=metadata.get, to_dict=Mock(return_value=metadata)) for index in range(250)]
+    mock_firestore.collection.return_value.where.return_value.get.return_value = mock_docs
+
+    response = client.get(f'/process_batch?batch_id={batch_id}')
+
+    assert response.status_code == 200
+    transaction = mock_firestore.transaction.return_value
+    # 250 images need three shards of 100, all starting in the first
+    assert [call.args[1] for call in transaction.set.call_args_list] == [{'count': 250}, {'count': 0}, {'count': 0}]
+    transaction.update.assert_called_once_with(mock_firestore.collection.return_value.document.return_value,
+                                               {'remaining_shards': 3})
+
+
+def test_process_batch_forwards_encoder_profile(client, mock_firestore, mock_publisher):
+    batch_id = "test-batch-789"
+    mock_batch_doc = Mock()
+    mock_batch_doc.to_dict.return_value = {'email': 'test@example.com', 'image_count': 1}
+    mock_firestore.collection.return_value.document.return_value.get.return_value = mock_batch_doc
+
+    metadata = {'image_name': 'test1.jpg', 'batch_id': batch_id, 'filter_json': [], 'encoder_profile': 'small'}
+    mock_doc = Mock(id='doc1')
+    mock_doc.get = lambda field: metadata[field]
+    mock_doc.to_dict.return_value = metadata
+    mock_firestore.collection.return_value.where.return_value.get.return_value = [mock_doc]
+
+    response = client.get(f'/process_batch?batch_id={batch_id}')
+
+    assert response.status_code == 200
+    published = json.loads(mock_publisher.publish.call_args[0][1])
+    assert published['encoder_profile'] == 'small'
+
+
+def test_process_batch_from_manifest(client, mock_firestore, mock_publisher):
+    manifest = {'batch_id': 'test-batch-789', 'email': 'test@example.com', 'images': [
+        {'doc_id': f'test-batch-789_{index}.jpg', 'image_name': f'{index}.jpg',
+         'filters': [{'filter_type': 'blur', 'filter_value': '2'}], 'encoder_profile': 'small'}
+        for index in range(3)
+    ]}
+    batch_ref = mock_firestore.collection.return_value.document.return_value
+    batch_ref.get.return_value.to_dict.return_value = {'email': 'test@example.com', 'image_count': 3}
+
+    response = client.post('/process_batch', json=manifest)
+
+    assert response.status_code == 200
+    # Nothing is read back: no metadata query, and the batch document only
+    # inside the transaction that starts the remaining count
+    mock_firestore.collection.return_value.where.assert_not_called()
+    transaction = mock_firestore.transaction.return_value
+    batch_ref.get.assert_called_once_with(transaction=transaction)
+    assert transaction.set.call_args_list[0].args[1] == {'count': 3}
+    published = [json.loads(call.args[1]) for call in mock_publisher.publish.call_args_list]
+    assert published[0] == {'doc_id': 'test-batch-789_0.jpg', 'image_name': '0.jpg', 'email': 'test@example.com',
+                            'batch_id': 'test-batch-789', 'filters': [{'filter_type': 'blur', 'filter_value': '2'}],
+                            'encoder_profile': 'small'}
+    assert [message['image_name'] for message in published] == ['0.jpg', '1.jpg', '2.jpg']
+
+
+@pytest.mark.parametrize('image_count, lane', [(3, 'small'), (10, 'small'), (11, 'medium'), (5000, 'large')])
+def test_process_batch_publishes_to_lane_of_batch_size(client, mock_firestore, mock_publisher, image_count, lane):
+    manifest = {'batch_id': 'test-batch-789', 'email': 'test@example.com', 'images': [
+        {'doc_id': f'test-batch-789_{index}.jpg', 'image_name': f'{index}.jpg'} for index in range(image_count)
+    ]}
+
+    with patch('interaction_pod.SCHEDULING_LANES', 'small:10,medium:200,large'):
+        response = client.post('/process_batch', json=manifest)
+
+    assert response.status_code == 200
+    topics = {call.args[0] for call in mock_publisher.publish.call_args_list}
+    assert topics == {f'{interaction_pod.IMAGE_PUBSUB_TOPIC}-{lane}'}
+
+
+def test_process_batch_rejects_malformed_manifest(client, mock_firestore, mock_publisher):
+    response = client.post('/process_batch', json={'batch_id': 'test-batch-789', 'images': [{'doc_id': 'doc1'}]})
+
+    assert response.status_code == 400
+    mock_firestore.transaction.assert_not_called()
+    mock_publisher.publish.assert_not_called()
+
+
+def test_update_image_statuses_batches_writes(client, mock_firestore, mock_publisher):
+    transaction = mock_firestore.transaction.return_value
+    transaction.get_all.return_value = [
+        image_snapshot('doc1', 'test-batch-456'),
+        image_snapshot('doc2', 'test-batch-456'),
+        Mock(id='doc3', exists=False),
+        image_snapshot('doc4', 'batch-2')
+    ]
+    set_up_batch(mock_firestore, {'email': 'test@example.com', 'image_count': 2, 'email_sent': False,
+                                  'remaining_shards': 1}, remaining=[0])
+    mock_publisher.publish.return_value.result.return_value = None
+
+    response = client.post('/update_image_statuses', json={'updates': [
+        {'doc_id': 'doc1', 'batch_id': 'test-batch-456'},
+        {'doc_id': 'doc2', 'batch_id': 'test-batch-456'},
+        {'doc_id': 'doc3', 'batch_id': 'test-batch-456'},
+        {'doc_id': 'doc4', 'batch_id': 'test-batch-456'}
+    ]})
+
+    assert response.status_code == 200
+    results = json.loads(response.data)['results']
+    assert [result['status'] for result in results] == ['success', 'success', 'error', 'error']
+    assert results[2]['message'] == 'No such image'
+    assert results[3]['message'] == 'Image is not in this batch'
+
+    # Every image is read and written in one transaction, with a single
+    # decrement of the batch's remaining count
+    transaction.get_all.assert_called_once()
+    update_calls = [call.args for call in transaction.update.call_args_list]
+    assert [args[0].id for args in update_calls[:2]] == ['doc1', 'doc2']
+    assert update_calls[2][1]['count'].value == -2
+    # One completion check and one email for the batch
+    assert mock_firestore.get_all.call_count == 2
+    mock_publisher.publish.assert_called_once()
+
+
+def test_update_image_statuses_rejects_malformed_body(client, mock_firestore):
+    response = client.post('/update_image_statuses', json={'doc_id': 'doc1'})
+
+    assert response.status_code == 400
+    mock_firestore.batch.assert_not_called()
+
+
+def set_up_dispatch(mock_firestore, image_names):
+    batch_id = "test-batch-789"
+    mock_batch_doc = Mock()
+    mock_batch_doc.to_dict.return_value = {'email': 'test@example.com', 'image_count': len(image_names)}
+    mock_firestore.collection.return_value.document.return_value.get.return_value = mock_batch_doc
+    mock_docs = []
+    for image_name in image_names:
+        metadata = {'image_name': image_name, 'batch_id': batch_id, 'filter_json': []}
+        mock_docs.append(Mock(id=f'doc-{image_name}', get=metadata.get, to_dict=Mock(return_value=metadata)))
+    mock_firestore.collection.return_value.where.return_value.get.return_value = mock_docs
+    return batch_id
+
+
+def publish_future(error=None):
+    future = Mock()
+    if error:
+        future.result.side_effect = error
+    return future
+
+
+def test_process_batch_publishes_before_waiting_and_retries(client, mock_firestore, mock_publisher):
+    batch_id = set_up_dispatch(mock_firestore, ['a.jpg', 'b.jpg', 'c.jpg'])
+    events = []
+    attempts = Counter()
+
+    def publish(topic, data):
+        image_name = json.loads(data)['image_name']
+        events.append(('publish', image_name))
+        attempts[image_name] += 1
+
+        def result(timeout=None):
+            events.append(('wait', image_name))
+            if image_name == 'b.jpg' and attempts[image_name] == 1:
+                raise RuntimeError('unavailable')
+            return 'message-id'
+
+        return Mock(result=Mock(side_effect=result))
+
+    mock_publisher.publish.side_effect = publish
+    with patch('interaction_pod.time.sleep'):
+        response = client.get(f'/process_batch?batch_id={batch_id}')
+
+    assert response.status_code == 200
+    # Every message is published before the first wait; only the failure is retried
+    assert events == [('publish', 'a.jpg'), ('publish', 'b.jpg'), ('publish', 'c.jpg'),
+                      ('wait', 'a.jpg'), ('wait', 'b.jpg'), ('wait', 'c.jpg'),
+                      ('publish', 'b.jpg'), ('wait', 'b.jpg')]
+
+
+def test_process_batch_reports_failed_publishes(client, mock_firestore, mock_publisher):
+    batch_id = set_up_dispatch(mock_firestore, ['a.jpg', 'b.jpg'])
+    mock_publisher.publish.side_effect = lambda topic, data: publish_future(
+        RuntimeError('unavailable') if json.loads(data)['image_name'] == 'b.jpg' else None)
+
+    with patch('interaction_pod.time.sleep'), patch('interaction_pod.PUBLISH_RETRIES', 2):
+        response = client.get(f'/process_batch?batch_id={batch_id}')
+
+    assert response.status_code == 500
+    response_data = json.loads(response.data)
+    assert response_data['failed_images'] == [{'doc_id': 'doc-b.jpg', 'image_name': 'b.jpg', 'error': 'unavailable'}]
+    # The first attempt and two retries of b.jpg
+    assert mock_publisher.publish.call_count == 4
+
+
+def test_event_fanout_delivers_to_every_watcher_of_the_batch():
+    fanout = interaction_pod.LocalEventFanout()
+    first = fanout.subscribe('batch-1')
+    second = fanout.subscribe('batch-1')
+    other = fanout.subscribe('batch-2')
+
+    fanout.publish('batch-1', {'type': 'image', 'doc_id': 'doc-1'})
+    fanout.unsubscribe('batch-1', second)
+    fanout.publish('batch-1', {'type': 'completed'})
+
+    assert [first.events.get_nowait()['type'] for _ in range(2)] == ['image', 'completed']
+    assert second.events.get_nowait()['type'] == 'image'
+    assert second.events.empty() and other.events.empty()
+
+
+def test_event_fanout_drops_watchers_that_fall_behind():
+    with patch('interaction_pod.SSE_QUEUE_SIZE', 1):
+        fanout = interaction_pod.LocalEventFanout()
+        watcher = fanout.subscribe('batch-1')
+    fanout.publish('batch-1', {'type': 'image', 'doc_id': 'doc-1'})
+    fanout.publish('batch-1', {'type': 'image', 'doc_id': 'doc-2'})
+
+    assert watcher.dropped
+    assert 'batch-1' not in fanout.watchers
+
+
+def test_update_image_status_publishes_progress_events(client, mock_firestore, mock_publisher):
+    transaction = mock_firestore.transaction.return_value
+    transaction.get_all.return_value = [image_snapshot('test-doc-123', 'test-batch-456')]
+    set_up_batch(mock_firestore, {'email_sent': False, 'remaining_shards': 1}, remaining=[0])
+    watcher = interaction_pod.batch_events.subscribe('test-batch-456')
+    try:
+        response = client.get('/update_image_status?doc_id=test-doc-123&batch_id=test-batch-456')
+    finally:
+        interaction_pod.batch_events.unsubscribe('test-batch-456', watcher)
+
+    assert response.status_code == 200
+    assert watcher.events.get_nowait() == {'type': 'image', 'batch_id': 'test-batch-456', 'doc_id': 'test-doc-123'}
+    assert watcher.events.get_nowait() == {'type': 'completed', 'batch_id': 'test-batch-456'}
+
+
+def sse_events(chunks):
+    # (event, data) of each event in the chunks of a text/event-stream body
+    events = []
+    for chunk in chunks:
+        chunk = chunk.decode('utf-8') if isinstance(chunk, bytes) else chunk
+        if chunk.startswith('event: '):
+            event_line, data_line = chunk.strip().split('\n')
+            events.append((event_line[len('event: '):], json.loads(data_line[len('data: '):])))
+    return events
+
+
+def test_batch_events_streams_progress_until_completed(client, mock_firestore):
+    set_up_batch(mock_firestore, {'job_status': 'Pending', 'image_count': 2, 'remaining_shards': 1}, remaining=[2])
+    mock_firestore.get_all.side_effect = None
+    mock_firestore.get_all.return_value = [Mock(to_dict=Mock(return_value={'count': 2}))]
+
+    response = client.get('/batches/test-batch-456/events', buffered=False)
+    assert response.mimetype == 'text/event-stream'
+    body = iter(response.response)
+    # The stream subscribes before it reads the batch
+    first = next(body)
+    interaction_pod.publish_batch_event('test-batch-456', 'image', doc_id='doc-1')
+    interaction_pod.publish_batch_event('other-batch', 'image', doc_id='doc-9')
+    interaction_pod.publish_batch_event('test-batch-456', 'completed')
+
+    assert sse_events([first] + list(body)) == [
+        ('status', {'type': 'status', 'batch_id': 'test-batch-456', 'job_status': 'Pending', 'image_count': 2,
+                    'remaining': 2}),
+        ('image', {'type': 'image', 'batch_id': 'test-batch-456', 'doc_id': 'doc-1'}),
+        ('completed', {'type': 'completed', 'batch_id': 'test-batch-456'})
+    ]
+    assert 'test-batch-456' not in interaction_pod.batch_events.watchers
+
+
+def test_batch_events_of_completed_batch(client, mock_firestore):
+    set_up_batch(mock_firestore, {'job_status': 'Completed', 'image_count': 2}, remaining=[])
+
+    response = client.get('/batches/test-batch-456/events')
+
+    assert [event for event, _ in sse_events([response.get_data(as_text=True)])] == ['status']
+    assert 'test-batch-456' not in interaction_pod.batch_events.watchers
+
+
+def test_batch_events_of_unknown_batch(client, mock_firestore):
+    mock_firestore.collection.return_value.document.return_value.get.return_value = Mock(exists=False)
+
+    response = client.get('/batches/no-such-batch/events')
+
+    assert response.status_code == 404
+    assert 'no-such-batch' not in interaction_pod.batch_events.watchers
+
+
+def test_update_image_statuses_records_failed_images(client, mock_firestore, mock_publisher):
+    # An image that can never be processed still counts towards completion
+    transaction = mock_firestore.transaction.return_value
+    transaction.get_all.return_value = [image_snapshot('doc1', 'test-batch-456')]
+    set_up_batch(mock_firestore, {'email': 'test@example.com', 'email_sent': False, 'remaining_shards': 1},
+                 remaining=[0])
+    watcher = interaction_pod.batch_events.subscribe('test-batch-456')
+    try:
+        response = client.post('/update_image_statuses', json={'updates': [
+            {'doc_id': 'doc1', 'batch_id': 'test-batch-456', 'error': 'Resize exceeds the pixel limit'}
+        ]})
+    finally:
+        interaction_pod.batch_events.unsubscribe('test-batch-456', watcher)
+
+    assert response.status_code == 200
+    assert json.loads(response.data)['results'][0]['status'] == 'success'
+    update_calls = [call.args for call in transaction.update.call_args_list]
+    assert update_calls[0][1] == {'is_processed': True, 'error': 'Resize exceeds the pixel limit'}
+    assert update_calls[1][1]['count'].value == -1
+    mock_publisher.publish.assert_called_once()
+    assert watcher.events.get_nowait() == {'type': 'image', 'batch_id': 'test-batch-456', 'doc_id': 'doc1',
+                                           'error': 'Resize exceeds the pixel limit'}
@@ -76,23 +76,36 @@ const ImageFetcher = () => {
 
     setError('');
     setIsLoading(true);
+    setImagePairs([]);
 
     try {
-      const response = await fetch(`http://34.66.13.157/get-processed-images?batch_id=${uuidToFetch}`);
+      // Pairs come one JSON object per line as the batch is listed, so the
+      // gallery fills in without waiting for the whole batch
+      const response = await fetch(`http://34.66.13.157/get-processed-images?batch_id=${uuidToFetch}&derivatives=true&format=ndjson`);
 
+      if (response.status === 404) {
+        setError('No images found for this UUID');
+        return;
+      }
       if (!response.ok) {
         throw new Error(`HTTP error! status: ${response.status}`);
       }
 
-      const data = await response.json();
-
-      if (!data || !Array.isArray(data.image_pairs) || data.image_pairs.length === 0) {
-        setError('No images found for this UUID');
-        setImagePairs([]);
-        return;
+      const reader = response.body.getReader();
+      const decoder = new TextDecoder();
+      let buffered = '';
+      while (true) {
+        const { done, value } = await reader.read();
+        buffered += decoder.decode(value || new Uint8Array(), { stream: !done });
+        const lines = buffered.split('\n');
+        buffered = done ? '' : lines.pop();
+        const pairs = lines.filter(line => line.trim()).map(line => JSON.parse(line));
+        if (pairs.length > 0) {
+          setImagePairs(prev => [...prev, ...pairs]);
+          setIsLoading(false);
+        }
+        if (done) break;
       }
-
-      setImagePairs(data.image_pairs);
     } catch (error) {
       console.error('Error fetching images:', error);
       setError('Failed to fetch images. Please try again.');
@@ -146,6 +159,13 @@ const ImageFetcher = () => {
     }
   };
 
+  // Show the processor's preview derivatives in the gallery and keep the
+  // full-size images for zoom and download
+  const galleryUrls = (pair) => {
+    const preview = pair.derivatives && pair.derivatives.preview;
+    return preview ? preview : { before_url: pair.before_url, after_url: pair.after_url };
+  };
+
   const imageCount = imagePairs.length;
 
   return (
@@ -189,11 +209,11 @@ const ImageFetcher = () => {
                 </div>
                 <div className="slider-container">
                   <img-comparison-slider>
-                    <img slot="first" src={pair.before_url} alt="Before" onError={(e) => {
+                    <img slot="first" src={galleryUrls(pair).before_url} alt="Before" onError={(e) => {
                       e.target.src = 'placeholder-image-url';
                       setError('Failed to load some images');
                     }}/>
-                    <img slot="second" src={pair.after_url} alt="After" onError={(e) => {
+                    <img slot="second" src={galleryUrls(pair).after_url} alt="After" onError={(e) => {
                       e.target.src = 'placeholder-image-url';
                       setError('Failed to load some images');
                     }}/>
@@ -213,17 +213,17 @@ const ImageUploader = () => {
     setIsLoading(true);
     setIsSubmitting(true);
     const formData = new FormData();
-    files.forEach((file) => {
-      formData.append('files', file);
-    });
-
     const transformedData = {
       email,
       imagesMetadata: transformMetadata(metadata)
     };
 
+    // Metadata goes first so the handler can name each image as it streams in
     formData.append('metadata', JSON.stringify(transformedData));
     console.log(transformedData);
+    files.forEach((file) => {
+      formData.append('files', file);
+    });
 
     try {
       // const response = await axios.post('http://localhost:5000/upload-images', formData, {
@@ -231,13 +231,13 @@ const ImageUploader = () => {
       //           'Content-Type': 'multipart/form-data'
       //       }
       //   });
-        const response = await axios.post('http://34.66.13.157/upload-images', formData, {
+        const response = await axios.post('http://34.66.13.157/upload-images/stream', formData, {
             headers: {
                 'Content-Type': 'multipart/form-data'
             }
         });
         console.log(response)
-        if (response.status === 200) {
+        if (response.status === 202) {
             // alert('Images uploaded successfully!');
           toast.success('Images uploaded successfully!');
           setFiles([]);